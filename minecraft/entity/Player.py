@@ -1,4 +1,7 @@
+import math
+
 from minecraft.entity.Entity import Entity
+from minecraft.world.ChunkQueue import ChunkQueue
 from pumpkinpy.networking import Packet
 from pumpkinpy.Util import absoluteInt
 
@@ -10,6 +13,7 @@ class Player(Entity):
         self.client = client
 
         self.visibleChunks = []
+        self.chunkQueue = ChunkQueue(self)
         self.chunk = None
 
         self.health = 20
@@ -26,6 +30,12 @@ class Player(Entity):
     def spawn(self, world, x, y, z, onGround=False, broadcast=True):
         self.world = world
 
+        # Never inside the ground under open sky.
+        height = world.getHeightAt(int(math.floor(x)), int(math.floor(z)))
+        if height is not None and y < height:
+            y = height
+            onGround = True
+
         self.x = x
         self.y = y
         self.z = z
@@ -35,22 +45,29 @@ class Player(Entity):
         self.chunk = self.world.getChunk(*self.world.getChunkCoord(self.x, self.z))
         self.chunk.enter(self)
 
-        packet = Packet.SpawnPositionPacket('')
-        packet.writePacket(self.world.spawn)
+        packet = Packet.SpawnPositionPacket.encode(self.world.spawn)
         self.client.send(packet)
 
         if broadcast:
 
-            packet = Packet.NamedEntitySpawnPacket('')
-            packet.writePacket(self)
+            packet = Packet.NamedEntitySpawnPacket.encode(self)
 
             # TODO: broadcast in more than one chunk?
 
-            for entity in self.chunk.entities:
-                if isinstance(entity, Player) and entity != self:
-                    entity.client.send(packet)
+            self.client.server.broadcastManager.toChunk(packet, self.chunk, exclude=self.client)
 
     def move(self, newX, newY, newZ, stance=None, yaw=None, pitch=None, onGround=None, broadcast=True):
+        if self.world is None:
+            # Not spawned yet; the spawn tells the client where it is.
+            return
+
+        if not self.canStandAt(newX, newY, newZ):
+            # Into solid blocks; put the client back where it was, unless it
+            # is stuck in them already.
+            if self.canStandAt(self.x, self.y, self.z):
+                self.sendPosLook()
+                return
+
         self.dX = newX - self.x
         self.dY = newY - self.y
         self.dZ = newZ - self.z
@@ -78,7 +95,9 @@ class Player(Entity):
         chunkX, chunkZ = self.world.getChunkCoord(self.x, self.z)
         chunk = self.world.getChunk(chunkX, chunkZ)
         if not chunk:
-            print("Could not find chunk at: %s %s" % (chunkX, chunkZ))
+            # Past the saved world; the move is picked up again by the first
+            # update after the chunk has been generated.
+            self.world.generator.request(chunkX, chunkZ)
             return
 
         if self.chunk != chunk and self.chunk is not None:
@@ -90,7 +109,9 @@ class Player(Entity):
             for i, coord in enumerate(newVisibleChunks):
                 newVisibleChunks[i] = (coord[0] + chunkdX, coord[1] + chunkdZ)
 
+            self.chunkQueue.setCenter(chunk.x, chunk.z)
             self.updateVisibility(self.visibleChunks, newVisibleChunks)
+            self.world.generator.generateAhead(cmp(chunkdX, 0), cmp(chunkdZ, 0), newVisibleChunks)
 
             if self.chunk is not None:
                 self.chunk.exit(self)
@@ -102,28 +123,43 @@ class Player(Entity):
         if broadcast:
             self.sendPosLook(relative=relative)
 
+    def canStandAt(self, x, y, z):
+        return self.world.canStandAt(int(math.floor(x)), y, int(math.floor(z)))
+
     def rotate(self, yaw, pitch):
         pass
 
     def updateVisibility(self, oldVisibility, newVisibility):
-        for chunkCoord in oldVisibility:
-            x, z = chunkCoord
-            chunk = self.world.getChunk(x, z)
-            if chunkCoord not in newVisibility:
-                chunk.sendUnloadChunk(self.client)
+        oldSet = set(oldVisibility)
+        newSet = set(newVisibility)
 
+        # New tickets are taken before old ones are dropped, so chunks that
+        # stay in view are never evicted in between.
         for chunkCoord in newVisibility:
-            x, z = chunkCoord
-            chunk = self.world.getChunk(x, z)
-            if chunkCoord not in oldVisibility:
-                chunk.sendPreChunk(self.client)
-                chunk.sendLoadChunk(self.client)
+            if chunkCoord not in oldSet:
+                self.world.addTicket(*chunkCoord)
+                self.chunkQueue.enqueue(chunkCoord)
+
+        for chunkCoord in oldVisibility:
+            if chunkCoord not in newSet:
+                if not self.chunkQueue.cancel(chunkCoord):
+                    chunk = self.world.getChunk(*chunkCoord)
+                    if chunk:
+                        chunk.sendUnloadChunk(self.client)
+
+                self.world.removeTicket(*chunkCoord)
 
         self.visibleChunks = newVisibility
 
+    def releaseChunks(self):
+        world = self.world or self.client.server.world
+        for chunkCoord in self.visibleChunks:
+            self.chunkQueue.cancel(chunkCoord)
+            world.removeTicket(*chunkCoord)
+        self.visibleChunks = []
+
     def sendPosLook(self, relative=False):
-        packet = Packet.PlayerPosLookPacket('')
-        packet.writePacket(self.x, self.y, self.stance, self.z, self.h, self.p, self.onGround)
+        packet = Packet.PlayerPosLookPacket.encode(self.x, self.y, self.stance, self.z, self.h, self.p, self.onGround)
         self.client.send(packet)
 
         if relative:
@@ -131,38 +167,28 @@ class Player(Entity):
             y = absoluteInt(self.dY)
             z = absoluteInt(self.dZ)
 
-            packet = Packet.EntityRelativePosLookPacket('')
-            packet.writePacket(self.eid, x, y, z, int(self.h), int(self.p))
+            packet = Packet.EntityRelativePosLookPacket.encode(self.eid, x, y, z, int(self.h), int(self.p))
 
-            for entity in self.chunk.entities:
-                if isinstance(entity, Player) and entity != self:
-                    entity.client.send(packet)
+            self.client.server.broadcastManager.toChunk(packet, self.chunk, exclude=self.client)
         else:
             x = absoluteInt(self.x)
             y = absoluteInt(self.y)
             z = absoluteInt(self.z)
 
-            packet = Packet.EntityMovePacket('')
-            packet.writePacket(self.eid, x, y, z, int(self.h), int(self.p))
+            packet = Packet.EntityMovePacket.encode(self.eid, x, y, z, int(self.h), int(self.p))
 
-            for entity in self.chunk.entities:
-                if isinstance(entity, Player) and entity != self:
-                    entity.client.send(packet)
+            self.client.server.broadcastManager.toChunk(packet, self.chunk, exclude=self.client)
 
     def sendInventory(self):
-        packet = Packet.WindowItemsPacket('')
-        packet.writePacket(windowId=0, inventory=self.inventory)
+        packet = Packet.WindowItemsPacket.encode(windowId=0, inventory=self.inventory)
         self.client.send(packet)
 
     def destroy(self):
         del self.inventory[:]
 
-        packet = Packet.EntityDestroyPacket('')
-        packet.writePacket(self.eid)
+        packet = Packet.EntityDestroyPacket.encode(self.eid)
 
-        for entity in self.chunk.entities:
-            if isinstance(entity, Player) and entity != self:
-                entity.client.send(packet)
+        self.client.server.broadcastManager.toChunk(packet, self.chunk, exclude=self.client)
 
 
 class InventoryItem:
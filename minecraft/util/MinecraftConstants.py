@@ -84,3 +84,44 @@ class Blocks:
     PORTAL = 90
     JACK_O_LANTERN = 91
     CAKE_BLOCK = 92
+
+
+# Light emitted by each block ID, 0-15.
+LIGHT_EMISSION = [0] * 256
+for blockId, level in ((Blocks.LAVA, 15), (Blocks.STATIONARY_LAVA, 15), (Blocks.BROWN_MUSHROOM, 1),
+                       (Blocks.TORCH, 14), (Blocks.FIRE, 15), (Blocks.BURNING_FURNACE, 13),
+                       (Blocks.GLOWING_REDSTONE_ORE, 9), (Blocks.REDSTONE_TORCH_ON, 7), (Blocks.GLOW_STONE, 15),
+                       (Blocks.PORTAL, 11), (Blocks.JACK_O_LANTERN, 15)):
+    LIGHT_EMISSION[blockId] = level
+
+# Light each block ID absorbs on top of the usual falloff of one per block;
+# opaque blocks absorb all of it.
+LIGHT_OPACITY = [15] * 256
+for blockId in (Blocks.AIR, Blocks.SAPLING, Blocks.GLASS, Blocks.YELLOW_FLOWER, Blocks.RED_ROSE,
+                Blocks.BROWN_MUSHROOM, Blocks.RED_MUSHROOM, Blocks.SLAB, Blocks.TORCH, Blocks.FIRE,
+                Blocks.MONSTER_SPAWNER, Blocks.WOODEN_STAIRS, Blocks.REDSTONE_WIRE, Blocks.CROPS, Blocks.SIGN_POST,
+                Blocks.WOODEN_DOOR, Blocks.LADDER, Blocks.MINECART_TRACKS, Blocks.COBBLESTONE_STAIRS,
+                Blocks.WALL_SIGN, Blocks.LEVER, Blocks.STONE_PRESSURE_PLATE, Blocks.IRON_DOOR,
+                Blocks.WOODEN_PRESSURE_PLATE, Blocks.REDSTONE_TORCH_OFF, Blocks.REDSTONE_TORCH_ON,
+                Blocks.STONE_BUTTON, Blocks.SNOW, Blocks.CACTUS, Blocks.SUGAR_CANE, Blocks.FENCE, Blocks.PORTAL,
+                Blocks.CAKE_BLOCK):
+    LIGHT_OPACITY[blockId] = 0
+for blockId, opacity in ((Blocks.LEAVES, 1), (Blocks.WATER, 3), (Blocks.STATIONARY_WATER, 3), (Blocks.ICE, 3)):
+    LIGHT_OPACITY[blockId] = opacity
+
+# Top of each block ID's collision box above the bottom of its cell; players
+# pass through blocks of height 0. Stairs count as their lower step and doors
+# as open, so players are never pushed back off either.
+BLOCK_HEIGHT = [1.0] * 256
+for blockId in (Blocks.AIR, Blocks.SAPLING, Blocks.WATER, Blocks.STATIONARY_WATER, Blocks.LAVA, Blocks.STATIONARY_LAVA,
+                Blocks.YELLOW_FLOWER, Blocks.RED_ROSE, Blocks.BROWN_MUSHROOM, Blocks.RED_MUSHROOM, Blocks.TORCH,
+                Blocks.FIRE, Blocks.REDSTONE_WIRE, Blocks.CROPS, Blocks.SIGN_POST, Blocks.WOODEN_DOOR, Blocks.LADDER,
+                Blocks.MINECART_TRACKS, Blocks.WALL_SIGN, Blocks.LEVER, Blocks.STONE_PRESSURE_PLATE, Blocks.IRON_DOOR,
+                Blocks.WOODEN_PRESSURE_PLATE, Blocks.REDSTONE_TORCH_OFF, Blocks.REDSTONE_TORCH_ON, Blocks.STONE_BUTTON,
+                Blocks.SNOW, Blocks.SUGAR_CANE, Blocks.PORTAL):
+    BLOCK_HEIGHT[blockId] = 0.0
+for blockId, height in ((Blocks.SLAB, 0.5), (Blocks.WOODEN_STAIRS, 0.5), (Blocks.COBBLESTONE_STAIRS, 0.5),
+                        (Blocks.FARMLAND, 0.9375), (Blocks.CACTUS, 0.9375), (Blocks.FENCE, 1.5),
+                        (Blocks.SOUL_SAND, 0.875), (Blocks.CAKE_BLOCK, 0.4375)):
+    BLOCK_HEIGHT[blockId] = height
+del blockId, level, opacity, height
@@ -1,6 +1,59 @@
+import numpy
+from twisted.internet import defer
+
+from minecraft.util.MinecraftConstants import LIGHT_OPACITY
+from minecraft.world.HeightMap import getColumnHeight, getHeightMap
 from pumpkinpy.networking import Packet
 
 
+BLOCK_COUNT = 16 * 16 * 128
+NIBBLE_COUNT = BLOCK_COUNT / 2
+DATA_SIZE = BLOCK_COUNT + NIBBLE_COUNT * 3
+
+# Past this many changes in one flush the whole chunk is resent anyway.
+MAX_TRACKED_CHANGES = 4096
+
+
+def getBlockIndex(x, y, z):
+    # Works on scalars and on NumPy arrays of chunk-relative coordinates.
+    return y + (z << 7) + (x << 11)
+
+
+def unpackNibbles(packed):
+    values = numpy.empty(len(packed) * 2, numpy.uint8)
+    values[0::2] = packed & 15
+    values[1::2] = packed >> 4
+    return values
+
+
+def packNibbles(values):
+    values = numpy.asarray(values, numpy.uint8)
+    return (values[0::2] & 15) | (values[1::2] << 4)
+
+
+def getNibbles(packed, indices):
+    return ((packed[indices >> 1] >> ((indices & 1) << 2)) & 15).astype(numpy.uint8)
+
+
+def setNibbles(packed, indices, values):
+    indices = numpy.asarray(indices)
+    values = numpy.broadcast_to(numpy.asarray(values, numpy.uint8), indices.shape)
+
+    # Low and high nibbles are written separately so two indices sharing a
+    # byte do not overwrite each other.
+    for half in (0, 1):
+        selected = (indices & 1) == half
+        byteIndices = indices[selected] >> 1
+        shift = half << 2
+        packed[byteIndices] = (packed[byteIndices] & (0xf0 >> shift)) | ((values[selected] & 15) << shift)
+
+
+# Block data lives in one contiguous uint8 array laid out exactly like the
+# MapChunk payload: block IDs indexed by getBlockIndex, then block metadata,
+# block light and sky light packed two nibbles per byte. blocks, blockMeta,
+# blockLight and skyLight are views into it, and blockGrid views the block IDs
+# as [x, z, y]. heightMap holds the [x, z] column heights for getHeightAt and
+# the saved HeightMap tag, kept up to date on every block change.
 class Chunk:
     def __init__(self, server, world, x, z, terrainPopulated, blocks, blockMeta, blockLight, skyLight,
                  persistent=False):
@@ -9,35 +62,205 @@ class Chunk:
         self.x = x
         self.z = z
         self.terrainPopulated = terrainPopulated
-        self.blocks = blocks
-        self.blockMeta = blockMeta
-        self.blockLight = blockLight
-        self.skyLight = skyLight
+
+        self.data = numpy.empty(DATA_SIZE, numpy.uint8)
+        self.blocks = self.data[:BLOCK_COUNT]
+        self.blockMeta = self.data[BLOCK_COUNT:BLOCK_COUNT + NIBBLE_COUNT]
+        self.blockLight = self.data[BLOCK_COUNT + NIBBLE_COUNT:BLOCK_COUNT + NIBBLE_COUNT * 2]
+        self.skyLight = self.data[BLOCK_COUNT + NIBBLE_COUNT * 2:]
+        self.blockGrid = self.blocks.reshape(16, 16, 128)
+
+        for view, source in ((self.blocks, blocks), (self.blockMeta, blockMeta), (self.blockLight, blockLight),
+                             (self.skyLight, skyLight)):
+            if not isinstance(source, numpy.ndarray):
+                source = numpy.frombuffer(source, numpy.uint8)
+            view[:] = source
+
+        self.heightMap = getHeightMap(self.blockGrid)
 
         self.persistent = persistent
+        self.dirty = False
+        self.recentlyUsed = False
+
+        # Bumped on every modification; the encoded MapChunk packet is cached
+        # until the version moves on.
+        self.version = 0
+        self.payload = None
+        self.payloadVersion = -1
+        self.payloadWaiters = None
 
         self.entities = []
+        self.players = []
+
+        # Players whose client has been sent this chunk.
+        self.viewers = set()
+
+        # Block indices changed since the last flush, or changedAll once there
+        # are too many to be worth tracking one by one.
+        self.changedBlocks = set()
+        self.changedAll = False
+        self.lastPayloadSize = None
 
     def sendPreChunk(self, client):
-        packet = Packet.PreChunkPacket('')
-        packet.writePacket(self.x, self.z, mode=Packet.PreChunkPacket.LOAD)
+        packet = Packet.PreChunkPacket.encode(self.x, self.z, mode=Packet.PreChunkPacket.LOAD)
         client.send(packet)
 
     def sendLoadChunk(self, client):
-        packet = Packet.MapChunkPacket('')
-        packet.writePacket(self)
-        client.send(packet)
+        d = self.loadPayload()
+        d.addCallback(client.send)
+        return d
+
+    def loadPayload(self):
+        # Compression runs on the server's worker pool. Concurrent requests
+        # for the same chunk share one job.
+        if self.payloadVersion == self.version:
+            return defer.succeed(self.payload)
+
+        d = defer.Deferred()
+        if self.payloadWaiters is not None:
+            self.payloadWaiters.append(d)
+            return d
+
+        self.payloadWaiters = [d]
+        self.compressPayload()
+        return d
+
+    def compressPayload(self):
+        version = self.version
+        chunkData = Packet.MapChunkPacket.getChunkData(self)
+
+        d = self.server.workerPool.submit(Packet.compressChunkData, chunkData)
+        d.addCallbacks(self.payloadCompressed, self.payloadFailed, callbackArgs=(version,))
+
+    def payloadCompressed(self, compressedData, version):
+        if version != self.version:
+            # Modified while compressing, start over from the new contents.
+            self.compressPayload()
+            return
+
+        self.payload = Packet.MapChunkPacket.encode(self, compressedData=compressedData)
+        self.payloadVersion = version
+        self.lastPayloadSize = len(self.payload)
+
+        waiters, self.payloadWaiters = self.payloadWaiters, None
+        for d in waiters:
+            d.callback(self.payload)
+
+    def payloadFailed(self, failure):
+        waiters, self.payloadWaiters = self.payloadWaiters, None
+        for d in waiters:
+            d.errback(failure)
+
+    def modified(self):
+        self.version += 1
+        self.payload = None
+        self.dirty = True
+        self.world.dirtyChunks.add(self)
+
+    def getBlocks(self, indices):
+        return self.blocks[indices]
+
+    def getMeta(self, indices):
+        return getNibbles(self.blockMeta, indices)
+
+    def getBlockLight(self, indices):
+        return getNibbles(self.blockLight, indices)
+
+    def getSkyLight(self, indices):
+        return getNibbles(self.skyLight, indices)
+
+    def setBlock(self, index, blockId, meta=0):
+        nibbleIndex = index >> 1
+        shift = (index & 1) << 2
+        packed = self.blockMeta.item(nibbleIndex)
+        oldId = self.blocks.item(index)
+        if oldId == blockId and packed >> shift & 15 == meta:
+            return False
+
+        self.blocks.itemset(index, blockId)
+        self.blockMeta.itemset(nibbleIndex, (packed & (0xf0 >> shift)) | ((meta & 15) << shift))
+        self.modified()
+        self.blocksChanged((index,))
+        if oldId != blockId:
+            self.updateHeight(index, blockId)
+            self.world.lighting.blockChanged(self, index, oldId)
+        return True
+
+    def setBlocks(self, indices, blockIds, meta=0):
+        # Like setBlock for many blocks at once; returns how many changed.
+        indices = numpy.asarray(indices)
+        blockIds = numpy.broadcast_to(numpy.asarray(blockIds, numpy.uint8), indices.shape)
+        meta = numpy.broadcast_to(numpy.asarray(meta, numpy.uint8) & 15, indices.shape)
+
+        oldIds = self.blocks[indices]
+        idChanged = oldIds != blockIds
+        changed = idChanged | (getNibbles(self.blockMeta, indices) != meta)
+        if not changed.all():
+            indices = indices[changed]
+            if not len(indices):
+                return 0
+            blockIds = blockIds[changed]
+            meta = meta[changed]
+            oldIds = oldIds[changed]
+            idChanged = idChanged[changed]
+        count = len(indices)
+
+        self.blocks[indices] = blockIds
+        setNibbles(self.blockMeta, indices, meta)
+        self.modified()
+        self.blocksChanged(indices)
+
+        # Meta alone changes neither heights nor light.
+        if not idChanged.all():
+            indices = indices[idChanged]
+            oldIds = oldIds[idChanged]
+        if len(indices):
+            columns = numpy.unique(indices >> 7)
+            self.heightMap.reshape(256)[columns] = getHeightMap(self.blocks.reshape(256, 128)[columns])
+
+            self.world.lighting.blocksChanged(self, indices, oldIds)
+        return count
+
+    def updateHeight(self, index, blockId):
+        # Only a block at or above the top of its column can move it.
+        column = index >> 7
+        y = index & 127
+        height = self.heightMap.item(column)
+        if LIGHT_OPACITY[blockId]:
+            if y >= height:
+                self.heightMap.itemset(column, y + 1)
+        elif y == height - 1:
+            self.heightMap.itemset(column, getColumnHeight(self.blocks[index - y:index]))
+
+    def blocksChanged(self, indices):
+        if not self.changedAll:
+            if len(self.changedBlocks) + len(indices) > MAX_TRACKED_CHANGES:
+                self.changedAll = True
+                self.changedBlocks.clear()
+            else:
+                self.changedBlocks.update(numpy.asarray(indices).tolist())
+
+        self.world.chunkChanged(self)
+
+    def getMemorySize(self):
+        size = self.data.nbytes
+        if self.payload is not None:
+            size += len(self.payload)
+        return size
 
     def sendUnloadChunk(self, client):
         if self.persistent:
             return
 
-        packet = Packet.PreChunkPacket('')
-        packet.writePacket(self.x, self.z, mode=Packet.PreChunkPacket.UNLOAD)
+        packet = Packet.PreChunkPacket.encode(self.x, self.z, mode=Packet.PreChunkPacket.UNLOAD)
         client.send(packet)
 
     def enter(self, entity):
         self.entities.append(entity)
+        if entity.client is not None:
+            self.players.append(entity)
 
     def exit(self, entity):
         self.entities.remove(entity)
+        if entity.client is not None:
+            self.players.remove(entity)
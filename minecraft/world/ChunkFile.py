@@ -0,0 +1,199 @@
+import errno
+import os
+
+from nbt.nbt import NBTFile, TAG_Byte, TAG_Byte_Array, TAG_Compound, TAG_Int
+
+from minecraft.world.Chunk import BLOCK_COUNT, NIBBLE_COUNT
+from pumpkinpy.Util import base36
+
+
+# Reading and writing the one-file-per-chunk layout. The module functions only
+# deal in plain strings and numbers so they can run on worker threads or
+# processes.
+
+CHUNK_ARRAYS = ('Blocks', 'Data', 'BlockLight', 'SkyLight')
+CHUNK_SIZES = (BLOCK_COUNT, NIBBLE_COUNT, NIBBLE_COUNT, NIBBLE_COUNT)
+
+# Chunk files per preload job.
+LOAD_BATCH = 16
+
+
+def readChunkNBT(nbt, location, x, z):
+    # The arrays come back joined into one string along with their sizes,
+    # which pickles far more compactly than the NBT tree. Errors come back as
+    # a message.
+    try:
+        level = nbt['Level']
+
+        if x != level['xPos'].value or z != level['zPos'].value:
+            return location, x, z, 'position does not match the file name'
+
+        arrays = [level[name].value for name in CHUNK_ARRAYS]
+        data = ''.join(bytes(array) for array in arrays)
+        return location, x, z, (level['TerrainPopulated'].value, tuple(len(array) for array in arrays), data)
+    except Exception as e:
+        return location, x, z, str(e) or e.__class__.__name__
+
+
+def readChunkFile(job):
+    location, x, z = job
+    try:
+        nbt = NBTFile(filename=location, buffer='rb')
+    except Exception as e:
+        return location, x, z, str(e) or e.__class__.__name__
+    return readChunkNBT(nbt, location, x, z)
+
+
+def readChunkFiles(jobs):
+    return [readChunkFile(job) for job in jobs]
+
+
+def writeChunkNBT(nbt, x, z, terrainPopulated, data, heightMap=None):
+    # data is a chunk's storage as laid out by Chunk, heightMap an [x, z]
+    # array. Whatever else an existing tree holds, such as entities, is kept.
+    if nbt is None:
+        nbt = NBTFile()
+        level = TAG_Compound()
+        nbt['Level'] = level
+        level['xPos'] = TAG_Int(x)
+        level['zPos'] = TAG_Int(z)
+    else:
+        level = nbt['Level']
+
+    level['TerrainPopulated'] = TAG_Byte(int(terrainPopulated))
+
+    offset = 0
+    for name, size in zip(CHUNK_ARRAYS, CHUNK_SIZES):
+        tag = TAG_Byte_Array()
+        tag.value = bytearray(data[offset:offset + size])
+        level[name] = tag
+        offset += size
+
+    if heightMap is not None:
+        tag = TAG_Byte_Array()
+        # Stored z-major.
+        tag.value = bytearray(heightMap.T.astype('uint8').tobytes())
+        level['HeightMap'] = tag
+
+    return nbt
+
+
+def makeDirectories(directory):
+    # Other threads and processes may be creating the same directory.
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(directory):
+            raise
+
+
+def writeNBTFile(location, nbt):
+    # The file is written next to its final name and renamed over it, so a
+    # crash never leaves a half-written chunk behind.
+    makeDirectories(os.path.dirname(location))
+
+    temporary = location + '.tmp'
+    nbt.write_file(filename=temporary)
+    if os.name == 'nt' and os.path.exists(location):
+        os.remove(location)
+    os.rename(temporary, location)
+
+
+def writeChunkFile(location, x, z, terrainPopulated, data, heightMap=None):
+    nbt = None
+    if os.path.exists(location):
+        nbt = NBTFile(filename=location, buffer='rb')
+
+    writeNBTFile(location, writeChunkNBT(nbt, x, z, terrainPopulated, data, heightMap))
+
+
+def runLoadJob(job):
+    # Preload jobs are (function, args...) tuples returning a list of
+    # readChunkNBT results.
+    return job[0](*job[1:])
+
+
+# The original layout: c.<x>.<z>.dat files nested in base36 directories named
+# after the low six bits of each coordinate.
+class ChunkFileStorage:
+    def __init__(self, folder):
+        self.folder = folder
+
+    def getChunkPath(self, x, z):
+        return os.path.join(self.folder, base36(x & 63), base36(z & 63), 'c.%s.%s.dat' % (base36(x), base36(z)))
+
+    def readChunk(self, x, z):
+        # A readChunkNBT result, or None if the chunk was never saved.
+        location = self.getChunkPath(x, z)
+        if not os.path.exists(location):
+            return None
+        return readChunkFile((location, x, z))
+
+    def hasChunk(self, x, z):
+        return os.path.exists(self.getChunkPath(x, z))
+
+    def writeChunk(self, x, z, terrainPopulated, data, heightMap=None):
+        writeChunkFile(self.getChunkPath(x, z), x, z, terrainPopulated, data, heightMap)
+
+    def readNBT(self, x, z):
+        location = self.getChunkPath(x, z)
+        if not os.path.exists(location):
+            return None
+        return NBTFile(filename=location, buffer='rb')
+
+    def writeNBT(self, x, z, nbt):
+        writeNBTFile(self.getChunkPath(x, z), nbt)
+
+    def handleChunkFile(self, root, name):
+        # Returns the (location, x, z) of a valid chunk file name, else None.
+        location = os.path.join(root, name)
+        root = root.replace(self.folder, '')[1:]
+
+        dirs = root.split(os.sep)
+        if len(dirs) != 2:
+            return None
+
+        a, b = dirs
+
+        chunkFile = name.split('.')
+        if len(chunkFile) != 4:
+            print("Invalid chunk file: %s" % location)
+            return None
+
+        if chunkFile[0] != 'c' or chunkFile[3] != 'dat':
+            print("Invalid chunk file: %s" % location)
+            return None
+
+        x, z = chunkFile[1], chunkFile[2]
+        x, z = int(x, 36), int(z, 36)
+
+        if a != base36(x & 63):
+            print("Invalid chunk file: %s" % location)
+            return None
+        if b != base36(z & 63):
+            print("Invalid chunk file: %s" % location)
+            return None
+
+        return location, x, z
+
+    def listChunkFiles(self):
+        files = []
+        for root, dirs, names in os.walk(self.folder):
+            for name in names:
+                job = self.handleChunkFile(root, name)
+                if job is not None:
+                    files.append(job)
+        return files
+
+    def listChunks(self):
+        return [(x, z) for location, x, z in self.listChunkFiles()]
+
+    def getLoadJobs(self, skip=()):
+        # Returns the preload jobs and the number of chunks they cover,
+        # leaving out the (x, z) coordinates in skip.
+        files = [job for job in self.listChunkFiles() if (job[1], job[2]) not in skip]
+        jobs = [(readChunkFiles, files[i:i + LOAD_BATCH]) for i in xrange(0, len(files), LOAD_BATCH)]
+        return jobs, len(files)
+
+    def close(self):
+        pass
@@ -0,0 +1,98 @@
+REGION_SHIFT = 5
+
+COORD_MASK = 0xffffffff
+
+
+def packKey(x, z):
+    # x in the high bits with its sign, z as 32-bit two's complement in the
+    # low bits, which keeps keys within a machine int.
+    return x << 32 | (z & COORD_MASK)
+
+
+def unpackKey(key):
+    x = key >> 32
+    z = key & COORD_MASK
+    if z & 0x80000000:
+        z -= 0x100000000
+    return x, z
+
+
+_offsetTables = {}
+
+
+def getRadiusOffsets(radius):
+    # (dX, dZ) offsets covering the same square as World.getAllChunksInRadius,
+    # nearest first. Tables are built once per radius and shared.
+    offsets = _offsetTables.get(radius)
+    if offsets is None:
+        offsets = [(dX, dZ) for dX in xrange(-radius, radius) for dZ in xrange(-radius, radius)]
+        offsets.sort(key=lambda offset: (max(abs(offset[0]), abs(offset[1])), offset[0] ** 2 + offset[1] ** 2))
+        offsets = _offsetTables[radius] = tuple(offsets)
+    return offsets
+
+
+NEIGHBOR_OFFSETS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+
+
+# Loaded chunks keyed by packed integer coordinates, also grouped into
+# 32x32 chunk regions so whole regions can be visited or saved together.
+class ChunkMap:
+    def __init__(self):
+        self.chunks = {}
+        self.regions = {}
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __iter__(self):
+        return self.chunks.itervalues()
+
+    def get(self, x, z):
+        return self.chunks.get(x << 32 | (z & COORD_MASK))
+
+    def add(self, chunk):
+        key = packKey(chunk.x, chunk.z)
+        self.chunks[key] = chunk
+
+        regionKey = packKey(chunk.x >> REGION_SHIFT, chunk.z >> REGION_SHIFT)
+        region = self.regions.get(regionKey)
+        if region is None:
+            region = self.regions[regionKey] = {}
+        region[key] = chunk
+
+    def remove(self, x, z):
+        key = packKey(x, z)
+        chunk = self.chunks.pop(key, None)
+        if chunk is None:
+            return None
+
+        regionKey = packKey(x >> REGION_SHIFT, z >> REGION_SHIFT)
+        region = self.regions[regionKey]
+        del region[key]
+        if not region:
+            del self.regions[regionKey]
+        return chunk
+
+    def getRegion(self, regionX, regionZ):
+        region = self.regions.get(packKey(regionX, regionZ))
+        if region is None:
+            return []
+        return region.values()
+
+    def getRegionCoords(self):
+        return [unpackKey(regionKey) for regionKey in self.regions]
+
+    def inRadius(self, centerX, centerZ, radius):
+        # Yields the loaded chunks around a center, nearest first.
+        chunks = self.chunks
+        for dX, dZ in getRadiusOffsets(radius):
+            chunk = chunks.get((centerX + dX) << 32 | ((centerZ + dZ) & COORD_MASK))
+            if chunk is not None:
+                yield chunk
+
+    def neighbors(self, x, z):
+        chunks = self.chunks
+        for dX, dZ in NEIGHBOR_OFFSETS:
+            chunk = chunks.get((x + dX) << 32 | ((z + dZ) & COORD_MASK))
+            if chunk is not None:
+                yield chunk
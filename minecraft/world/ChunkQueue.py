@@ -0,0 +1,176 @@
+from twisted.internet import defer
+
+from pumpkinpy.networking import Packet
+
+
+# Per-player queue of chunks waiting to be streamed to the client. Chunks are
+# sent nearest first (ring by ring around the player's chunk) under a per-tick
+# chunk budget and a byte budget that refills every tick, so a join or a fast
+# flight does not saturate the connection. The queue pumps in the broadcasting
+# phase of each tick while it has work, and leaves the tick loop when idle.
+# Chunks that leave view before they were sent are dropped without the client
+# ever hearing about them.
+class ChunkQueue:
+    CHUNKS_PER_TICK = 4
+    BYTES_PER_TICK = 64 * 1024
+    MAX_IN_FLIGHT = 8
+
+    def __init__(self, player):
+        self.player = player
+
+        self.centerX = 0
+        self.centerZ = 0
+
+        self.pending = set()
+        self.order = []
+        self.orderDirty = False
+
+        self.inFlight = set()
+        self.sent = set()
+
+        self.byteCredit = self.BYTES_PER_TICK
+        self.waiters = []
+        self.pumping = False
+
+    def setCenter(self, chunkX, chunkZ):
+        if (chunkX, chunkZ) != (self.centerX, self.centerZ):
+            self.centerX = chunkX
+            self.centerZ = chunkZ
+            self.orderDirty = True
+
+    def enqueue(self, chunkCoord):
+        if chunkCoord in self.pending or chunkCoord in self.inFlight or chunkCoord in self.sent:
+            return
+
+        self.pending.add(chunkCoord)
+        self.orderDirty = True
+        self.schedule()
+
+    def cancel(self, chunkCoord):
+        # Returns True if the chunk never reached the client, in which case
+        # there is nothing to unload.
+        if chunkCoord in self.sent:
+            self.sent.remove(chunkCoord)
+            chunk = self.getWorld().chunks.get(*chunkCoord)
+            if chunk is not None:
+                chunk.viewers.discard(self.player)
+
+        if chunkCoord in self.pending:
+            self.pending.remove(chunkCoord)
+        elif chunkCoord in self.inFlight:
+            self.inFlight.remove(chunkCoord)
+        else:
+            return False
+
+        self.checkWaiters()
+        return True
+
+    def waitFor(self, chunkCoords):
+        # Fires once every given chunk has been sent or cancelled.
+        d = defer.Deferred()
+        self.waiters.append((set(chunkCoords), d))
+        self.checkWaiters()
+        return d
+
+    def checkWaiters(self):
+        if not self.waiters:
+            return
+
+        waiting = self.pending | self.inFlight
+        for entry in self.waiters[:]:
+            chunkCoords, d = entry
+            if not chunkCoords & waiting:
+                self.waiters.remove(entry)
+                d.callback(None)
+
+    def getWorld(self):
+        return self.player.world or self.player.client.server.world
+
+    def distance(self, chunkCoord):
+        dX = chunkCoord[0] - self.centerX
+        dZ = chunkCoord[1] - self.centerZ
+        return max(abs(dX), abs(dZ)), dX * dX + dZ * dZ
+
+    def getTicks(self):
+        return self.player.client.server.ticks
+
+    def schedule(self):
+        if not self.pumping:
+            self.pumping = True
+            self.getTicks().register('broadcasting', self.pump)
+
+    def stop(self):
+        if self.pumping:
+            self.pumping = False
+            self.getTicks().unregister('broadcasting', self.pump)
+
+    def pump(self, tick):
+        self.byteCredit = min(self.byteCredit + self.BYTES_PER_TICK, self.BYTES_PER_TICK * 2)
+
+        if self.orderDirty:
+            # Farthest first, so the nearest chunk is popped off the end.
+            self.order = sorted(self.pending, key=self.distance, reverse=True)
+            self.orderDirty = False
+
+        world = self.getWorld()
+
+        budget = self.CHUNKS_PER_TICK
+        while (self.order and budget > 0 and self.byteCredit > 0 and
+               len(self.inFlight) < self.MAX_IN_FLIGHT):
+            chunkCoord = self.order.pop()
+            if chunkCoord not in self.pending:
+                continue
+            self.pending.remove(chunkCoord)
+
+            self.inFlight.add(chunkCoord)
+            budget -= 1
+
+            chunk = world.getChunk(*chunkCoord)
+            if chunk is None:
+                d = world.generator.generate(*chunkCoord)
+                d.addCallbacks(self.chunkGenerated, self.payloadFailed, callbackArgs=(chunkCoord,),
+                               errbackArgs=(chunkCoord,))
+            else:
+                self.loadPayload(chunk, chunkCoord)
+
+        self.checkWaiters()
+
+        if not self.pending and not self.inFlight:
+            self.stop()
+
+    def loadPayload(self, chunk, chunkCoord):
+        d = chunk.loadPayload()
+        d.addCallbacks(self.payloadReady, self.payloadFailed, callbackArgs=(chunk, chunkCoord),
+                       errbackArgs=(chunkCoord,))
+
+    def chunkGenerated(self, chunk, chunkCoord):
+        if chunkCoord in self.inFlight:
+            self.loadPayload(chunk, chunkCoord)
+
+    def payloadReady(self, payload, chunk, chunkCoord):
+        if chunkCoord not in self.inFlight:
+            return
+        self.inFlight.remove(chunkCoord)
+
+        client = self.player.client
+        if not client.connected:
+            return
+
+        client.send(Packet.PreChunkPacket.encode(chunk.x, chunk.z, mode=Packet.PreChunkPacket.LOAD))
+        client.send(payload)
+
+        self.byteCredit -= len(payload)
+        chunk.viewers.add(self.player)
+
+        metrics = client.server.metrics
+        metrics.chunksSent += 1
+        metrics.chunkBytesSent += len(payload)
+
+        self.sent.add(chunkCoord)
+        self.checkWaiters()
+
+    def payloadFailed(self, failure, chunkCoord):
+        print("Could not send chunk %s %s: %s" % (chunkCoord[0], chunkCoord[1],
+                                                   failure.getErrorMessage()))
+        self.inFlight.discard(chunkCoord)
+        self.checkWaiters()
@@ -0,0 +1,127 @@
+from twisted.internet import defer
+
+from minecraft.world.ChunkMap import packKey
+
+
+# Write-behind persistence for modified chunks. Each save copies the chunk's
+# storage on the reactor thread, then encodes the NBT and writes it through the
+# world's storage on the worker pool's threads, which share its open files.
+# Saves start in the saving phase of each tick, at most BYTES_PER_TICK
+# snapshot bytes per tick, so an autosave never lands as one burst of work on
+# the reactor. Everything still dirty is flushed at shutdown, without waiting
+# for ticks.
+class ChunkSaver:
+    AUTOSAVE_INTERVAL = 30.0
+    BYTES_PER_TICK = 512 * 1024
+    MAX_IN_FLIGHT = 16
+
+    def __init__(self, world):
+        self.world = world
+
+        self.queue = []
+        self.queued = set()
+        # Packed chunk key -> Deferred of the write in progress.
+        self.saving = {}
+
+        self.autosaveTicks = 0
+        self.flushed = None
+
+    def start(self):
+        ticks = self.world.server.ticks
+        self.autosaveTicks = int(round(self.AUTOSAVE_INTERVAL * ticks.TICKS_PER_SECOND))
+        ticks.register('saving', self.tick)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.flushAll)
+
+    def tick(self, tick):
+        if self.autosaveTicks > 0 and tick and not tick % self.autosaveTicks:
+            self.autosave()
+        if self.queue and self.flushed is None:
+            self.step()
+
+    def autosave(self):
+        for chunk in list(self.world.dirtyChunks):
+            self.save(chunk)
+
+    def save(self, chunk):
+        if chunk in self.queued:
+            return
+
+        self.queued.add(chunk)
+        self.queue.append(chunk)
+
+    def isSaving(self, chunk):
+        return chunk in self.queued or packKey(chunk.x, chunk.z) in self.saving
+
+    def step(self):
+        # No limits while flushing for shutdown.
+        flushing = self.flushed is not None
+        budget = self.BYTES_PER_TICK
+
+        remaining = []
+        for chunk in self.queue:
+            key = packKey(chunk.x, chunk.z)
+            busy = budget <= 0 or len(self.saving) >= self.MAX_IN_FLIGHT
+            if key in self.saving or (not flushing and busy):
+                remaining.append(chunk)
+                continue
+
+            self.queued.discard(chunk)
+            if chunk.dirty:
+                budget -= self.write(chunk, key)
+
+        self.queue = remaining
+        self.checkFlushed()
+
+    def write(self, chunk, key):
+        world = self.world
+        snapshot = chunk.data.tobytes()
+
+        chunk.dirty = False
+        world.dirtyChunks.discard(chunk)
+
+        d = world.server.workerPool.submitThread(world.storage.writeChunk, chunk.x, chunk.z,
+                                                 chunk.terrainPopulated, snapshot, chunk.heightMap.copy())
+        self.saving[key] = d
+        d.addCallbacks(self.written, self.failed, callbackArgs=(key,), errbackArgs=(key, chunk))
+        return len(snapshot)
+
+    def written(self, result, key):
+        del self.saving[key]
+
+        # Clean chunks held back from eviction can go now.
+        self.world.evict()
+        self.flushNext()
+
+    def failed(self, failure, key, chunk):
+        del self.saving[key]
+        print('Could not save chunk %d %d: %s' % (chunk.x, chunk.z, failure.getErrorMessage()))
+
+        # Retried on the next autosave.
+        chunk.dirty = True
+        self.world.dirtyChunks.add(chunk)
+        self.flushNext()
+
+    def flushAll(self):
+        self.flushed = defer.Deferred()
+        for chunk in list(self.world.dirtyChunks):
+            self.save(chunk)
+
+        d = self.flushed
+        self.step()
+        return d
+
+    def flushNext(self):
+        # While flushing, chunks held back behind a write to the same chunk
+        # go as soon as it finishes.
+        if self.flushed is not None and self.queue:
+            self.step()
+        else:
+            self.checkFlushed()
+
+    def checkFlushed(self):
+        if self.flushed is None or self.queue or self.saving:
+            return
+
+        print('Saved all chunks.')
+        d, self.flushed = self.flushed, None
+        d.callback(None)
@@ -0,0 +1,27 @@
+import numpy
+
+from minecraft.util.MinecraftConstants import LIGHT_OPACITY
+
+
+# Column heights the way the HeightMap chunk tag counts them: the lowest y
+# with nothing but fully transparent blocks from there up. Chunks keep them for
+# World.getHeightAt, which spawning players are stood on, and for the HeightMap
+# tag written on save. Lighting works out direct sky light from the block
+# opacities itself, since leaves and water dim it without stopping it.
+
+# Whether each block ID takes anything out of light passing through it.
+SOLID = numpy.array([opacity != 0 for opacity in LIGHT_OPACITY])
+
+
+def getHeightMap(blocks):
+    # Heights of [..., y] columns of block IDs as uint8.
+    solid = SOLID[blocks]
+    heights = solid.shape[-1] - numpy.argmax(solid[..., ::-1], axis=-1)
+    heights[~solid.any(axis=-1)] = 0
+    return heights.astype(numpy.uint8)
+
+
+def getColumnHeight(column):
+    # The same for a single column starting at y = 0.
+    solid = numpy.flatnonzero(SOLID[column])
+    return int(solid[-1]) + 1 if len(solid) else 0
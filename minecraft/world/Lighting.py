@@ -0,0 +1,389 @@
+import time
+from collections import deque
+
+import numpy
+
+from minecraft.util.MinecraftConstants import LIGHT_EMISSION, LIGHT_OPACITY
+from minecraft.world.Chunk import (BLOCK_COUNT, NIBBLE_COUNT, getBlockIndex, packNibbles, setNibbles,
+                                   unpackNibbles)
+
+
+# Offsets of the two light layers in Chunk.data.
+BLOCK_LIGHT = BLOCK_COUNT + NIBBLE_COUNT
+SKY_LIGHT = BLOCK_COUNT + NIBBLE_COUNT * 2
+
+EMISSION = numpy.array(LIGHT_EMISSION, numpy.int16)
+OPACITY = numpy.array(LIGHT_OPACITY, numpy.int16)
+
+DIRECTIONS = ((1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1))
+SIDES = ((-1, 0), (1, 0), (0, -1), (0, 1))
+
+
+def getBorder(light, dX, dZ):
+    # The [x, z, y] layer's border plane facing the given side.
+    if dX:
+        return light[0 if dX < 0 else 15]
+    return light[:, 0 if dZ < 0 else 15]
+
+
+def getDirectSkyLight(opacity):
+    # Sky light falling straight down columns of [..., y] opacities: full
+    # strength until something absorbs part of it.
+    light = 15 - numpy.cumsum(opacity[..., ::-1], axis=-1, dtype=numpy.int16)[..., ::-1]
+    return numpy.maximum(light, 0)
+
+
+def spreadLight(light, decay, edges):
+    # Floods an [x, z, y] int16 chunk layer until it is stable, taking in
+    # light from the neighbouring chunk planes in edges (one per SIDES entry,
+    # None where there is no neighbour).
+    padded = numpy.zeros((18, 18, 130), numpy.int16)
+    targets = (padded[0, 1:17, 1:129], padded[17, 1:17, 1:129], padded[1:17, 0, 1:129],
+               padded[1:17, 17, 1:129])
+    for plane, target in zip(edges, targets):
+        if plane is not None:
+            target[:] = plane
+
+    padded[1:17, 1:17, 1:129] = light
+    return floodLight(padded, decay)
+
+
+def floodLight(padded, decay):
+    # Floods the inside of a padded [x, z, y] signed array in place, the
+    # one-block rim staying as it is. Each pass moves light one block, so at
+    # most 14 passes are needed.
+    inner = padded[1:-1, 1:-1, 1:-1]
+    for i in xrange(14):
+        best = numpy.maximum(padded[:-2, 1:-1, 1:-1], padded[2:, 1:-1, 1:-1])
+        numpy.maximum(best, padded[1:-1, :-2, 1:-1], out=best)
+        numpy.maximum(best, padded[1:-1, 2:, 1:-1], out=best)
+        numpy.maximum(best, padded[1:-1, 1:-1, :-2], out=best)
+        numpy.maximum(best, padded[1:-1, 1:-1, 2:], out=best)
+        best -= decay
+
+        if not (best > inner).any():
+            break
+        numpy.maximum(inner, best, out=inner)
+
+    return inner
+
+
+def getVolume(region):
+    minX, minY, minZ, maxX, maxY, maxZ = region
+    return (maxX - minX) * (maxY - minY) * (maxZ - minZ)
+
+
+# Keeps block light and sky light up to date as blocks change. A change
+# queues the box of blocks whose light it can reach: no further than the
+# brightest light that shone or can shine through the block, less one. The
+# box is relit with whole-array passes, from the light sources inside it and
+# the unchanged light just outside, so the cost of an edit is bounded by its
+# box instead of by the number of blocks the light touches. Boxes run across
+# chunk borders; unloaded chunks stop light. Overlapping boxes, such as those
+# of the blocks of one fill, are merged into one.
+#
+# Boxes are worked off in the lighting phase of each tick, at most BUDGET
+# seconds per tick, and every chunk whose light changed is marked modified so
+# it is saved and encoded afresh before it is sent again. Clients light their
+# own block changes, so the light is not pushed to viewers.
+#
+# Changes of more than RELIGHT_THRESHOLD blocks at once queue one box around
+# all of them, padded by the furthest light can reach. New chunks without
+# light are relit as a whole; the light that runs out of them into their
+# neighbours is spread by a BFS queue (increases).
+class LightingEngine:
+    BUDGET = 0.005
+    RELIGHT_THRESHOLD = 1024
+
+    def __init__(self, world):
+        self.world = world
+
+        # Layer -> (minX, minY, minZ, maxX, maxY, maxZ) boxes to relight.
+        self.regions = {BLOCK_LIGHT: deque(), SKY_LIGHT: deque()}
+        # (layer, x, y, z)
+        self.increases = deque()
+        self.relights = deque()
+        self.relightQueued = set()
+
+        self.changedChunks = set()
+
+        world.server.ticks.register('lighting', self.step)
+
+    def blockChanged(self, chunk, index, oldId):
+        newId = chunk.blocks.item(index)
+        oldOpacity = LIGHT_OPACITY[oldId]
+        newOpacity = LIGHT_OPACITY[newId]
+        if oldOpacity == newOpacity and LIGHT_EMISSION[oldId] == LIGHT_EMISSION[newId]:
+            return
+
+        x = chunk.x << 4 | index >> 11
+        y = index & 127
+        z = chunk.z << 4 | index >> 7 & 15
+
+        reach = max(LIGHT_EMISSION[oldId], LIGHT_EMISSION[newId],
+                    self.getLevel(BLOCK_LIGHT, x, y, z))
+        if newOpacity < oldOpacity:
+            reach = max(reach, self.getNeighborLevel(BLOCK_LIGHT, x, y, z))
+        self.queueRegion(BLOCK_LIGHT, x, y, z, x, y, z, reach)
+
+        if oldOpacity != newOpacity:
+            # Sky light straight down the column can change far below.
+            opacity = OPACITY[chunk.blockGrid[index >> 11, index >> 7 & 15]]
+            newDirect = getDirectSkyLight(opacity)
+            opacity[y] = oldOpacity
+            oldDirect = getDirectSkyLight(opacity)
+
+            reach = self.getLevel(SKY_LIGHT, x, y, z)
+            if newOpacity < oldOpacity:
+                reach = max(reach, self.getNeighborLevel(SKY_LIGHT, x, y, z))
+            bottom = top = y
+            changed = numpy.flatnonzero(newDirect != oldDirect)
+            if len(changed):
+                reach = max(reach, int(numpy.maximum(newDirect, oldDirect)[changed].max()))
+                bottom = min(bottom, int(changed[0]))
+                top = max(top, int(changed[-1]))
+            self.queueRegion(SKY_LIGHT, x, bottom, z, x, top, z, reach)
+
+    def blocksChanged(self, chunk, indices, oldIds):
+        if len(indices) <= self.RELIGHT_THRESHOLD:
+            for index, oldId in zip(numpy.asarray(indices).tolist(), numpy.asarray(oldIds).tolist()):
+                self.blockChanged(chunk, index, oldId)
+            return
+
+        # Too many blocks to size a box for each; one box around all of them
+        # takes in the light of any source that came or went.
+        indices = numpy.asarray(indices)
+        oldIds = numpy.asarray(oldIds)
+        newIds = chunk.blocks[indices]
+        opacityChanged = OPACITY[oldIds] != OPACITY[newIds]
+        lit = indices[opacityChanged | (EMISSION[oldIds] != EMISSION[newIds])]
+        if not len(lit):
+            return
+
+        xs = chunk.x << 4 | lit >> 11
+        ys = lit & 127
+        zs = chunk.z << 4 | lit >> 7 & 15
+        self.queueRegion(BLOCK_LIGHT, xs.min(), ys.min(), zs.min(), xs.max(), ys.max(), zs.max(), 15)
+
+        if opacityChanged.any():
+            # Sky light straight down the changed columns can change far below.
+            columns, positions = numpy.unique(indices >> 7, return_inverse=True)
+            opacity = OPACITY[chunk.blocks.reshape(256, 128)[columns]]
+            newDirect = getDirectSkyLight(opacity)
+            opacity[positions, indices & 127] = OPACITY[oldIds]
+            changed = numpy.nonzero(getDirectSkyLight(opacity) != newDirect)[1]
+            bottom = min(ys.min(), changed.min()) if len(changed) else ys.min()
+            self.queueRegion(SKY_LIGHT, xs.min(), bottom, zs.min(), xs.max(), ys.max(), zs.max(), 15)
+
+    def getLevel(self, layer, x, y, z):
+        if y >= 128:
+            return 15 if layer == SKY_LIGHT else 0
+        chunk = self.world.chunks.get(x >> 4, z >> 4)
+        if chunk is None or y < 0:
+            return 0
+        index = y + ((z & 15) << 7) + ((x & 15) << 11)
+        return chunk.data.item(layer + (index >> 1)) >> ((index & 1) << 2) & 15
+
+    def getNeighborLevel(self, layer, x, y, z):
+        return max(self.getLevel(layer, x + dX, y + dY, z + dZ) for dX, dY, dZ in DIRECTIONS)
+
+    def queueRegion(self, layer, minX, minY, minZ, maxX, maxY, maxZ, reach):
+        # Queues the blocks within reach - 1 of the changed blocks from minX,
+        # minY, minZ to maxX, maxY, maxZ inclusive.
+        if reach <= 0:
+            return
+        radius = reach - 1
+        region = (int(minX) - radius, max(int(minY) - radius, 0), int(minZ) - radius,
+                  int(maxX) + radius + 1, min(int(maxY) + radius + 1, 128), int(maxZ) + radius + 1)
+
+        regions = self.regions[layer]
+        if regions:
+            last = regions[-1]
+            merged = tuple(map(min, last[:3], region[:3]) + map(max, last[3:], region[3:]))
+            if getVolume(merged) <= getVolume(last) + getVolume(region):
+                regions[-1] = merged
+                return
+        regions.append(region)
+
+    def relight(self, chunk):
+        if chunk not in self.relightQueued:
+            self.relightQueued.add(chunk)
+            self.relights.append(chunk)
+
+    def step(self, tick):
+        if not (self.relights or self.regions[BLOCK_LIGHT] or self.regions[SKY_LIGHT] or
+                self.increases or self.changedChunks):
+            return
+
+        deadline = time.time() + self.BUDGET
+
+        while self.relights and time.time() < deadline:
+            chunk = self.relights.popleft()
+            self.relightQueued.discard(chunk)
+            if self.world.chunks.get(chunk.x, chunk.z) is chunk:
+                self.relightChunk(chunk)
+
+        if time.time() < deadline:
+            self.propagate(deadline)
+
+        changedChunks, self.changedChunks = self.changedChunks, set()
+        for chunk in changedChunks:
+            chunk.modified()
+
+    def propagate(self, deadline):
+        for layer, regions in self.regions.iteritems():
+            while regions:
+                if time.time() >= deadline:
+                    return
+                self.relightRegion(layer, *regions.popleft())
+
+        getChunk = self.world.chunks.get
+        increases = self.increases
+        changedChunks = self.changedChunks
+        count = 0
+
+        while increases:
+            count += 1
+            if not count & 63 and time.time() >= deadline:
+                return
+
+            layer, x, y, z = increases.popleft()
+            home = getChunk(x >> 4, z >> 4)
+            if home is None:
+                continue
+
+            index = y + ((z & 15) << 7) + ((x & 15) << 11)
+            level = home.data.item(layer + (index >> 1)) >> ((index & 1) << 2) & 15
+            if level <= 1:
+                continue
+
+            for dX, dY, dZ in DIRECTIONS:
+                neighborY = y + dY
+                if not 0 <= neighborY < 128:
+                    continue
+                neighborX = x + dX
+                neighborZ = z + dZ
+                chunk = home
+                if (neighborX ^ x) >> 4 or (neighborZ ^ z) >> 4:
+                    chunk = getChunk(neighborX >> 4, neighborZ >> 4)
+                    if chunk is None:
+                        continue
+
+                index = neighborY + ((neighborZ & 15) << 7) + ((neighborX & 15) << 11)
+                neighborLevel = level - (LIGHT_OPACITY[chunk.blocks.item(index)] or 1)
+                if neighborLevel <= 0:
+                    continue
+
+                data = chunk.data
+                byteIndex = layer + (index >> 1)
+                shift = (index & 1) << 2
+                packed = data.item(byteIndex)
+                if neighborLevel > packed >> shift & 15:
+                    data.itemset(byteIndex, (packed & (0xf0 >> shift)) | (neighborLevel << shift))
+                    changedChunks.add(chunk)
+                    increases.append((layer, neighborX, neighborY, neighborZ))
+
+    def relightRegion(self, layer, minX, minY, minZ, maxX, maxY, maxZ):
+        # Recomputes one layer inside the box. The light one block around it
+        # is read as well and kept as it is.
+        lowY = max(minY - 1, 0)
+        highY = min(maxY + 1, 128)
+        offset = lowY - minY + 1
+        shape = (maxX - minX + 2, maxZ - minZ + 2)
+
+        # Light fits in int8, which halves the memory the passes go through.
+        padded = numpy.zeros(shape + (maxY - minY + 2,), numpy.int8)
+        # Block IDs from the bottom of the box to the top of the world, for
+        # the sky light falling into it.
+        columns = numpy.zeros(shape + (128 - minY,), numpy.uint8)
+        loaded = numpy.zeros(shape, bool)
+
+        chunks = []
+        pieces = self.world.getBoxChunks(minX - 1, minZ - 1, maxX + 1, maxZ + 1, load=False)
+        for chunk, chunkXs, chunkZs, boxXs, boxZs in pieces:
+            if chunk is None:
+                continue
+            light = unpackNibbles(chunk.data[layer:layer + NIBBLE_COUNT]).reshape(16, 16, 128)
+            padded[boxXs, boxZs, offset:offset + highY - lowY] = light[chunkXs, chunkZs, lowY:highY]
+            columns[boxXs, boxZs] = chunk.blockGrid[chunkXs, chunkZs, minY:]
+            loaded[boxXs, boxZs] = True
+            chunks.append(chunk)
+
+        inner = padded[1:-1, 1:-1, 1:-1]
+        old = inner.copy()
+
+        blocks = columns[1:-1, 1:-1, :maxY - minY]
+        opacity = OPACITY[blocks]
+        if layer == SKY_LIGHT:
+            inner[:] = getDirectSkyLight(OPACITY[columns[1:-1, 1:-1]])[..., :maxY - minY]
+        else:
+            inner[:] = EMISSION[blocks]
+        decay = numpy.maximum(opacity, 1).astype(numpy.int8)
+
+        # Nothing lights or passes light through chunks that are not loaded.
+        missing = ~loaded[1:-1, 1:-1]
+        inner[missing] = 0
+        decay[missing] = 15
+
+        light = floodLight(padded, decay)
+
+        changed = light != old
+        if not changed.any():
+            return
+
+        for chunk in chunks:
+            # The part of the box inside this chunk.
+            startX = max(minX, chunk.x << 4)
+            endX = min(maxX, (chunk.x + 1) << 4)
+            startZ = max(minZ, chunk.z << 4)
+            endZ = min(maxZ, (chunk.z + 1) << 4)
+            if startX >= endX or startZ >= endZ:
+                continue
+
+            part = (slice(startX - minX, endX - minX), slice(startZ - minZ, endZ - minZ))
+            xs, zs, ys = numpy.nonzero(changed[part])
+            if not len(xs):
+                continue
+
+            values = light[part][xs, zs, ys]
+            indices = getBlockIndex(xs + (startX & 15), ys + minY, zs + (startZ & 15))
+            setNibbles(chunk.data[layer:layer + NIBBLE_COUNT], indices, values)
+            self.changedChunks.add(chunk)
+
+    def relightChunk(self, chunk):
+        # Recomputes both layers of a chunk with whole-array passes, taking in
+        # light from loaded neighbours and queueing the border blocks that
+        # should light them in turn.
+        opacity = OPACITY[chunk.blockGrid]
+        decay = numpy.maximum(opacity, 1)
+        neighbors = [self.world.chunks.get(chunk.x + dX, chunk.z + dZ) for dX, dZ in SIDES]
+
+        for layer, view, light in ((SKY_LIGHT, chunk.skyLight, getDirectSkyLight(opacity)),
+                                   (BLOCK_LIGHT, chunk.blockLight, EMISSION[chunk.blockGrid])):
+            edges = []
+            for neighbor, (dX, dZ) in zip(neighbors, SIDES):
+                if neighbor is None:
+                    edges.append(None)
+                else:
+                    neighborLight = unpackNibbles(neighbor.data[layer:layer + NIBBLE_COUNT])
+                    neighborLight = neighborLight.reshape(16, 16, 128)
+                    edges.append(getBorder(neighborLight, -dX, -dZ))
+
+            # Most chunks have no block light at all.
+            if (layer == SKY_LIGHT or light.any() or
+                    any(edge is not None and edge.any() for edge in edges)):
+                light = spreadLight(light, decay, edges)
+            view[:] = packNibbles(light.ravel())
+
+            for edge, (dX, dZ) in zip(edges, SIDES):
+                if edge is None:
+                    continue
+                borderX = chunk.x << 4 | (0 if dX < 0 else 15)
+                borderZ = chunk.z << 4 | (0 if dZ < 0 else 15)
+                for along, y in zip(*numpy.nonzero(getBorder(light, dX, dZ) - 1 > edge)):
+                    if dX:
+                        self.increases.append((layer, borderX, int(y), chunk.z << 4 | int(along)))
+                    else:
+                        self.increases.append((layer, chunk.x << 4 | int(along), int(y), borderZ))
+
+        self.changedChunks.add(chunk)
@@ -0,0 +1,347 @@
+import gzip
+import io
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+from nbt.nbt import NBTFile
+
+from minecraft.world.ChunkFile import ChunkFileStorage, makeDirectories, readChunkNBT, writeChunkNBT
+from minecraft.world.ChunkMap import REGION_SHIFT
+
+
+# McRegion files hold 32x32 chunks. The file starts with two 4KiB tables of
+# 1024 big-endian ints indexed by (x & 31) + (z & 31) * 32: chunk locations,
+# as a sector offset in the upper three bytes and a sector count in the low
+# byte, then last-modified timestamps. Each chunk is stored from the start of
+# its sectors as a 4-byte length, a compression type and the compressed NBT.
+
+SECTOR_SIZE = 4096
+HEADER_SIZE = SECTOR_SIZE * 2
+REGION_SIZE = 1 << REGION_SHIFT
+REGION_MASK = REGION_SIZE - 1
+MAX_SECTORS = 255
+
+GZIP = 1
+ZLIB = 2
+
+INT_STRUCT = struct.Struct('!I')
+CHUNK_HEADER_STRUCT = struct.Struct('!IB')
+
+REGION_NAME = re.compile(r'^r\.(-?\d+)\.(-?\d+)\.mcr$')
+
+
+def getRegionName(regionX, regionZ):
+    return 'r.%d.%d.mcr' % (regionX, regionZ)
+
+
+def isRegionWorld(folder):
+    return os.path.isdir(os.path.join(folder, 'region'))
+
+
+def openStorage(folder, storage='auto', readOnly=False):
+    # 'auto' keeps using region files once a world has any.
+    if storage == 'region' or (storage == 'auto' and isRegionWorld(folder)):
+        return RegionStorage(folder, readOnly=readOnly)
+    return ChunkFileStorage(folder)
+
+
+def compactRegionFile(location):
+    # Rewrites a region file with its chunks packed back to back, dropping the
+    # sectors freed by earlier saves. Returns the sizes before and after.
+    source = RegionFile(location, readOnly=True)
+    temporary = location + '.tmp'
+    if os.path.exists(temporary):
+        os.remove(temporary)
+
+    target = RegionFile(temporary)
+    try:
+        for index in xrange(REGION_SIZE * REGION_SIZE):
+            if source.getLocation(index)[0]:
+                x, z = index & REGION_MASK, index >> REGION_SHIFT
+                compression, data = source.readRaw(x, z)
+                target.writeCompressed(x, z, compression, data, source.getTimestamp(index))
+    finally:
+        source.close()
+        target.close()
+
+    before = os.path.getsize(location)
+    if os.name == 'nt':
+        os.remove(location)
+    os.rename(temporary, location)
+    return before, os.path.getsize(location)
+
+
+def readRegionFile(location, regionX, regionZ):
+    # Parses every chunk in one region; a preload job.
+    try:
+        region = RegionFile(location, readOnly=True)
+    except (IOError, ValueError) as e:
+        print('Invalid region file: %s (%s)' % (location, e))
+        return []
+
+    try:
+        results = []
+        for x, z in region.getChunkCoords(regionX, regionZ):
+            results.append(region.readChunk(x, z))
+        return results
+    finally:
+        region.close()
+
+
+# One region file. Only the header is memory-mapped, so locating a chunk is a
+# lookup in the mapped table and reading it is one seek and read. Writes go to
+# free sectors and the header entry is switched over afterwards, so the old
+# copy stays intact until the new one is complete. All file access is behind
+# a lock because reads come from the reactor thread and writes from workers.
+class RegionFile:
+    def __init__(self, location, readOnly=False):
+        self.location = location
+        self.readOnly = readOnly
+        self.lock = threading.Lock()
+
+        if readOnly:
+            self.file = open(location, 'rb')
+        elif os.path.exists(location):
+            self.file = open(location, 'r+b')
+        else:
+            self.file = open(location, 'w+b')
+
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        if size % SECTOR_SIZE or size < HEADER_SIZE:
+            if readOnly:
+                raise IOError('truncated region file %s' % location)
+            # Pad to whole sectors, which also creates the header of a new file.
+            size = max(HEADER_SIZE, -(-size // SECTOR_SIZE) * SECTOR_SIZE)
+            self.file.truncate(size)
+
+        if readOnly:
+            self.header = mmap.mmap(self.file.fileno(), HEADER_SIZE, access=mmap.ACCESS_READ)
+        else:
+            self.header = mmap.mmap(self.file.fileno(), HEADER_SIZE)
+
+        # One byte per sector, nonzero while in use.
+        self.usedSectors = bytearray(size // SECTOR_SIZE)
+        self.usedSectors[0:2] = '\x01\x01'
+        for index in xrange(REGION_SIZE * REGION_SIZE):
+            offset, count = self.getLocation(index)
+            if offset and offset + count <= len(self.usedSectors):
+                self.usedSectors[offset:offset + count] = '\x01' * count
+
+    def getLocation(self, index):
+        location = INT_STRUCT.unpack_from(self.header, index * 4)[0]
+        return location >> 8, location & 0xff
+
+    def getTimestamp(self, index):
+        return INT_STRUCT.unpack_from(self.header, SECTOR_SIZE + index * 4)[0]
+
+    def hasChunk(self, x, z):
+        return self.getLocation((x & REGION_MASK) + (z & REGION_MASK) * REGION_SIZE)[0] != 0
+
+    def getChunkCoords(self, regionX, regionZ):
+        coords = []
+        for index in xrange(REGION_SIZE * REGION_SIZE):
+            if self.getLocation(index)[0]:
+                coords.append((regionX << REGION_SHIFT | index & REGION_MASK,
+                               regionZ << REGION_SHIFT | index >> REGION_SHIFT))
+        return coords
+
+    def readRaw(self, x, z):
+        # The chunk's compression type and compressed NBT, or None if it is not
+        # in the file.
+        with self.lock:
+            offset, count = self.getLocation((x & REGION_MASK) + (z & REGION_MASK) * REGION_SIZE)
+            if not offset:
+                return None
+
+            self.file.seek(offset * SECTOR_SIZE)
+            length, compression = CHUNK_HEADER_STRUCT.unpack(self.file.read(CHUNK_HEADER_STRUCT.size))
+            if not 0 < length <= count * SECTOR_SIZE - 4:
+                raise IOError('bad chunk length %d' % length)
+            return compression, self.file.read(length - 1)
+
+    def read(self, x, z):
+        # The chunk's uncompressed NBT, or None if it is not in the file.
+        raw = self.readRaw(x, z)
+        if raw is None:
+            return None
+
+        compression, data = raw
+        if compression == ZLIB:
+            return zlib.decompress(data)
+        if compression == GZIP:
+            return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+        raise IOError('unknown compression type %d' % compression)
+
+    def readNBT(self, x, z):
+        data = self.read(x, z)
+        if data is None:
+            return None
+        return NBTFile(buffer=io.BytesIO(data))
+
+    def readChunk(self, x, z):
+        location = '%s[%d,%d]' % (self.location, x, z)
+        try:
+            nbt = self.readNBT(x, z)
+        except Exception as e:
+            return location, x, z, str(e) or e.__class__.__name__
+        return readChunkNBT(nbt, location, x, z)
+
+    def write(self, x, z, data):
+        # data is uncompressed NBT.
+        self.writeCompressed(x, z, ZLIB, zlib.compress(data))
+
+    def writeCompressed(self, x, z, compression, data, timestamp=None):
+        index = (x & REGION_MASK) + (z & REGION_MASK) * REGION_SIZE
+
+        length = len(data) + CHUNK_HEADER_STRUCT.size
+        count = -(-length // SECTOR_SIZE)
+        if count > MAX_SECTORS:
+            raise ValueError('chunk %d %d is too large for a region file' % (x, z))
+
+        with self.lock:
+            oldOffset, oldCount = self.getLocation(index)
+
+            offset = self.usedSectors.find('\x00' * count, 2)
+            if offset < 0:
+                offset = len(self.usedSectors)
+                self.usedSectors.extend('\x00' * count)
+
+            self.file.seek(offset * SECTOR_SIZE)
+            self.file.write(CHUNK_HEADER_STRUCT.pack(len(data) + 1, compression))
+            self.file.write(data)
+            self.file.write('\x00' * (count * SECTOR_SIZE - length))
+            self.file.flush()
+            self.usedSectors[offset:offset + count] = '\x01' * count
+
+            INT_STRUCT.pack_into(self.header, index * 4, offset << 8 | count)
+            if timestamp is None:
+                timestamp = int(time.time())
+            INT_STRUCT.pack_into(self.header, SECTOR_SIZE + index * 4, timestamp)
+
+            if oldOffset:
+                self.usedSectors[oldOffset:oldOffset + oldCount] = '\x00' * oldCount
+
+    def writeNBT(self, x, z, nbt):
+        buffer = io.BytesIO()
+        nbt.write_file(buffer=buffer)
+        self.write(x, z, buffer.getvalue())
+
+    def close(self):
+        with self.lock:
+            if not self.readOnly:
+                self.header.flush()
+            self.header.close()
+            self.file.close()
+
+
+# Chunks stored in region/r.<x>.<z>.mcr files. Chunks not yet in a region
+# file are still read from the one-file-per-chunk layout, and move into their
+# region the next time they are saved. A read-only storage never creates or
+# pads files, so it can read regions another process is writing.
+class RegionStorage:
+    def __init__(self, folder, readOnly=False):
+        self.folder = folder
+        self.readOnly = readOnly
+        self.regionFolder = os.path.join(folder, 'region')
+        self.legacy = ChunkFileStorage(folder)
+
+        # (regionX, regionZ) -> RegionFile, or None if there is no file yet.
+        self.regions = {}
+        self.lock = threading.Lock()
+
+    def getRegion(self, regionX, regionZ, create=False):
+        key = regionX, regionZ
+        with self.lock:
+            region = self.regions.get(key)
+            if region is None and (create or key not in self.regions):
+                location = os.path.join(self.regionFolder, getRegionName(regionX, regionZ))
+                if self.readOnly:
+                    try:
+                        region = RegionFile(location, readOnly=True)
+                    except (IOError, ValueError):
+                        region = None
+                elif create or os.path.exists(location):
+                    makeDirectories(self.regionFolder)
+                    region = RegionFile(location)
+                self.regions[key] = region
+            return region
+
+    def readChunk(self, x, z):
+        region = self.getRegion(x >> REGION_SHIFT, z >> REGION_SHIFT)
+        if region is not None and region.hasChunk(x, z):
+            return region.readChunk(x, z)
+        return self.legacy.readChunk(x, z)
+
+    def hasChunk(self, x, z):
+        return self.hasRegionChunk(x, z) or self.legacy.hasChunk(x, z)
+
+    def hasRegionChunk(self, x, z):
+        # Whether the chunk is in its region file, where it is newer than any
+        # chunk file left behind.
+        region = self.getRegion(x >> REGION_SHIFT, z >> REGION_SHIFT)
+        return region is not None and region.hasChunk(x, z)
+
+    def readNBT(self, x, z):
+        region = self.getRegion(x >> REGION_SHIFT, z >> REGION_SHIFT)
+        if region is not None and region.hasChunk(x, z):
+            return region.readNBT(x, z)
+        return self.legacy.readNBT(x, z)
+
+    def writeNBT(self, x, z, nbt):
+        self.getRegion(x >> REGION_SHIFT, z >> REGION_SHIFT, create=True).writeNBT(x, z, nbt)
+
+    def writeChunk(self, x, z, terrainPopulated, data, heightMap=None):
+        # Keeps whatever else the chunk holds, such as entities.
+        nbt = self.readNBT(x, z)
+        self.writeNBT(x, z, writeChunkNBT(nbt, x, z, terrainPopulated, data, heightMap))
+
+    def listRegionFiles(self):
+        regions = []
+        if os.path.isdir(self.regionFolder):
+            for name in os.listdir(self.regionFolder):
+                match = REGION_NAME.match(name)
+                if match is not None:
+                    regions.append((os.path.join(self.regionFolder, name), int(match.group(1)),
+                                    int(match.group(2))))
+        return regions
+
+    def listChunks(self):
+        chunks = []
+        for location, regionX, regionZ in self.listRegionFiles():
+            region = self.getRegion(regionX, regionZ)
+            if region is not None:
+                chunks.extend(region.getChunkCoords(regionX, regionZ))
+
+        covered = set(chunks)
+        chunks.extend(chunkCoord for chunkCoord in self.legacy.listChunks() if chunkCoord not in covered)
+        return chunks
+
+    def getLoadJobs(self):
+        jobs = []
+        total = 0
+        covered = set()
+        for location, regionX, regionZ in self.listRegionFiles():
+            region = self.getRegion(regionX, regionZ)
+            if region is None:
+                print('Invalid region file: %s' % location)
+                continue
+            coords = region.getChunkCoords(regionX, regionZ)
+            covered.update(coords)
+            total += len(coords)
+            jobs.append((readRegionFile, location, regionX, regionZ))
+
+        legacyJobs, legacyTotal = self.legacy.getLoadJobs(covered)
+        return jobs + legacyJobs, total + legacyTotal
+
+    def close(self):
+        with self.lock:
+            for region in self.regions.itervalues():
+                if region is not None:
+                    region.close()
+            self.regions.clear()
@@ -0,0 +1,172 @@
+import numpy
+from twisted.internet import defer
+
+from minecraft.util.MinecraftConstants import Blocks
+from minecraft.world.Chunk import NIBBLE_COUNT, packNibbles
+from minecraft.world.ChunkFile import CHUNK_SIZES
+from minecraft.world.ChunkMap import packKey
+from minecraft.world.Lighting import OPACITY, getDirectSkyLight, spreadLight
+
+
+SEA_LEVEL = 62
+BASE_HEIGHT = 64
+HEIGHT_RANGE = 28
+
+# (scale in blocks, amplitude) of each heightmap octave.
+OCTAVES = ((256.0, 1.0), (96.0, 0.45), (32.0, 0.2), (12.0, 0.08))
+
+# 16 unit gradients for the noise lattice.
+GRADIENT_ANGLES = numpy.arange(16) * (numpy.pi / 8)
+GRADIENTS_X = numpy.cos(GRADIENT_ANGLES)
+GRADIENTS_Z = numpy.sin(GRADIENT_ANGLES)
+
+
+# Everything below works on whole arrays of coordinates and only depends on
+# the seed, so chunks generated separately, on any worker, line up at their
+# borders.
+
+def hashCoords(seed, xs, zs):
+    # Mixes integer lattice coordinates into well spread uint32 values.
+    with numpy.errstate(over='ignore'):
+        h = xs.astype(numpy.uint32) * numpy.uint32(0x27d4eb2d)
+        h ^= zs.astype(numpy.uint32) * numpy.uint32(0x165667b1)
+        h ^= numpy.uint32(seed & 0xffffffff)
+        h ^= h >> 15
+        h *= numpy.uint32(0x2c1b3c6d)
+        h ^= h >> 12
+        h *= numpy.uint32(0x297a2d39)
+        h ^= h >> 15
+    return h
+
+
+def gradientNoise(seed, xs, zs):
+    # 2D Perlin-style gradient noise in about [-1, 1] at float coordinates.
+    x0 = numpy.floor(xs)
+    z0 = numpy.floor(zs)
+    fx = xs - x0
+    fz = zs - z0
+    x0 = x0.astype(numpy.int64)
+    z0 = z0.astype(numpy.int64)
+
+    def corner(dX, dZ):
+        gradient = hashCoords(seed, x0 + dX, z0 + dZ) & 15
+        return GRADIENTS_X[gradient] * (fx - dX) + GRADIENTS_Z[gradient] * (fz - dZ)
+
+    u = fx * fx * fx * (fx * (fx * 6 - 15) + 10)
+    v = fz * fz * fz * (fz * (fz * 6 - 15) + 10)
+
+    low = corner(0, 0) + u * (corner(1, 0) - corner(0, 0))
+    high = corner(0, 1) + u * (corner(1, 1) - corner(0, 1))
+    return (low + v * (high - low)) * 1.4
+
+
+def getHeights(seed, chunkX, chunkZ):
+    # [x, z] surface heights of one chunk.
+    xs, zs = numpy.mgrid[0:16, 0:16].astype(numpy.float64)
+    xs += chunkX << 4
+    zs += chunkZ << 4
+
+    total = numpy.zeros((16, 16))
+    for octave, (scale, amplitude) in enumerate(OCTAVES):
+        total += gradientNoise(seed + octave * 0x9e3779b9, xs / scale, zs / scale) * amplitude
+    total /= sum(amplitude for scale, amplitude in OCTAVES)
+
+    return numpy.clip(BASE_HEIGHT + total * HEIGHT_RANGE, 4, 120).astype(numpy.int32)
+
+
+def generateChunkData(seed, chunkX, chunkZ):
+    # Returns a chunk the way ChunkFile.readChunkNBT does: stone under a few
+    # blocks of dirt, grass on land, sand and water below sea level, with sky
+    # light already spread inside the chunk.
+    heights = getHeights(seed, chunkX, chunkZ)[:, :, numpy.newaxis]
+    ys = numpy.arange(128)[numpy.newaxis, numpy.newaxis, :]
+
+    beach = heights <= SEA_LEVEL + 1
+    topsoil = numpy.where(beach, Blocks.SAND, Blocks.DIRT)
+    surface = numpy.where(beach, Blocks.SAND, Blocks.GRASS)
+
+    blocks = numpy.full((16, 16, 128), Blocks.AIR, numpy.uint8)
+    blocks[(ys > heights) & (ys <= SEA_LEVEL)] = Blocks.STATIONARY_WATER
+    blocks[...] = numpy.where(ys == heights, surface, blocks)
+    blocks[...] = numpy.where((ys < heights) & (ys >= heights - 3), topsoil, blocks)
+    blocks[ys < heights - 3] = Blocks.STONE
+
+    # A ragged bedrock floor.
+    xs, zs = numpy.mgrid[0:16, 0:16]
+    floor = (hashCoords(seed ^ 0x5bd1e995, xs + (chunkX << 4), zs + (chunkZ << 4)) % 4)[:, :, numpy.newaxis]
+    blocks[(ys == 0) | (ys <= floor) & (ys < 3)] = Blocks.BEDROCK
+
+    opacity = OPACITY[blocks]
+    skyLight = spreadLight(getDirectSkyLight(opacity), numpy.maximum(opacity, 1), (None,) * 4)
+
+    empty = numpy.zeros(NIBBLE_COUNT, numpy.uint8)
+    data = ''.join((blocks.tobytes(), empty.tobytes(), empty.tobytes(), packNibbles(skyLight.ravel()).tobytes()))
+    return True, CHUNK_SIZES, data
+
+
+# Creates chunks the world has never saved, on the server's worker pool. The
+# chunk queue asks for the chunks players are about to be sent, and players
+# ask for GENERATE_AHEAD more rows of chunks in the direction they move, up to
+# MAX_AHEAD jobs at a time, so new terrain is usually ready when it comes
+# into view. Generated chunks are marked modified so they get saved.
+class TerrainGenerator:
+    GENERATE_AHEAD = 2
+    MAX_AHEAD = 16
+
+    def __init__(self, world):
+        self.world = world
+
+        # Packed chunk key -> Deferreds waiting for that chunk.
+        self.pending = {}
+
+    def request(self, x, z):
+        # Starts generating the chunk unless that is already under way.
+        key = packKey(x, z)
+        if key in self.pending:
+            return self.pending[key]
+
+        waiters = self.pending[key] = []
+        d = self.world.server.workerPool.submit(generateChunkData, self.world.seed, x, z)
+        d.addCallbacks(self.generated, self.failed, callbackArgs=(key, x, z), errbackArgs=(key, x, z))
+        return waiters
+
+    def generate(self, x, z):
+        # Returns a Deferred firing with the chunk.
+        d = defer.Deferred()
+        self.request(x, z).append(d)
+        return d
+
+    def generateNow(self, x, z):
+        # Generates on the calling thread, for startup.
+        return self.addChunk(generateChunkData(self.world.seed, x, z), x, z)
+
+    def generateAhead(self, directionX, directionZ, visibleChunks):
+        covered = set(visibleChunks)
+        for step in xrange(1, self.GENERATE_AHEAD + 1):
+            ahead = set([(x + directionX * step, z + directionZ * step) for x, z in visibleChunks]) - covered
+            covered |= ahead
+
+            for chunkCoord in ahead:
+                if len(self.pending) >= self.MAX_AHEAD:
+                    return
+                if not self.world.hasChunk(*chunkCoord):
+                    self.request(*chunkCoord)
+
+    def addChunk(self, result, x, z):
+        world = self.world
+        chunk = world.chunks.get(x, z)
+        if chunk is None:
+            chunk = world.buildChunk('generated chunk', x, z, result)
+            chunk.modified()
+            world.lighting.relight(chunk)
+        return chunk
+
+    def generated(self, result, key, x, z):
+        chunk = self.addChunk(result, x, z)
+        for d in self.pending.pop(key):
+            d.callback(chunk)
+
+    def failed(self, failure, key, x, z):
+        print('Could not generate chunk %d %d: %s' % (x, z, failure.getErrorMessage()))
+        for d in self.pending.pop(key):
+            d.errback(failure)
@@ -1,22 +1,88 @@
+import itertools
+import math
+import multiprocessing
 import os
+import time
+from collections import OrderedDict
 
+import numpy
 from nbt.nbt import NBTFile
 
+from minecraft.util.MinecraftConstants import BLOCK_HEIGHT
 from minecraft.world.Block import Block
-from minecraft.world.Chunk import Chunk
-from pumpkinpy.Util import base36
+from minecraft.world.Chunk import BLOCK_COUNT, NIBBLE_COUNT, Chunk, getBlockIndex, getNibbles, unpackNibbles
+from minecraft.world.ChunkFile import CHUNK_SIZES, runLoadJob
+from minecraft.world.ChunkMap import ChunkMap, getRadiusOffsets, packKey
+from minecraft.world.ChunkSaver import ChunkSaver
+from minecraft.world.Lighting import LightingEngine
+from minecraft.world.TerrainGenerator import TerrainGenerator
+from minecraft.world.RegionFile import openStorage
 from pumpkinpy.networking import Packet
 
 
+# Chunks are loaded from disk the first time they are asked for. A chunk stays
+# loaded while it holds a ticket (it is in some player's view) or is one of
+# the persistent spawn chunks; otherwise it moves to an LRU of unreferenced
+# chunks capped at cacheBytes, and the least recently used ones are dropped
+# once any changes have been written back. Lookups only flag a chunk as
+# recently used, which gives it a second chance at eviction time instead of
+# reordering the LRU on every getChunk.
 class World:
-    def __init__(self, server, folder):
+    SPAWN_RADIUS = 3
+    CACHE_BYTES = 64 * 1024 * 1024
+
+    # Assumed size of a chunk's MapChunk packet when it has never been
+    # encoded, for deciding between a multi-block change and a resend.
+    PAYLOAD_SIZE_ESTIMATE = 16 * 1024
+
+    # Height of a player's collision box, and how far its feet may sink into
+    # the top of a block to allow for rounding in client positions.
+    PLAYER_HEIGHT = 1.8
+    STEP_TOLERANCE = 1.0 / 64
+
+    def __init__(self, server, folder, preload=False, loadWorkers=0, storage='auto'):
         self.server = server
         self.folder = folder
+        self.storage = None
+
+        self.seed = 0
+        self.spawn = [0, 64, 0]
+
+        self.chunks = ChunkMap()
+
+        # Packed chunk key -> number of tickets held on that chunk.
+        self.tickets = {}
+        # Packed chunk key -> (chunk, size), least recently used first.
+        self.unreferenced = OrderedDict()
+        self.unreferencedBytes = 0
+        self.cacheBytes = self.CACHE_BYTES
+        # Chunks known not to exist on disk.
+        self.missing = set()
+
+        # Chunks modified since they were last saved.
+        self.dirtyChunks = set()
+        self.saver = ChunkSaver(self)
+
+        self.lighting = LightingEngine(self)
+        self.generator = TerrainGenerator(self)
+
+        # Chunks with block changes not yet sent to their viewers, sent in
+        # the broadcasting phase of the next tick.
+        self.changedChunks = set()
+
+        self.clients = []
+
+        self.time = 0
+
+        server.ticks.register('simulation', self.tick)
+        server.ticks.register('broadcasting', self.broadcast)
 
         if not os.path.exists(folder) or not os.path.isdir(folder):
             print('The world folder is missing!')
             return
 
+        self.storage = openStorage(folder, storage)
+
         self.levelData = NBTFile(filename=os.path.join(self.folder, 'level.dat'), buffer='rb')
         self.seed = self.levelData['Data']['RandomSeed'].value
         self.spawn = [
@@ -25,136 +91,397 @@ class World:
             self.levelData['Data']['SpawnZ'].value
         ]
 
-        self.chunks = {}
-
         self.test = False
 
-        self.loadWorld()
+        if preload:
+            self.loadWorld(loadWorkers)
+        self.loadSpawnChunks()
         print 'Loaded %s chunks' % (len(self.chunks))
 
-        self.clients = []
-
-        self.time = 0
-
-        reactor.callLater(1, self.sendTime)
+        self.saver.start()
+        reactor.addSystemEventTrigger('after', 'shutdown', self.storage.close)
+
+    def loadSpawnChunks(self):
+        chunkX, chunkZ = self.getChunkCoord(self.spawn[0], self.spawn[2])
+        for x, z in self.getAllChunksInRadius(chunkX, chunkZ, self.SPAWN_RADIUS):
+            chunk = self.getChunk(x, z)
+            if chunk is None:
+                chunk = self.generator.generateNow(x, z)
+            chunk.persistent = True
+            self.reference(chunk)
+
+    def loadWorld(self, workers=0):
+        # Loads every stored chunk up front instead of on demand, parsing them
+        # on a process pool when workers > 0. Preloaded chunks are never
+        # evicted.
+        self.cacheBytes = None
+
+        jobs, total = self.storage.getLoadJobs()
+
+        pool = None
+        if workers > 0:
+            pool = multiprocessing.Pool(workers)
+            results = pool.imap_unordered(runLoadJob, jobs)
+        else:
+            results = itertools.imap(runLoadJob, jobs)
+
+        started = lastReport = time.time()
+        done = 0
+        try:
+            for jobResults in results:
+                for result in jobResults:
+                    if self.chunks.get(result[1], result[2]) is None:
+                        self.buildChunk(*result)
+                done += len(jobResults)
+
+                now = time.time()
+                if now - lastReport >= 1.0 or done >= total:
+                    lastReport = now
+                    print('Loaded %d/%d chunks (%d%%) in %.1fs' % (done, total, done * 100 / max(total, 1),
+                                                                  now - started))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def buildChunk(self, location, x, z, result):
+        if isinstance(result, basestring):
+            print("Invalid chunk: %s (%s)" % (location, result))
+            return None
+
+        terrainPopulated, sizes, data = result
+        if sizes != CHUNK_SIZES:
+            print("Invalid chunk: %s (unexpected array sizes %s)" % (location, sizes))
+            return None
+
+        # Views over the worker's string; Chunk copies them into its storage.
+        data = numpy.frombuffer(data, numpy.uint8)
+        arrays = []
+        offset = 0
+        for size in sizes:
+            arrays.append(data[offset:offset + size])
+            offset += size
+
+        chunk = Chunk(self.server, self, x, z, terrainPopulated, *arrays)
+
+        self.addChunk(chunk)
+        return chunk
 
-    def loadWorld(self):
-        for root, dirs, files in os.walk(self.folder):
-            for name in files:
-                self.handleChunkFile(root, name)
+    def saveChunk(self, chunk):
+        # Writes the chunk right away on the calling thread; ChunkSaver is the
+        # asynchronous path.
+        self.storage.writeChunk(chunk.x, chunk.z, chunk.terrainPopulated, chunk.data.tobytes(), chunk.heightMap)
+        chunk.dirty = False
+        self.dirtyChunks.discard(chunk)
 
-    def handleChunkFile(self, root, name):
-        location = os.path.join(root, name)
-        root = root.replace(self.folder, '')[1:]
+    def addChunk(self, chunk):
+        key = packKey(chunk.x, chunk.z)
+        self.chunks.add(chunk)
+        self.missing.discard(key)
 
-        dirs = root.split(os.sep)
-        if len(dirs) != 2:
-            return
+        if not chunk.persistent and key not in self.tickets:
+            self.unreference(chunk)
+            self.evict()
 
-        a, b = dirs
-
-        chunkFile = name.split('.')
-        if len(chunkFile) != 4:
-            print("Invalid chunk file: %s" % location)
+    def getChunk(self, x, z):
+        chunk = self.chunks.get(x, z)
+        if chunk is not None:
+            chunk.recentlyUsed = True
+            return chunk
+
+        key = packKey(x, z)
+        if key in self.missing or self.storage is None:
+            return None
+
+        result = self.storage.readChunk(x, z)
+        if result is None:
+            self.missing.add(key)
+            return None
+
+        return self.buildChunk(*result)
+
+    def hasChunk(self, x, z):
+        # Whether the chunk is loaded or saved, without loading it.
+        if self.chunks.get(x, z) is not None:
+            return True
+        if packKey(x, z) in self.missing or self.storage is None:
+            return False
+        return self.storage.hasChunk(x, z)
+
+    def addTicket(self, x, z):
+        key = packKey(x, z)
+        count = self.tickets.get(key, 0)
+        self.tickets[key] = count + 1
+
+        if not count:
+            chunk = self.getChunk(x, z)
+            if chunk is not None:
+                self.reference(chunk)
+
+    def removeTicket(self, x, z):
+        key = packKey(x, z)
+        count = self.tickets.get(key, 0)
+        if count > 1:
+            self.tickets[key] = count - 1
             return
+        self.tickets.pop(key, None)
 
-        if chunkFile[0] != 'c' or chunkFile[3] != 'dat':
-            print("Invalid chunk file: %s" % location)
-            return
+        chunk = self.chunks.get(x, z)
+        if chunk is not None and not chunk.persistent:
+            self.unreference(chunk)
+            self.evict()
 
-        x, z = chunkFile[1], chunkFile[2]
-        x, z = int(x, 36), int(z, 36)
-        
-        print("Loaded %s %s" % (x, z))
+    def reference(self, chunk):
+        entry = self.unreferenced.pop(packKey(chunk.x, chunk.z), None)
+        if entry is not None:
+            self.unreferencedBytes -= entry[1]
 
-        if a != base36(x & 63):
-            print("Invalid chunk file: %s" % location)
-            return
-        if b != base36(z & 63):
-            print("Invalid chunk file: %s" % location)
+    def unreference(self, chunk):
+        key = packKey(chunk.x, chunk.z)
+        if key in self.unreferenced:
             return
 
-        nbt = NBTFile(filename=location, buffer='rb')
+        size = chunk.getMemorySize()
+        chunk.recentlyUsed = False
+        self.unreferenced[key] = (chunk, size)
+        self.unreferencedBytes += size
 
-        if x != nbt['Level']['xPos'].value:
-            print("Invalid chunk file: %s" % location)
+    def evict(self):
+        if self.cacheBytes is None or self.unreferencedBytes <= self.cacheBytes:
             return
 
-        if z != nbt['Level']['zPos'].value:
-            print("Invalid chunk file: %s" % location)
-            return
+        for key in self.unreferenced.keys():
+            if self.unreferencedBytes <= self.cacheBytes:
+                break
 
-        chunk = Chunk(
-            self.server,
-            self,
-            x, z,
-            nbt['Level']['TerrainPopulated'].value,
-            nbt['Level']['Blocks'].value,
-            nbt['Level']['Data'].value,
-            nbt['Level']['BlockLight'].value,
-            nbt['Level']['SkyLight'].value
-        )
+            chunk, size = self.unreferenced[key]
+            if chunk.recentlyUsed:
+                chunk.recentlyUsed = False
+                self.unreferenced[key] = self.unreferenced.pop(key)
+                continue
 
-        self.chunks[(chunkFile[1], chunkFile[2])] = chunk
+            # Dirty chunks stay until the saver has written them; it calls
+            # evict again once a write completes.
+            if self.storage is not None and (chunk.dirty or self.saver.isSaving(chunk)):
+                self.saver.save(chunk)
+                continue
 
-    def getChunk(self, x, z):
-        a, b = base36(x), base36(z)
-        chunk = self.chunks.get((a, b))
-        if not chunk:
-            print('No chunk %d %d %s %s' % (x, z, a, b))
-            print(self.chunks.keys())
-        return chunk
+            del self.unreferenced[key]
+            self.unreferencedBytes -= size
+            self.chunks.remove(chunk.x, chunk.z)
 
     def getChunkCoord(self, x, z):
         return int(x) >> 4, int(z) >> 4
 
     def getAllChunksInRadius(self, centerX, centerZ, radius):
-        chunks = []
+        return [(centerX + dX, centerZ + dZ) for dX, dZ in getRadiusOffsets(radius)]
 
-        for x in xrange(centerX - radius, centerX + radius):
-            for z in xrange(centerZ - radius, centerZ + radius):
-                chunks.append((x, z))
+    def getChunksInRadius(self, centerX, centerZ, radius):
+        # Like getAllChunksInRadius, but yields the loaded chunks themselves.
+        return self.chunks.inRadius(centerX, centerZ, radius)
 
-        return chunks
+    def tick(self, tick):
+        self.time = (self.time + 1) % 24000
 
-    def sendTime(self):
-        packet = Packet.TimeUpdatePacket('')
-        packet.writePacket(self.time)
-
-        for c in self.clients:
-            c.send(packet)
-
-        self.time += 20
+    def broadcast(self, tick):
+        if self.changedChunks:
+            self.flushBlockChanges()
 
-        if self.time > 24000:
-            self.time = 0
+        # Clients keep the clock running themselves; once a second corrects
+        # any drift.
+        if not tick % self.server.ticks.TICKS_PER_SECOND:
+            self.sendTime()
 
-        reactor.callLater(1, self.sendTime)
+    def sendTime(self):
+        packet = Packet.TimeUpdatePacket.encode(self.time)
+        self.server.broadcastManager.toWorld(packet)
 
     def getBlockAt(self, x, y, z):
-        chunkX = x >> 4
-        chunkZ = z >> 4
-
-        relX = x & 15
-        relZ = z & 15
+        chunk = self.getChunk(x >> 4, z >> 4)
 
-        chunk = self.getChunk(chunkX, chunkZ)
+        index = getBlockIndex(x & 15, y, z & 15)
 
-        index = y + (relZ * 128 + (relX * 128 * 16))
+        # item() reads straight into Python ints, skipping NumPy scalars.
+        data = chunk.data
+        dataIndex = BLOCK_COUNT + (index >> 1)
+        shift = (index & 1) << 2
 
-        blockId = chunk.blocks[index]
-
-        dataIndex = index / 2
-
-        msb = index % 2
-
-        if msb:
-            blockLight = chunk.blockLight[dataIndex] >> 4
-            blockMeta = chunk.blockMeta[dataIndex] >> 4
-            skyLight = chunk.skyLight[dataIndex] >> 4
-        else:
-            blockLight = chunk.blockLight[dataIndex] & 15
-            blockMeta = chunk.blockMeta[dataIndex] & 15
-            skyLight = chunk.skyLight[dataIndex] & 15
+        blockId = data.item(index)
+        blockMeta = data.item(dataIndex) >> shift & 15
+        blockLight = data.item(dataIndex + NIBBLE_COUNT) >> shift & 15
+        skyLight = data.item(dataIndex + NIBBLE_COUNT * 2) >> shift & 15
 
         return Block(x, y, z, blockId, blockMeta, blockLight, skyLight)
+
+    def getHeightAt(self, x, z):
+        # The y right above the highest block that is not fully transparent,
+        # from the chunk's heightmap, or None if the chunk does not exist.
+        chunk = self.getChunk(x >> 4, z >> 4)
+        if chunk is None:
+            return None
+        return chunk.heightMap.item(x & 15, z & 15)
+
+    def getSpawnPoint(self):
+        # The spawn column, standing on its ground.
+        x, y, z = self.spawn
+        height = self.getHeightAt(x, z)
+        return [x, y if height is None else height, z]
+
+    def canStandAt(self, x, y, z):
+        # Whether a player standing in block column x, z with feet at height
+        # y is clear of every block's collision box. Chunks that are not
+        # loaded do not block.
+        chunk = self.chunks.get(x >> 4, z >> 4)
+        if chunk is None or y >= 128:
+            return True
+        if y < 0:
+            return False
+
+        base = ((x & 15) << 4 | z & 15) << 7
+        blocks = chunk.blocks
+        bottom = y + self.STEP_TOLERANCE
+        top = y + self.PLAYER_HEIGHT
+
+        # Starts a block below the feet for blocks taller than one, fences.
+        for blockY in xrange(max(int(bottom) - 1, 0), min(int(math.ceil(top)), 128)):
+            height = BLOCK_HEIGHT[blocks.item(base | blockY)]
+            if height and blockY + height > bottom:
+                return False
+        return True
+
+    def setBlockAt(self, x, y, z, blockId, meta=0):
+        # Returns whether the block changed. Changes reach clients in one batch
+        # per chunk on the next tick.
+        if not 0 <= y < 128:
+            return False
+
+        chunk = self.getChunk(x >> 4, z >> 4)
+        if chunk is None:
+            return False
+
+        return chunk.setBlock(getBlockIndex(x & 15, y, z & 15), blockId, meta)
+
+    def chunkChanged(self, chunk):
+        self.changedChunks.add(chunk)
+
+    def flushBlockChanges(self):
+        changedChunks, self.changedChunks = self.changedChunks, set()
+        for chunk in changedChunks:
+            changedBlocks, chunk.changedBlocks = chunk.changedBlocks, set()
+            changedAll, chunk.changedAll = chunk.changedAll, False
+
+            clients = [player.client for player in chunk.viewers]
+            if not clients:
+                continue
+
+            # Whichever of one BlockChange (12 bytes), one MultiBlockChange
+            # (11 + 4n bytes) or the whole chunk is smallest.
+            count = len(changedBlocks)
+            payloadSize = chunk.lastPayloadSize or self.PAYLOAD_SIZE_ESTIMATE
+            if changedAll or 11 + 4 * count >= payloadSize:
+                d = chunk.loadPayload()
+                d.addCallback(self.resendChunk, chunk, clients)
+                continue
+
+            if count == 1:
+                index = changedBlocks.pop()
+                x = (chunk.x << 4) + (index >> 11)
+                z = (chunk.z << 4) + (index >> 7 & 15)
+                packet = Packet.BlockChangePacket.encode(x, index & 127, z, chunk.blocks.item(index),
+                                                         int(getNibbles(chunk.blockMeta, index)))
+            else:
+                indices = numpy.fromiter(changedBlocks, numpy.int32, count)
+                coords = (indices >> 11) << 12 | (indices >> 7 & 15) << 8 | (indices & 127)
+                packet = Packet.MultiBlockChangePacket.encode(chunk.x, chunk.z, coords.astype('>u2').tobytes(),
+                                                              chunk.blocks[indices].tobytes(),
+                                                              getNibbles(chunk.blockMeta, indices).tobytes())
+
+            self.server.broadcastManager.toClients(packet, clients)
+
+    def resendChunk(self, payload, chunk, clients):
+        # Only to clients that still have the chunk.
+        clients = [client for client in clients if client.player in chunk.viewers]
+        self.server.broadcastManager.toClients(payload, clients)
+
+    def getBoxChunks(self, minX, minZ, maxX, maxZ, load=True):
+        # Splits the half-open box [minX, maxX) x [minZ, maxZ) along chunk
+        # borders. Yields (chunk, chunk-relative x slice, z slice, box-relative
+        # x slice, z slice); chunk is None where no chunk exists, or without
+        # load where it is not loaded.
+        getChunk = self.getChunk if load else self.chunks.get
+        for chunkX in xrange(minX >> 4, ((maxX - 1) >> 4) + 1):
+            startX = max(minX, chunkX << 4)
+            endX = min(maxX, (chunkX + 1) << 4)
+
+            for chunkZ in xrange(minZ >> 4, ((maxZ - 1) >> 4) + 1):
+                startZ = max(minZ, chunkZ << 4)
+                endZ = min(maxZ, (chunkZ + 1) << 4)
+
+                yield (getChunk(chunkX, chunkZ),
+                       slice(startX & 15, ((endX - 1) & 15) + 1), slice(startZ & 15, ((endZ - 1) & 15) + 1),
+                       slice(startX - minX, endX - minX), slice(startZ - minZ, endZ - minZ))
+
+    def getBox(self, minX, minY, minZ, maxX, maxY, maxZ, light=True):
+        # Reads the half-open box into [x, z, y] uint8 arrays of block IDs,
+        # metadata and, with light, block light and sky light. Blocks in
+        # missing chunks read as zero.
+        minY = max(minY, 0)
+        maxY = min(maxY, 128)
+        shape = (max(maxX - minX, 0), max(maxZ - minZ, 0), max(maxY - minY, 0))
+
+        layers = 4 if light else 2
+        arrays = [numpy.zeros(shape, numpy.uint8) for i in xrange(layers)]
+        if not all(shape):
+            return arrays
+
+        for chunk, chunkXs, chunkZs, boxXs, boxZs in self.getBoxChunks(minX, minZ, maxX, maxZ):
+            if chunk is None:
+                continue
+
+            sources = (chunk.blockGrid, unpackNibbles(chunk.blockMeta))
+            if light:
+                sources += (unpackNibbles(chunk.blockLight), unpackNibbles(chunk.skyLight))
+
+            for array, source in zip(arrays, sources):
+                array[boxXs, boxZs] = source.reshape(16, 16, 128)[chunkXs, chunkZs, minY:maxY]
+
+        return arrays
+
+    def fillBox(self, minX, minY, minZ, maxX, maxY, maxZ, blockId, meta=0, replace=None):
+        # Sets every block in the half-open box, or only those with the ID
+        # replace, and returns how many blocks changed.
+        minY = max(minY, 0)
+        maxY = min(maxY, 128)
+        if minX >= maxX or minY >= maxY or minZ >= maxZ:
+            return 0
+
+        changed = 0
+        for chunk, chunkXs, chunkZs, boxXs, boxZs in self.getBoxChunks(minX, minZ, maxX, maxZ):
+            if chunk is None:
+                continue
+
+            xs, zs, ys = numpy.mgrid[chunkXs, chunkZs, minY:maxY]
+            indices = getBlockIndex(xs, ys, zs).ravel()
+            if replace is not None:
+                indices = indices[chunk.blocks[indices] == replace]
+
+            if len(indices):
+                changed += chunk.setBlocks(indices, blockId, meta)
+
+        return changed
+
+    def findBlocks(self, blockId, centerX, centerY, centerZ, radius):
+        # Returns an (n, 3) array of the x, y, z of every block with the given
+        # ID within radius of the center.
+        minX, minY, minZ = centerX - radius, centerY - radius, centerZ - radius
+        blockIds = self.getBox(minX, minY, minZ, centerX + radius + 1, centerY + radius + 1, centerZ + radius + 1,
+                               light=False)[0]
+
+        minY = max(minY, 0)
+        xs, zs, ys = numpy.ogrid[minX:minX + blockIds.shape[0], minZ:minZ + blockIds.shape[1],
+                                 minY:minY + blockIds.shape[2]]
+        mask = blockIds == blockId
+        mask &= (xs - centerX) ** 2 + (ys - centerY) ** 2 + (zs - centerZ) ** 2 <= radius * radius
+
+        x, z, y = numpy.nonzero(mask)
+        return numpy.column_stack((x + minX, y + minY, z + minZ))
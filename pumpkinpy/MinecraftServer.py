@@ -4,26 +4,48 @@ from twisted.internet import reactor
 
 __builtin__.reactor = reactor
 
-from pumpkinpy.networking.MinecraftProtocol import MinecraftFactory
+from pumpkinpy.networking.MinecraftProtocol import MinecraftFactory, MinecraftProtocol
+from pumpkinpy.networking.BroadcastManager import BroadcastManager
+from pumpkinpy.TickScheduler import TickScheduler
+from pumpkinpy.WorkerPool import WorkerPool
+from pumpkinpy.metrics.Metrics import Metrics
 from pumpkinpy.chat.ChatManager import ChatManager
+from minecraft.world.ChunkSaver import ChunkSaver
 from minecraft.world.World import World
 
 
 class MinecraftServer:
 
-    def __init__(self, worldDirectory):
+    def __init__(self, worldDirectory, workerThreads=4, workerProcesses=0, preload=False, loadWorkers=0,
+                 storage='auto'):
         self.factory = MinecraftFactory()
         self.factory.server = self
 
-        self.world = World(self, worldDirectory)
+        self.metrics = Metrics()
+        self.workerPool = WorkerPool(threads=workerThreads, processes=workerProcesses)
+        self.broadcastManager = BroadcastManager(self)
+        self.ticks = TickScheduler(self)
+
+        self.world = World(self, worldDirectory, preload=preload, loadWorkers=loadWorkers, storage=storage)
         self.chatManager = ChatManager(self)
 
         self.nextEID = 100
         self.id2entity = {}
 
-    def start(self, port):
+    def start(self, port, statsPort=0):
         print('Listening on port %d...' % port)
         reactor.listenTCP(port, self.factory)
+        self.ticks.start()
+
+        if statsPort:
+            from twisted.web.server import Site
+            from pumpkinpy.metrics.StatsResource import StatsResource
+
+            # Only reachable from this machine; /stats is JSON, /metrics is
+            # Prometheus text.
+            print('Serving stats on http://127.0.0.1:%d/stats' % statsPort)
+            reactor.listenTCP(statsPort, Site(StatsResource(self)), interface='127.0.0.1')
+
         reactor.run()
 
     def allocateEntityId(self):
@@ -34,13 +56,36 @@ class MinecraftServer:
 
 if __name__ == '__main__':        
     import argparse
+    import multiprocessing
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--port', default=25565, type=int, help='The port for the server to listen on.')
     parser.add_argument('--world-directory', default='World1', help='The directory name of the main world.')
+    parser.add_argument('--max-flush-delay', default=MinecraftProtocol.MAX_FLUSH_DELAY, type=float,
+                        help='The longest time in seconds outbound packets are held back to be coalesced.')
+    parser.add_argument('--worker-threads', default=4, type=int,
+                        help='The number of threads used for chunk compression and other background work.')
+    parser.add_argument('--worker-processes', default=0, type=int,
+                        help='Run background work on this many processes instead of threads.')
+    parser.add_argument('--preload', action='store_true',
+                        help='Load the whole world at startup instead of loading chunks on demand.')
+    parser.add_argument('--load-workers', default=multiprocessing.cpu_count(), type=int,
+                        help='The number of processes used to parse chunk files with --preload, 0 for none.')
+    parser.add_argument('--storage', default='auto', choices=('auto', 'chunks', 'region'),
+                        help='Save chunks as one file per chunk or in region files; auto uses region files if the '
+                             'world has any. Chunk files stay readable either way.')
+    parser.add_argument('--autosave-interval', default=ChunkSaver.AUTOSAVE_INTERVAL, type=float,
+                        help='Seconds between saves of modified chunks, 0 to only save on shutdown.')
+    parser.add_argument('--stats-port', default=0, type=int,
+                        help='Serve protocol metrics on this local port, 0 to disable.')
     args = parser.parse_args()
 
-    server = MinecraftServer(args.world_directory)
-    server.start(args.port)
+    MinecraftProtocol.MAX_FLUSH_DELAY = args.max_flush_delay
+    ChunkSaver.AUTOSAVE_INTERVAL = args.autosave_interval
+
+    server = MinecraftServer(args.world_directory, workerThreads=args.worker_threads,
+                             workerProcesses=args.worker_processes, preload=args.preload,
+                             loadWorkers=args.load_workers, storage=args.storage)
+    server.start(args.port, statsPort=args.stats_port)
 
 
@@ -0,0 +1,102 @@
+import time
+import traceback
+from collections import deque
+
+
+PHASES = ('input', 'simulation', 'lighting', 'broadcasting', 'saving')
+
+
+# Runs the game loop at a fixed TICKS_PER_SECOND. Every tick calls the
+# handlers registered for each phase, phase by phase in PHASES order. Ticks
+# are scheduled against an absolute timeline, so they do not drift. After an
+# overrun the missed ticks run back to back, one per reactor turn so network
+# input still gets in between, until the loop is more than MAX_CATCH_UP ticks
+# behind; past that the backlog is skipped. Subsystems keep to a fixed budget
+# of work per tick, so a tick costs about the same however much is queued.
+class TickScheduler:
+    TICKS_PER_SECOND = 20
+    MAX_CATCH_UP = 10
+
+    # Ticks TPS and MSPT are averaged over.
+    WINDOW = 100
+
+    def __init__(self, server):
+        self.server = server
+        self.interval = 1.0 / self.TICKS_PER_SECOND
+
+        # Phase -> handlers, each called with the tick number.
+        self.handlers = dict((phase, []) for phase in PHASES)
+
+        self.tick = 0
+        self.skipped = 0
+        self.nextTick = None
+        self.tickCall = None
+
+        self.starts = deque(maxlen=self.WINDOW)
+        self.durations = deque(maxlen=self.WINDOW)
+
+    def register(self, phase, handler):
+        self.handlers[phase].append(handler)
+
+    def unregister(self, phase, handler):
+        if handler in self.handlers[phase]:
+            self.handlers[phase].remove(handler)
+
+    def start(self):
+        self.nextTick = time.time()
+        self.schedule()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.tickCall is not None and self.tickCall.active():
+            self.tickCall.cancel()
+        self.tickCall = None
+
+    def schedule(self):
+        self.tickCall = reactor.callLater(max(0, self.nextTick - time.time()), self.run)
+
+    def run(self):
+        self.tickCall = None
+
+        started = time.time()
+        behind = int((started - self.nextTick) / self.interval)
+        if behind > self.MAX_CATCH_UP:
+            skipped = behind - self.MAX_CATCH_UP
+            print("Can't keep up! Skipping %d ticks" % skipped)
+            self.skipped += skipped
+            self.nextTick += skipped * self.interval
+
+        self.runTick()
+
+        finished = time.time()
+        self.starts.append(started)
+        self.durations.append(finished - started)
+        self.server.metrics.tickTime.observe(finished - started)
+
+        self.tick += 1
+        self.nextTick += self.interval
+        self.schedule()
+
+    def runTick(self):
+        tick = self.tick
+        for phase in PHASES:
+            # Handlers may unregister themselves.
+            for handler in tuple(self.handlers[phase]):
+                try:
+                    handler(tick)
+                except Exception:
+                    print('Error in %s tick handler:' % phase)
+                    traceback.print_exc()
+
+    def getTPS(self):
+        if len(self.starts) < 2:
+            return float(self.TICKS_PER_SECOND)
+        # Counting the time since the last tick started shows a stall while
+        # it is still going on.
+        elapsed = max(time.time(), self.starts[-1] + self.interval) - self.starts[0]
+        return min(len(self.starts) / elapsed, float(self.TICKS_PER_SECOND))
+
+    def getMSPT(self):
+        if not self.durations:
+            return 0.0
+        return sum(self.durations) / len(self.durations) * 1000
@@ -0,0 +1,74 @@
+import multiprocessing
+import signal
+import traceback
+
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+
+def runCatching(func, args, kwargs):
+    # Process pool jobs report errors as values, since multiprocessing's
+    # callbacks cannot carry exceptions back to the reactor.
+    try:
+        return True, func(*args, **kwargs)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def ignoreSignals():
+    # Ctrl-C and service managers signal the whole process group. Workers
+    # leave shutdown to the server, which closes the pool once the reactor
+    # stops; a worker dying mid-job can otherwise hang the pool's join.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+class WorkerError(Exception):
+    pass
+
+
+# Runs CPU-heavy jobs (chunk compression, parsing, generation) off the reactor
+# thread and delivers their results back on it as Deferreds. Jobs run on a
+# bounded thread pool, which suits work that releases the GIL such as zlib;
+# with processes > 0 they run on a process pool instead, in which case the
+# job and its arguments must be picklable.
+class WorkerPool:
+    def __init__(self, threads=4, processes=0):
+        self.threadPool = ThreadPool(minthreads=1, maxthreads=threads, name='WorkerPool')
+        self.processPool = None
+        if processes > 0:
+            self.processPool = multiprocessing.Pool(processes, initializer=ignoreSignals)
+
+        reactor.callWhenRunning(self.threadPool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def submit(self, func, *args, **kwargs):
+        if self.processPool is None:
+            return threads.deferToThreadPool(reactor, self.threadPool, func, *args, **kwargs)
+
+        d = defer.Deferred()
+
+        def finished(result):
+            reactor.callFromThread(self.deliver, d, result)
+
+        self.processPool.apply_async(runCatching, (func, args, kwargs), callback=finished)
+        return d
+
+    def submitThread(self, func, *args, **kwargs):
+        # Always runs on the thread pool, for jobs such as file writes that
+        # need state shared with the server process.
+        return threads.deferToThreadPool(reactor, self.threadPool, func, *args, **kwargs)
+
+    def deliver(self, d, result):
+        ok, value = result
+        if ok:
+            d.callback(value)
+        else:
+            d.errback(WorkerError(value))
+
+    def stop(self):
+        self.threadPool.stop()
+        if self.processPool is not None:
+            self.processPool.close()
+            self.processPool.join()
+            self.processPool = None
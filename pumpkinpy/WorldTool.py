@@ -0,0 +1,336 @@
+import multiprocessing
+import os
+import time
+
+import numpy
+from nbt.nbt import NBTFile
+
+from minecraft.world.Chunk import BLOCK_COUNT, NIBBLE_COUNT, packNibbles, unpackNibbles
+from minecraft.world.ChunkFile import CHUNK_SIZES, ChunkFileStorage
+from minecraft.world.ChunkMap import REGION_SHIFT, getRadiusOffsets
+from minecraft.world.HeightMap import getHeightMap
+from minecraft.world.Lighting import (BLOCK_LIGHT, EMISSION, OPACITY, SIDES, SKY_LIGHT, getBorder, getDirectSkyLight,
+                                      spreadLight)
+from minecraft.world.RegionFile import RegionStorage, compactRegionFile, openStorage
+from minecraft.world.TerrainGenerator import generateChunkData
+
+
+# Offline maintenance of a world folder while the server is not running. Work
+# is split into one job per 32x32 chunk region and spread over a process pool;
+# a job is the only writer of its region, and reads chunks outside it through
+# a read-only storage.
+
+def runJob(job):
+    return job[0](*job[1:])
+
+
+def groupByRegion(chunkCoords):
+    regions = {}
+    for x, z in chunkCoords:
+        regions.setdefault((x >> REGION_SHIFT, z >> REGION_SHIFT), []).append((x, z))
+    return regions.values()
+
+
+def readChunkData(storage, x, z):
+    # (terrainPopulated, writable data array) of a saved chunk, or None.
+    result = storage.readChunk(x, z)
+    if result is None:
+        return None
+
+    result = result[3]
+    if isinstance(result, basestring) or result[1] != CHUNK_SIZES:
+        print('Skipping invalid chunk %d %d' % (x, z))
+        return None
+    return result[0], numpy.frombuffer(result[2], numpy.uint8).copy()
+
+
+def lightChunks(chunks, reader):
+    # Lights chunks (coordinates -> data array) from scratch. Light crosses
+    # between them and comes in from the saved chunks around them. Each pass
+    # relights the chunks next to one that changed in the pass before.
+    decays = {}
+    sources = {}
+    for chunkCoord, data in chunks.iteritems():
+        grid = data[:BLOCK_COUNT].reshape(16, 16, 128)
+        opacity = OPACITY[grid]
+        decays[chunkCoord] = numpy.maximum(opacity, 1)
+        sources[chunkCoord] = getDirectSkyLight(opacity), EMISSION[grid]
+
+    outside = {}
+
+    def getOutsideLight(chunkCoord, layer):
+        key = chunkCoord, layer
+        if key not in outside:
+            loaded = readChunkData(reader, *chunkCoord)
+            if loaded is None:
+                outside[key] = None
+            else:
+                outside[key] = unpackNibbles(loaded[1][layer:layer + NIBBLE_COUNT]).reshape(16, 16, 128)
+        return outside[key]
+
+    for sourceIndex, layer in enumerate((SKY_LIGHT, BLOCK_LIGHT)):
+        light = dict((chunkCoord, source[sourceIndex]) for chunkCoord, source in sources.iteritems())
+
+        todo = set(chunks)
+        while todo:
+            changed = set()
+            for x, z in todo:
+                edges = []
+                for dX, dZ in SIDES:
+                    neighborCoord = x + dX, z + dZ
+                    if neighborCoord in light:
+                        neighborLight = light[neighborCoord]
+                    else:
+                        neighborLight = getOutsideLight(neighborCoord, layer)
+                    edges.append(None if neighborLight is None else getBorder(neighborLight, -dX, -dZ))
+
+                result = spreadLight(light[(x, z)], decays[(x, z)], edges)
+                if (result != light[(x, z)]).any():
+                    light[(x, z)] = result.copy()
+                    changed.add((x, z))
+
+            todo = set()
+            for x, z in changed:
+                for dX, dZ in SIDES:
+                    if (x + dX, z + dZ) in light:
+                        todo.add((x + dX, z + dZ))
+
+        for chunkCoord, data in chunks.iteritems():
+            data[layer:layer + NIBBLE_COUNT] = packNibbles(light[chunkCoord].ravel())
+
+
+def writeChunks(storage, chunks, terrainPopulated):
+    for (x, z), data in chunks.iteritems():
+        heightMap = getHeightMap(data[:BLOCK_COUNT].reshape(16, 16, 128))
+        storage.writeChunk(x, z, terrainPopulated[(x, z)], data, heightMap)
+
+
+def pregenRegion(folder, kind, seed, chunkCoords):
+    storage = openStorage(folder, kind)
+    reader = openStorage(folder, kind, readOnly=True)
+    try:
+        chunks = {}
+        for x, z in chunkCoords:
+            if not storage.hasChunk(x, z):
+                chunks[(x, z)] = numpy.frombuffer(generateChunkData(seed, x, z)[2], numpy.uint8).copy()
+
+        lightChunks(chunks, reader)
+        writeChunks(storage, chunks, dict.fromkeys(chunks, True))
+        return len(chunks)
+    finally:
+        storage.close()
+        reader.close()
+
+
+def relightRegion(folder, kind, chunkCoords):
+    storage = openStorage(folder, kind)
+    reader = openStorage(folder, kind, readOnly=True)
+    try:
+        chunks = {}
+        terrainPopulated = {}
+        for x, z in chunkCoords:
+            loaded = readChunkData(storage, x, z)
+            if loaded is not None:
+                terrainPopulated[(x, z)], chunks[(x, z)] = loaded
+
+        lightChunks(chunks, reader)
+        writeChunks(storage, chunks, terrainPopulated)
+        return len(chunks)
+    finally:
+        storage.close()
+        reader.close()
+
+
+def convertRegion(folder, target, chunkCoords):
+    # Copies whole chunk trees, entities and all.
+    if target == 'region':
+        source = ChunkFileStorage(folder)
+        destination = RegionStorage(folder)
+    else:
+        source = RegionStorage(folder, readOnly=True)
+        destination = ChunkFileStorage(folder)
+
+    try:
+        copied = 0
+        for x, z in chunkCoords:
+            if target == 'region' and destination.hasRegionChunk(x, z):
+                # Saved into the region after the chunk file was written.
+                continue
+            nbt = source.readNBT(x, z)
+            if nbt is not None:
+                destination.writeNBT(x, z, nbt)
+                copied += 1
+        return copied
+    finally:
+        source.close()
+        destination.close()
+
+
+def runJobs(jobs, workers, action):
+    # Returns the sum of the job results.
+    pool = None
+    if workers > 0:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(runJob, jobs)
+    else:
+        results = (runJob(job) for job in jobs)
+
+    total = 0
+    started = lastReport = time.time()
+    try:
+        for done, result in enumerate(results, 1):
+            total += result
+
+            now = time.time()
+            if now - lastReport >= 1.0 or done == len(jobs):
+                lastReport = now
+                print('%s: %d/%d regions, %d chunks in %.1fs' % (action, done, len(jobs), total, now - started))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return total
+
+
+def getKind(storage):
+    return 'region' if isinstance(storage, RegionStorage) else 'chunks'
+
+
+def removeEmptyDirectories(folder):
+    for root, dirs, files in os.walk(folder, topdown=False):
+        if root != folder and not os.listdir(root):
+            os.rmdir(root)
+
+
+def pregen(args):
+    levelData = NBTFile(filename=os.path.join(args.world_directory, 'level.dat'), buffer='rb')
+    seed = levelData['Data']['RandomSeed'].value
+    if args.center is None:
+        centerX = levelData['Data']['SpawnX'].value >> 4
+        centerZ = levelData['Data']['SpawnZ'].value >> 4
+    else:
+        centerX, centerZ = args.center
+
+    storage = openStorage(args.world_directory, args.storage, readOnly=True)
+    kind = getKind(storage)
+    storage.close()
+
+    chunkCoords = [(centerX + dX, centerZ + dZ) for dX, dZ in getRadiusOffsets(args.radius)]
+    jobs = [(pregenRegion, args.world_directory, kind, seed, region) for region in groupByRegion(chunkCoords)]
+    runJobs(jobs, args.workers, 'Generated')
+
+
+def relight(args):
+    storage = openStorage(args.world_directory, args.storage, readOnly=True)
+    kind = getKind(storage)
+    chunkCoords = storage.listChunks()
+    storage.close()
+
+    jobs = [(relightRegion, args.world_directory, kind, region) for region in groupByRegion(chunkCoords)]
+    runJobs(jobs, args.workers, 'Relit')
+
+
+def convert(args):
+    folder = args.world_directory
+    chunkFiles = ChunkFileStorage(folder)
+
+    if args.to == 'region':
+        chunkCoords = chunkFiles.listChunks()
+    else:
+        # Chunks in both layouts are newer in their region.
+        regions = RegionStorage(folder, readOnly=True)
+        chunkCoords = regions.listChunks()
+        regions.close()
+
+    jobs = [(convertRegion, folder, args.to, region) for region in groupByRegion(chunkCoords)]
+    runJobs(jobs, args.workers, 'Converted')
+
+    if args.keep:
+        return
+
+    # Old files only go once their chunks are confirmed in the new layout.
+    regions = RegionStorage(folder, readOnly=True)
+    obsolete = []
+    try:
+        if args.to == 'region':
+            for location, x, z in chunkFiles.listChunkFiles():
+                if regions.hasRegionChunk(x, z):
+                    obsolete.append(location)
+                else:
+                    print('Keeping %s, its chunk is not in a region file' % location)
+        else:
+            for location, regionX, regionZ in regions.listRegionFiles():
+                region = regions.getRegion(regionX, regionZ)
+                if region is None:
+                    print('Keeping %s, it could not be read' % location)
+                    continue
+                missing = [chunkCoord for chunkCoord in region.getChunkCoords(regionX, regionZ)
+                           if not chunkFiles.hasChunk(*chunkCoord)]
+                if missing:
+                    print('Keeping %s, %d of its chunks were not converted' % (location, len(missing)))
+                else:
+                    obsolete.append(location)
+    finally:
+        regions.close()
+
+    for location in obsolete:
+        os.remove(location)
+    removeEmptyDirectories(folder)
+
+
+def compact(args):
+    folder = args.world_directory
+    regions = RegionStorage(folder, readOnly=True)
+    locations = [(compactRegionFile, location) for location, regionX, regionZ in regions.listRegionFiles()]
+
+    pool = multiprocessing.Pool(args.workers) if args.workers > 0 else None
+    results = pool.map(runJob, locations) if pool is not None else map(runJob, locations)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    before = sum(result[0] for result in results)
+    after = sum(result[1] for result in results)
+    print('Compacted %d region files from %d to %d KiB' % (len(results), before / 1024, after / 1024))
+
+    # Leftovers of interrupted chunk file writes.
+    removed = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(root, name))
+                removed += 1
+    if removed:
+        print('Removed %d unfinished chunk files' % removed)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Prepares a world folder while the server is not running.')
+    parser.add_argument('--world-directory', default='World1', help='The world to work on.')
+    parser.add_argument('--storage', default='auto', choices=('auto', 'chunks', 'region'),
+                        help='The chunk layout to read and write; auto uses region files if the world has any.')
+    parser.add_argument('--workers', default=multiprocessing.cpu_count(), type=int,
+                        help='The number of processes to spread the work over, 0 for none.')
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser('pregen', help='Generate every missing chunk within a radius.')
+    command.add_argument('--radius', default=16, type=int, help='The radius in chunks.')
+    command.add_argument('--center', nargs=2, type=int, metavar=('X', 'Z'),
+                         help='The center chunk, the spawn chunk by default.')
+    command.set_defaults(func=pregen)
+
+    command = commands.add_parser('convert', help='Move every chunk into the other layout.')
+    command.add_argument('--to', required=True, choices=('chunks', 'region'), help='The layout to convert to.')
+    command.add_argument('--keep', action='store_true', help='Keep the files of the old layout.')
+    command.set_defaults(func=convert)
+
+    command = commands.add_parser('relight', help='Recompute the light and height maps of every chunk.')
+    command.set_defaults(func=relight)
+
+    command = commands.add_parser('compact', help='Repack region files and clear out unfinished writes.')
+    command.set_defaults(func=compact)
+
+    args = parser.parse_args()
+    args.func(args)
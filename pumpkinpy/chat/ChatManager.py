@@ -1,4 +1,5 @@
 from pumpkinpy.networking import Packet
+from pumpkinpy.networking.MinecraftProtocol import MinecraftProtocol, PLAY_GAME
 
 CHAT_FORMATTING = '<%s> %s'
 COLOR_ESCAPE_CHARACTER = unichr(0x00A7)
@@ -8,9 +9,10 @@ class ChatManager:
     def __init__(self, server):
         self.server = server
 
+        MinecraftProtocol.registerHandler(PLAY_GAME, Packet.ChatMessagePacket, self.handleChatMessage)
+
     def handleChatMessage(self, client, message):
-        packet = Packet.ChatMessagePacket('')
-        packet.writePacket(CHAT_FORMATTING % (client.username, message))
+        packet = Packet.ChatMessagePacket.encode(CHAT_FORMATTING % (client.username, message))
 
         client.send(packet)
 
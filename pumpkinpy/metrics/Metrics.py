@@ -0,0 +1,204 @@
+import bisect
+import time
+
+from pumpkinpy.networking import Packet
+
+
+# Upper bounds in seconds, doubling from 1us to about half a second.
+HISTOGRAM_BUCKETS = tuple(1e-6 * 2 ** i for i in xrange(20))
+
+
+class Histogram:
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def cumulative(self):
+        # (upper bound, observations <= bound) pairs, ending with +Inf.
+        result = []
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            running += count
+            result.append((bound, running))
+        return result
+
+    def toDict(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'buckets': [[bound, count] for bound, count in self.cumulative()[:-1]],
+        }
+
+
+class PacketMetrics:
+    def __init__(self):
+        # Indexed by packet ID so the hot path is a list index, not a lookup.
+        self.counts = [0] * 256
+        self.bytes = [0] * 256
+        self.decodeTime = {}
+        self.handleTime = {}
+
+    def observe(self, packetId, decodeTime, handleTime):
+        histogram = self.decodeTime.get(packetId)
+        if histogram is None:
+            histogram = self.decodeTime[packetId] = Histogram()
+            self.handleTime[packetId] = Histogram()
+        histogram.observe(decodeTime)
+        self.handleTime[packetId].observe(handleTime)
+
+    def toDict(self):
+        packets = {}
+        for packetId, count in enumerate(self.counts):
+            if not count:
+                continue
+            entry = {
+                'id': packetId,
+                'count': count,
+                'bytes': self.bytes[packetId],
+            }
+            if packetId in self.decodeTime:
+                entry['decodeTime'] = self.decodeTime[packetId].toDict()
+                entry['handleTime'] = self.handleTime[packetId].toDict()
+            packets[packetName(packetId)] = entry
+        return packets
+
+
+def packetName(packetId):
+    packetClass = Packet.PACKETS_BY_ID.get(packetId)
+    if packetClass is None:
+        return hex(packetId)
+    return packetClass.__name__
+
+
+def clientName(client):
+    # Usernames are whatever bytes the client sent.
+    return (client.username or '').decode('utf-8', 'replace')
+
+
+def escapeLabel(value):
+    # Label values as the Prometheus text format wants them.
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def connectionBacklog(client):
+    # Bytes queued on our side plus bytes the transport has not written yet.
+    backlog = client.outboundSize
+    transport = client.transport
+    if transport is not None:
+        backlog += len(getattr(transport, 'dataBuffer', '')) - getattr(transport, 'offset', 0)
+        backlog += getattr(transport, '_tempDataLen', 0)
+    return backlog
+
+
+# Server-wide protocol counters. Counts and byte totals are kept for every
+# packet; decode and handle times are only measured for one packet in
+# SAMPLE_MASK + 1 of each ID, which keeps the timer calls off most packets.
+class Metrics:
+    SAMPLE_MASK = 7
+
+    def __init__(self):
+        self.started = time.time()
+
+        self.inbound = PacketMetrics()
+        self.outbound = PacketMetrics()
+
+        self.chunksSent = 0
+        self.chunkBytesSent = 0
+
+        self.tickTime = Histogram()
+
+    def snapshot(self, server):
+        connections = []
+        for client in server.factory.clients:
+            connections.append({
+                'username': clientName(client),
+                'bytesIn': client.bytesIn,
+                'bytesOut': client.bytesOut,
+                'backlog': connectionBacklog(client),
+            })
+
+        return {
+            'uptime': time.time() - self.started,
+            'inbound': self.inbound.toDict(),
+            'outbound': self.outbound.toDict(),
+            'connections': connections,
+            'chunksSent': self.chunksSent,
+            'chunkBytesSent': self.chunkBytesSent,
+            'ticks': {
+                'count': server.ticks.tick,
+                'skipped': server.ticks.skipped,
+                'tps': server.ticks.getTPS(),
+                'mspt': server.ticks.getMSPT(),
+                'time': self.tickTime.toDict(),
+            },
+        }
+
+    def prometheus(self, server):
+        lines = []
+
+        def sample(name, labels, value):
+            if labels:
+                labels = '{%s}' % ','.join('%s="%s"' % (label, escapeLabel(value)) for label, value in labels)
+            lines.append('pumpkinpy_%s%s %s' % (name, labels or '', repr(float(value))))
+
+        def metric(name, kind, samples):
+            lines.append('# TYPE pumpkinpy_%s %s' % (name, kind))
+            for labels, value in samples:
+                sample(name, labels, value)
+
+        def packetLabels(direction, packetId):
+            return ('direction', direction), ('packet', packetName(packetId))
+
+        directions = (('in', self.inbound), ('out', self.outbound))
+
+        for name, attribute in (('packets_total', 'counts'), ('packet_bytes_total', 'bytes')):
+            samples = []
+            for direction, packets in directions:
+                for packetId, value in enumerate(getattr(packets, attribute)):
+                    if value:
+                        samples.append((packetLabels(direction, packetId), value))
+            metric(name, 'counter', samples)
+
+        for name, attribute in (('packet_decode_seconds', 'decodeTime'), ('packet_handle_seconds', 'handleTime')):
+            lines.append('# TYPE pumpkinpy_%s histogram' % name)
+            for direction, packets in directions:
+                for packetId, histogram in sorted(getattr(packets, attribute).items()):
+                    labels = packetLabels(direction, packetId)
+                    for bound, count in histogram.cumulative():
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        sample(name + '_bucket', labels + (('le', le),), count)
+                    sample(name + '_sum', labels, histogram.total)
+                    sample(name + '_count', labels, histogram.count)
+
+        clients = server.factory.clients
+        metric('connections', 'gauge', [((), len(clients))])
+        metric('connection_bytes_total', 'counter',
+               [((('client', clientName(client)), ('direction', 'in')), client.bytesIn) for client in clients] +
+               [((('client', clientName(client)), ('direction', 'out')), client.bytesOut) for client in clients])
+        metric('connection_backlog_bytes', 'gauge',
+               [((('client', clientName(client)),), connectionBacklog(client)) for client in clients])
+
+        metric('chunks_sent_total', 'counter', [((), self.chunksSent)])
+        metric('chunk_bytes_sent_total', 'counter', [((), self.chunkBytesSent)])
+
+        ticks = server.ticks
+        metric('ticks_total', 'counter', [((), ticks.tick)])
+        metric('ticks_skipped_total', 'counter', [((), ticks.skipped)])
+        metric('tps', 'gauge', [((), ticks.getTPS())])
+        metric('mspt', 'gauge', [((), ticks.getMSPT())])
+        lines.append('# TYPE pumpkinpy_tick_seconds histogram')
+        for bound, count in self.tickTime.cumulative():
+            sample('tick_seconds_bucket', (('le', '+Inf' if bound == float('inf') else repr(bound)),), count)
+        sample('tick_seconds_sum', (), self.tickTime.total)
+        sample('tick_seconds_count', (), self.tickTime.count)
+
+        return '\n'.join(lines) + '\n'
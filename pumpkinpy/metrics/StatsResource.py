@@ -0,0 +1,36 @@
+import json
+
+from twisted.web import resource
+
+
+class JsonStats(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, server):
+        resource.Resource.__init__(self)
+        self.minecraftServer = server
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(self.minecraftServer.metrics.snapshot(self.minecraftServer), indent=2, sort_keys=True)
+
+
+class PrometheusStats(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, server):
+        resource.Resource.__init__(self)
+        self.minecraftServer = server
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.minecraftServer.metrics.prometheus(self.minecraftServer)
+
+
+# Serves /stats (JSON) and /metrics (Prometheus text format). Resource
+# already has a server attribute, hence minecraftServer.
+class StatsResource(resource.Resource):
+    def __init__(self, server):
+        resource.Resource.__init__(self)
+        self.putChild('stats', JsonStats(server))
+        self.putChild('metrics', PrometheusStats(server))
@@ -0,0 +1,34 @@
+from pumpkinpy.networking import Packet
+
+
+# Fans one encoded packet out to many clients. Packets are serialized once by
+# the caller (or here, for Packet instances) and the same immutable string is
+# queued on every recipient's connection.
+class BroadcastManager:
+    def __init__(self, server):
+        self.server = server
+
+    def toClients(self, data, clients, exclude=None):
+        if isinstance(data, Packet.Packet):
+            data = data.buff
+
+        for client in clients:
+            if client is not exclude:
+                client.send(data)
+
+    def toChunk(self, data, chunk, exclude=None):
+        self.toClients(data, [player.client for player in chunk.players], exclude)
+
+    def toRadius(self, data, chunkX, chunkZ, radius, exclude=None):
+        clients = []
+        for client in self.server.world.clients:
+            chunk = client.player.chunk
+            if chunk is None:
+                continue
+            if abs(chunk.x - chunkX) <= radius and abs(chunk.z - chunkZ) <= radius:
+                clients.append(client)
+
+        self.toClients(data, clients, exclude)
+
+    def toWorld(self, data, exclude=None):
+        self.toClients(data, self.server.world.clients, exclude)
@@ -1,8 +1,11 @@
 import struct
+import time
 from twisted.internet import protocol
 
 from pumpkinpy.networking import Packet
+from pumpkinpy.networking.PacketBuffer import PacketBuffer
 from minecraft.entity.Player import Player
+from minecraft.util.MinecraftConstants import Blocks
 
 
 ANONYMOUS = 0
@@ -14,157 +17,228 @@ PLAY_GAME = 3
 class MinecraftProtocol(protocol.Protocol):
     PROTOCOL_VERSION = 8
 
+    # Outbound packets are queued and written with a single writeSequence.
+    # MAX_FLUSH_DELAY is the longest a queued packet may wait, in seconds; 0
+    # flushes once per reactor turn. MAX_QUEUED_BYTES forces an early flush.
+    MAX_FLUSH_DELAY = 0.0
+    MAX_QUEUED_BYTES = 64 * 1024
+
+    # Furthest a player may break a block from, in blocks.
+    MAX_REACH = 6.0
+
+    # state -> packet ID -> (packet class, handler). Handlers are called with
+    # the client and whatever the packet's handlePacket returned.
+    handlers = {
+        ANONYMOUS: {},
+        HANDSHAKE: {},
+        LOGGING_IN: {},
+        PLAY_GAME: {},
+    }
+
     def __init__(self):
         self.factory = None
         self.server = None
         self.username = None
         self.state = None
+        self.dispatch = {}
         self.player = None
 
-        self.dataBuffer = ''
+        self.dataBuffer = PacketBuffer()
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+        self.outbound = []
+        self.outboundSize = 0
+        self.flushCall = None
+
+    @classmethod
+    def registerHandler(cls, state, packetClass, handler):
+        if packetClass.PACKET_DIRECTION not in (Packet.UPSTREAM, Packet.BOTH):
+            raise ValueError('%s is not sent by clients' % packetClass.__name__)
+        cls.handlers[state][packetClass.PACKET_ID] = (packetClass, handler)
+
+    @classmethod
+    def unregisterHandler(cls, state, packetClass):
+        cls.handlers[state].pop(packetClass.PACKET_ID, None)
 
     def connectionMade(self):
         print('A new connection was made!')
         self.factory.clients.append(self)
         self.server = self.factory.server
-        self.state = ANONYMOUS
+        self.setState(ANONYMOUS)
+
+    def setState(self, state):
+        self.state = state
+        self.dispatch = self.handlers[state]
 
     def dataReceived(self, data):
-        self.dataBuffer += data
+        self.bytesIn += len(data)
 
-        packetId = struct.unpack_from('!b', self.dataBuffer)[0]
+        buff = self.dataBuffer
+        buff.feed(data)
 
-        for p in Packet.VALID_PACKETS:
-            if p.PACKET_ID == packetId:
-                if p.PACKET_DIRECTION not in (Packet.UPSTREAM, Packet.BOTH):
+        metrics = self.server.metrics
+        counts = metrics.inbound.counts
+        sizes = metrics.inbound.bytes
+        sampleMask = metrics.SAMPLE_MASK
+
+        while len(buff) and not self.transport.disconnecting:
+            packetId = buff.peek()
+
+            entry = self.dispatch.get(packetId)
+            if entry is None:
+                packetClass = Packet.PACKETS_BY_ID.get(packetId)
+                if packetClass is None:
+                    print("Unhandled Packet ID: %s" % hex(packetId))
+                    self.sendKick('Invalid packet was sent!')
+                    return
+                if packetClass.PACKET_DIRECTION not in (Packet.UPSTREAM, Packet.BOTH):
                     self.sendKick('A nonsendable packet was sent!')
                     return
-                if p.EXPECTED_SIZE > len(self.dataBuffer):
+                if self.state != PLAY_GAME:
+                    self.sendKick('Invalid packet sent!')
                     return
+
+                print('Unhandled packet ID: %s' % hex(packetId))
+                entry = (packetClass, None)
+
+            packetClass, handler = entry
+            if packetClass.EXPECTED_SIZE > len(buff):
                 break
-        else:
-            print("Unhandled Packet ID: %s" % hex(packetId))
-            self.sendKick('Invalid packet was sent!')
-            return
 
-        self.handlePacket(packetId)
+            sampled = not counts[packetId] & sampleMask
+            if sampled:
+                started = time.time()
 
-    def handlePacket(self, packetId):
-        self.dataBuffer = self.dataBuffer[1:]
+            packet = packetClass(buff.buff, buff.offset + 1)
+            try:
+                result = packet.handlePacket()
+            except struct.error:
+                # A variable-length field has not been fully received yet.
+                break
+            except ValueError:
+                self.sendKick('Invalid packet was sent!')
+                return
 
-        if self.state == ANONYMOUS:
-            if packetId == 0x02:
-                packet = Packet.LoginHandshakePacket(self.dataBuffer)
-                self.username = packet.handlePacket()
+            buff.advance(1 + packet.size)
+            counts[packetId] += 1
+            sizes[packetId] += 1 + packet.size
 
-                self.dataBuffer = self.dataBuffer[packet.size:]
-                packet.clear()
+            if sampled:
+                decoded = time.time()
 
-                self.state = HANDSHAKE
+            if handler is not None:
+                handler(self, result)
 
-                packet.writePacket(connectionHash='-')
-                self.send(packet)
-            else:
-                self.sendKick('Invalid packet sent!')
-                return
-        elif self.state == HANDSHAKE:
-            if packetId == 0x01:
-                packet = Packet.LoginRequestPacket(self.dataBuffer)
-                protocolVersion, username = packet.handlePacket()
+            if sampled:
+                metrics.inbound.observe(packetId, decoded - started, time.time() - decoded)
 
-                if protocolVersion != self.PROTOCOL_VERSION:
-                    self.sendKick('Invalid protocol version!')
-                    return
-                if username != self.username:
-                    self.sendKick('The server rejected your login request.')
-                    return
+        buff.compact()
 
-                self.dataBuffer = self.dataBuffer[packet.size:]
-                packet.clear()
+    def handleHandshake(self, username):
+        self.username = username
+        self.setState(HANDSHAKE)
 
-                self.state = LOGGING_IN
+        packet = Packet.LoginHandshakePacket.encode(connectionHash='-')
+        self.send(packet)
 
-                self.handleLogin()
-            else:
-                self.sendKick('Invalid packet sent!')
-                return
+    def handleLoginRequest(self, result):
+        protocolVersion, username = result
 
-        elif self.state == LOGGING_IN:
-            if packetId == 0x00:
-                packet = Packet.KeepAlivePacket('')
-                packet.writePacket()
-                self.send(packet)
-            else:
-                self.sendKick('Invalid packet sent!')
-                return
+        if protocolVersion != self.PROTOCOL_VERSION:
+            self.sendKick('Invalid protocol version!')
+            return
+        if username != self.username:
+            self.sendKick('The server rejected your login request.')
+            return
 
-        elif self.state == PLAY_GAME:
-            if packetId == 0x00:
-                packet = Packet.KeepAlivePacket('')
-                packet.writePacket()
-                self.send(packet)
-
-            elif packetId == 0x0D:
-                packet = Packet.PlayerPosLookPacket(self.dataBuffer)
-                x, stance, y, z, yaw, pitch, onGround = packet.handlePacket()
-                self.player.move(x, y, z, stance=stance, yaw=yaw, pitch=pitch, broadcast=False)
-                self.dataBuffer = self.dataBuffer[packet.size:]
-                packet.clear()
-
-            elif packetId == 0x0B:
-                packet = Packet.PlayerPositionPacket(self.dataBuffer)
-                x, y, stance, z, onGround = packet.handlePacket()
-                self.player.move(x, y, z, stance=stance, onGround=onGround, broadcast=False)
-                self.dataBuffer = self.dataBuffer[packet.size:]
-                packet.clear()
-
-            elif packetId == 0x0C:
-                packet = Packet.PlayerLookPacket(self.dataBuffer)
-                yaw, pitch, onGround = packet.handlePacket()
-                self.player.rotate(yaw, pitch)
-                self.dataBuffer = self.dataBuffer[packet.size:]
-                packet.clear()
-
-            elif packetId == 0x0A:
-                packet = Packet.PlayerOnGroundPacket(self.dataBuffer)
-                onGround = packet.handlePacket()
-                self.player.onGround = onGround
-                self.dataBuffer = self.dataBuffer[packet.size:]
-                packet.clear()
-
-            elif packetId == 0x12:
-                packet = Packet.EntityAnimationPacket(self.dataBuffer)
-                packet.handlePacket()
-                self.dataBuffer = self.dataBuffer[packet.size:]
-                packet.clear()
-
-            elif packetId == 0x0E:
-                packet = Packet.PlayerDiggingPacket(self.dataBuffer)
-                packet.handlePacket()
-                self.dataBuffer = self.dataBuffer[packet.size:]
-                packet.clear()
-
-            elif packetId == 0x03:
-                packet = Packet.ChatMessagePacket(self.dataBuffer)
-                message = packet.handlePacket()
-
-                self.dataBuffer = self.dataBuffer[packet.size:]
-                packet.clear()
-
-                self.server.chatManager.handleChatMessage(self, message)
-            else:
-                print('Unhandled packet ID: %s' % hex(packetId))
+        self.setState(LOGGING_IN)
+
+        self.handleLogin()
+
+    def handleKeepAlive(self, result):
+        packet = Packet.KeepAlivePacket.encode()
+        self.send(packet, urgent=True)
 
-        if len(self.dataBuffer):
-            self.dataReceived('')
+    def handlePlayerPosLook(self, result):
+        x, y, stance, z, yaw, pitch, onGround = result
+        self.player.move(x, y, z, stance=stance, yaw=yaw, pitch=pitch, onGround=onGround, broadcast=False)
 
-    def send(self, data):
+    def handlePlayerPosition(self, result):
+        x, y, stance, z, onGround = result
+        self.player.move(x, y, z, stance=stance, onGround=onGround, broadcast=False)
+
+    def handlePlayerLook(self, result):
+        yaw, pitch, onGround = result
+        self.player.rotate(yaw, pitch)
+
+    def handlePlayerOnGround(self, onGround):
+        self.player.onGround = onGround
+
+    def handlePlayerDigging(self, result):
+        status, x, y, z, face = result
+        if status != Packet.PlayerDiggingPacket.BLOCK_BROKEN or self.player.world is None:
+            return
+
+        player = self.player
+        dX = x + 0.5 - player.x
+        dY = y + 0.5 - player.y
+        dZ = z + 0.5 - player.z
+        if dX * dX + dY * dY + dZ * dZ > self.MAX_REACH * self.MAX_REACH:
+            self.resendBlock(x, y, z)
+            return
+
+        player.world.setBlockAt(x, y, z, Blocks.AIR)
+
+    def resendBlock(self, x, y, z):
+        # Undoes a change the client made locally but the server rejected.
+        world = self.server.world
+        if not 0 <= y < 128 or world.getChunk(x >> 4, z >> 4) is None:
+            return
+
+        block = world.getBlockAt(x, y, z)
+        self.send(Packet.BlockChangePacket.encode(x, y, z, block.blockId, block.blockData))
+
+    def send(self, data, urgent=False):
         if isinstance(data, Packet.Packet):
             data = data.buff
-        self.transport.write(data)
+
+        outbound = self.server.metrics.outbound
+        outbound.counts[ord(data[0])] += 1
+        outbound.bytes[ord(data[0])] += len(data)
+
+        self.outbound.append(data)
+        self.outboundSize += len(data)
+
+        if urgent or self.outboundSize >= self.MAX_QUEUED_BYTES:
+            self.flush()
+        elif self.flushCall is None:
+            self.flushCall = reactor.callLater(self.MAX_FLUSH_DELAY, self.flush)
+
+    def flush(self):
+        if self.flushCall is not None:
+            if self.flushCall.active():
+                self.flushCall.cancel()
+            self.flushCall = None
+
+        if not self.outbound:
+            return
+
+        self.transport.writeSequence(self.outbound)
+        self.bytesOut += self.outboundSize
+        self.outbound = []
+        self.outboundSize = 0
 
     def connectionLost(self, reason=protocol.connectionDone):
         protocol.Protocol.connectionLost(self, reason)
+        if self.flushCall is not None and self.flushCall.active():
+            self.flushCall.cancel()
+        self.flushCall = None
+        self.outbound = []
+        self.outboundSize = 0
+        if self.player is not None:
+            self.player.chunkQueue.stop()
+            self.player.releaseChunks()
         if self in self.server.world.clients:
             self.server.world.clients.remove(self)
         self.factory.clients.remove(self)
@@ -173,19 +247,25 @@ class MinecraftProtocol(protocol.Protocol):
     def handleLogin(self):
         self.player = Player(self, self.server.allocateEntityId())
 
-        packet = Packet.LoginRequestPacket('')
-        packet.writePacket(entityId=self.player.eid, seed=self.server.world.seed, dimension=0)
+        packet = Packet.LoginRequestPacket.encode(entityId=self.player.eid, seed=self.server.world.seed, dimension=0)
         self.send(packet)
 
-        self.sendInitialChunks()
+        d = self.sendInitialChunks()
 
         self.player.sendInventory()
 
-        self.state = PLAY_GAME
+        self.setState(PLAY_GAME)
 
         self.server.world.clients.append(self)
 
-        x, y, z = self.server.world.spawn
+        # The client is only told where it is once its terrain has arrived.
+        d.addCallback(self.spawnPlayer)
+
+    def spawnPlayer(self, result=None):
+        if not self.connected:
+            return
+
+        x, y, z = self.server.world.getSpawnPoint()
         y += 2
 
         self.player.spawn(self.server.world, x, y, z)
@@ -198,24 +278,37 @@ class MinecraftProtocol(protocol.Protocol):
 
         chunkCoords = self.server.world.getAllChunksInRadius(chunkX, chunkZ, 5)
 
+        queue = self.player.chunkQueue
+        queue.setCenter(chunkX, chunkZ)
+
         for c in chunkCoords:
             x, z = c
             self.player.visibleChunks.append((x, z))
-            chunk = self.server.world.getChunk(x, z)
-            if not chunk:
-                print("No chunk at: %s" % chunk)
-                return
+            self.server.world.addTicket(x, z)
+            queue.enqueue((x, z))
 
-            chunk.sendPreChunk(self)
-            chunk.sendLoadChunk(self)
+        # Only the chunks right around spawn have to arrive before spawning;
+        # the rest keep streaming in afterwards.
+        return queue.waitFor(self.server.world.getAllChunksInRadius(chunkX, chunkZ, 1))
 
     def sendKick(self, reason):
-        packet = Packet.ClientKickPacket('')
-        packet.writePacket(reason)
-        self.send(packet)
+        packet = Packet.ClientKickPacket.encode(reason)
+        self.send(packet, urgent=True)
         self.transport.loseConnection()
 
 
+MinecraftProtocol.registerHandler(ANONYMOUS, Packet.LoginHandshakePacket, MinecraftProtocol.handleHandshake)
+MinecraftProtocol.registerHandler(HANDSHAKE, Packet.LoginRequestPacket, MinecraftProtocol.handleLoginRequest)
+MinecraftProtocol.registerHandler(LOGGING_IN, Packet.KeepAlivePacket, MinecraftProtocol.handleKeepAlive)
+MinecraftProtocol.registerHandler(PLAY_GAME, Packet.KeepAlivePacket, MinecraftProtocol.handleKeepAlive)
+MinecraftProtocol.registerHandler(PLAY_GAME, Packet.PlayerPosLookPacket, MinecraftProtocol.handlePlayerPosLook)
+MinecraftProtocol.registerHandler(PLAY_GAME, Packet.PlayerPositionPacket, MinecraftProtocol.handlePlayerPosition)
+MinecraftProtocol.registerHandler(PLAY_GAME, Packet.PlayerLookPacket, MinecraftProtocol.handlePlayerLook)
+MinecraftProtocol.registerHandler(PLAY_GAME, Packet.PlayerOnGroundPacket, MinecraftProtocol.handlePlayerOnGround)
+MinecraftProtocol.registerHandler(PLAY_GAME, Packet.EntityAnimationPacket, None)
+MinecraftProtocol.registerHandler(PLAY_GAME, Packet.PlayerDiggingPacket, MinecraftProtocol.handlePlayerDigging)
+
+
 class MinecraftFactory(protocol.ServerFactory):
     protocol = MinecraftProtocol
     server = None
@@ -1,6 +1,10 @@
 import struct
 import zlib
 
+from pumpkinpy.networking import PacketSchema
+from pumpkinpy.networking.PacketSchema import BYTE, UBYTE, BOOL, SHORT, INT, LONG, FLOAT, DOUBLE, STRING, \
+    BYTE_ARRAY, ITEM, ITEM_ARRAY, BLOCK_CHANGES
+
 
 UPSTREAM = 0
 DOWNSTREAM = 1
@@ -10,109 +14,128 @@ BOTH = 2
 class Packet:
     PACKET_ID = None
     PACKET_DIRECTION = None
-    EXPECTED_SIZE = None  # Expected size without variable-length strings.
+    EXPECTED_SIZE = None  # Expected size without variable-length strings, derived from FIELDS.
+    FIELDS = ()
+    CODEC = None
 
-    def __init__(self, buff):
+    def __init__(self, buff, offset=0):
         self.buff = buff
+        self.offset = offset
         self.size = 0
 
-    def writePacket(self, *args):
-        raise NotImplementedError
+    def writePacket(self, *args, **kwargs):
+        data = self.encode(*args, **kwargs)
+        self.buff += data
+        self.size += len(data)
+
+    @classmethod
+    def encode(cls, *values):
+        return cls.CODEC.encode(values)
 
     def handlePacket(self):
-        raise NotImplementedError
+        return self.read()
 
     def clear(self):
         self.buff = ''
+        self.offset = 0
         self.size = 0
 
+    def read(self):
+        values, end = self.CODEC.decode(self.buff, self.offset)
+        self.size += end - self.offset
+        self.offset = end
+        return values
+
     def unpack(self, fmt):
-        size = struct.calcsize(fmt)
-        self.size += size
-        data = struct.unpack(fmt, self.buff[:size])
-        self.buff = self.buff[size:]
+        s = getStruct(fmt)
+        data = s.unpack_from(self.buff, self.offset)
+        self.offset += s.size
+        self.size += s.size
         return data
 
     def pack(self, fmt, *args):
-        size = struct.calcsize(fmt)
-        self.size += size
-        self.buff += struct.pack(fmt, *args)
+        data = getStruct(fmt).pack(*args)
+        self.buff += data
+        self.size += len(data)
 
     def unpackString(self):
-        length = self.unpack('!h')[0]
-        if length == 0:
-            return ''
-        fmt = '!' + ('c' * length)
-        return ''.join(self.unpack(fmt))
+        value, end = PacketSchema.STRING.read(self.buff, self.offset)
+        self.size += end - self.offset
+        self.offset = end
+        return value
 
     def packString(self, s):
+        s = PacketSchema.STRING.encode(s)
         self.pack('!h', len(s))
-        if len(s) == 0:
-            return
-        for c in s:
-            self.pack('!c', c)
+        self.buff += s
+        self.size += len(s)
+
+
+_structs = {}
+
+
+def getStruct(fmt):
+    s = _structs.get(fmt)
+    if s is None:
+        s = _structs[fmt] = struct.Struct(fmt)
+    return s
 
 
 class KeepAlivePacket(Packet):
     PACKET_ID = 0x00
     PACKET_DIRECTION = BOTH
-    PACKET_SIZE = 1
 
     def handlePacket(self):
         pass
 
-    def writePacket(self):
-        self.pack('!B', self.PACKET_ID)
-
 
 class LoginRequestPacket(Packet):
     PACKET_ID = 0x01
     PACKET_DIRECTION = BOTH
-    EXPECTED_SIZE = 18
+    FIELDS = (
+        ('entityId', INT),  # Protocol version when sent by the client.
+        ('username', STRING),
+        ('password', STRING),  # Used for password protected servers.
+        ('seed', LONG),
+        ('dimension', BYTE),
+    )
 
     def handlePacket(self):
-        protocolVersion = self.unpack('!i')[0]
-        username = self.unpackString()
-
-        # Used for password protected servers.
-        password = self.unpackString()
-
-        # Unused
-        # seed, dimension = self.unpack('!qb')
-
+        protocolVersion, username, password, seed, dimension = self.read()
         return protocolVersion, username
 
-    def writePacket(self, entityId, seed, dimension):
-        self.pack('!B', self.PACKET_ID)
-        self.pack('!i', entityId)
-
+    @classmethod
+    def encode(cls, entityId, seed, dimension):
         # Unused vars
         field2 = field3 = ''
 
-        self.packString(field2)
-        self.packString(field3)
-
-        self.pack('!qb', seed, dimension)
+        return cls.CODEC.encode((entityId, field2, field3, seed, dimension))
 
 
 class LoginHandshakePacket(Packet):
     PACKET_ID = 0x02
     PACKET_DIRECTION = BOTH
-    EXPECTED_SIZE = 3
+    FIELDS = (
+        ('username', STRING),
+    )
 
     def handlePacket(self):
-        username = self.unpackString()
+        username = self.read()[0]
         return username
 
-    def writePacket(self, connectionHash):
-        self.pack('!B', self.PACKET_ID)
-        self.packString(connectionHash)
+    @classmethod
+    def encode(cls, connectionHash):
+        return cls.CODEC.encode((connectionHash,))
 
 
 class PreChunkPacket(Packet):
     PACKET_ID = 0x32
     PACKET_DIRECTION = DOWNSTREAM
-    EXPECTED_SIZE = 10
+    FIELDS = (
+        ('chunkX', INT),
+        ('chunkZ', INT),
+        ('mode', UBYTE),
+    )
 
     UNLOAD = 0
     LOAD = 1
@@ -120,174 +143,195 @@ class PreChunkPacket(Packet):
     def handlePacket(self):
         pass
 
-    def writePacket(self, chunkX, chunkZ, mode):
-        self.pack('!B', self.PACKET_ID)
-        self.pack('!iiB', chunkX, chunkZ, mode)
+    @classmethod
+    def encode(cls, chunkX, chunkZ, mode):
+        return cls.CODEC.encode((chunkX, chunkZ, mode))
 
 
 class MapChunkPacket(Packet):
     PACKET_ID = 0x33
     PACKET_DIRECTION = DOWNSTREAM
-    EXPECTED_SIZE = 18
+    FIELDS = (
+        ('x', INT),
+        ('y', SHORT),
+        ('z', INT),
+        ('sizeX', BYTE),
+        ('sizeY', BYTE),
+        ('sizeZ', BYTE),
+        ('compressedData', BYTE_ARRAY),
+    )
 
     def handlePacket(self):
         pass
 
-    def writePacket(self, chunk, sizeX=15, sizeY=127, sizeZ=15):
+    @classmethod
+    def encode(cls, chunk, sizeX=15, sizeY=127, sizeZ=15, compressedData=None):
         x = (chunk.x * 16)
         y = 0
         z = (chunk.z * 16)
 
-        self.pack('!B', self.PACKET_ID)
-        self.pack('!ihi', x, y, z)
-        self.pack('!bbb', sizeX, sizeY, sizeZ)
+        if compressedData is None:
+            compressedData = compressChunkData(cls.getChunkData(chunk))
+
+        return cls.CODEC.encode((x, y, z, sizeX, sizeY, sizeZ, compressedData))
 
-        chunkData = chunk.blocks + chunk.blockMeta + chunk.blockLight + chunk.skyLight
-        chunkData = "".join(map(chr, chunkData))
-        compressedData = zlib.compress(chunkData)
+    @staticmethod
+    def getChunkData(chunk):
+        # The chunk's storage is already in payload order, so it is compressed
+        # in place; Chunk recompresses if it changes in the meantime.
+        return chunk.data
 
-        self.pack('!i', len(compressedData))
-        self.buff += compressedData
 
-        self.size += len(compressedData)
+def compressChunkData(chunkData):
+    return zlib.compress(chunkData)
 
 
 class SpawnPositionPacket(Packet):
     PACKET_ID = 0x06
     PACKET_DIRECTION = DOWNSTREAM
-    EXPECTED_SIZE = 13
+    FIELDS = (
+        ('x', INT),
+        ('y', INT),
+        ('z', INT),
+    )
 
     def handlePacket(self):
         pass
 
-    def writePacket(self, spawn):
+    @classmethod
+    def encode(cls, spawn):
         x, y, z = spawn
-        self.pack('!B', self.PACKET_ID)
-        self.pack('!iii', x, y, z)
+        return cls.CODEC.encode((x, y, z))
 
 
 class PlayerPosLookPacket(Packet):
     PACKET_ID = 0x0D
     PACKET_DIRECTION = BOTH
-    EXPECTED_SIZE = 42
-
-    def handlePacket(self):
-        return self.unpack('!ddddffb')
+    FIELDS = (
+        ('x', DOUBLE),
+        ('y', DOUBLE),
+        ('stance', DOUBLE),
+        ('z', DOUBLE),
+        ('yaw', FLOAT),
+        ('pitch', FLOAT),
+        ('onGround', BOOL),
+    )
 
-    def writePacket(self, x, y, stance, z, yaw, pitch, onGround):
-        self.pack('!B', self.PACKET_ID)
-        self.pack('!ddddffb', x, y, stance, z, yaw, pitch, onGround)
+    @classmethod
+    def encode(cls, x, y, stance, z, yaw, pitch, onGround):
+        return cls.CODEC.encode((x, y, stance, z, yaw, pitch, onGround))
 
 
 class PlayerPositionPacket(Packet):
     PACKET_ID = 0x0B
     PACKET_DIRECTION = UPSTREAM
-    EXPECTED_SIZE = 34
-
-    def handlePacket(self):
-        return self.unpack('!ddddb')
-
-    def writePacket(self, *args):
-        pass
+    FIELDS = (
+        ('x', DOUBLE),
+        ('y', DOUBLE),
+        ('stance', DOUBLE),
+        ('z', DOUBLE),
+        ('onGround', BOOL),
+    )
 
 
 class PlayerLookPacket(Packet):
     PACKET_ID = 0x0C
     PACKET_DIRECTION = UPSTREAM
-    EXPECTED_SIZE = 10
+    FIELDS = (
+        ('yaw', FLOAT),
+        ('pitch', FLOAT),
+        ('onGround', BOOL),
+    )
 
     def handlePacket(self):
-        yaw, pitch, onGround = self.unpack('!ffb')
+        yaw, pitch, onGround = self.read()
         return yaw, pitch, onGround
 
-    def writePacket(self, *args):
-        pass
-
 
 class PlayerOnGroundPacket(Packet):
     PACKET_ID = 0x0A
     PACKET_DIRECTION = UPSTREAM
-    EXPECTED_SIZE = 2
+    FIELDS = (
+        ('onGround', BOOL),
+    )
 
     def handlePacket(self):
-        onGround = self.unpack('!b')[0]
+        onGround = self.read()[0]
         return onGround
 
-    def writePacket(self, *args):
-        pass
-
 
 class EntityAnimationPacket(Packet):
     PACKET_ID = 0x12
     PACKET_DIRECTION = BOTH
-    EXPECTED_SIZE = 6
+    FIELDS = (
+        ('entityId', INT),
+        ('animation', BYTE),
+    )
 
     def handlePacket(self):
-        entityId = self.unpack('!i')
-        animation = self.unpack('!b')
+        entityId, animation = self.read()
         print("Entity Animation: %s %s" % (entityId, animation))
         return entityId, animation
 
-    def writePacket(self, *args):
-        pass
-
 
 class TimeUpdatePacket(Packet):
     PACKET_ID = 0x04
     PACKET_DIRECTION = DOWNSTREAM
-    EXPECTED_SIZE = 9
+    FIELDS = (
+        ('time', LONG),
+    )
 
     def handlePacket(self):
         pass
 
-    def writePacket(self, time):
-        self.pack('!B', self.PACKET_ID)
-        self.pack('!q', time)
+    @classmethod
+    def encode(cls, time):
+        return cls.CODEC.encode((time,))
 
 
 class SetSlotPacket(Packet):
     PACKET_ID = 0x67
     PACKET_DIRECTION = DOWNSTREAM
-    EXPECTED_SIZE = 6
+    FIELDS = (
+        ('windowId', BYTE),
+        ('slot', SHORT),
+        ('item', ITEM),
+    )
 
     def handlePacket(self):
         pass
 
-    def writePacket(self, windowId, item):
-        self.pack('!B', self.PACKET_ID)
-        self.pack('!b', windowId)
-
-        self.pack('!h', item.slot)
-        self.pack('!h', item.itemId)
-
-        if item.itemId != -1:
-            self.pack('!bh', item.count, item.uses)
+    @classmethod
+    def encode(cls, windowId, item):
+        return cls.CODEC.encode((windowId, item.slot, (item.itemId, item.count, item.uses)))
 
 
 class WindowItemsPacket(Packet):
     PACKET_ID = 0x68
     PACKET_DIRECTION = DOWNSTREAM
-    EXPECTED_SIZE = 4
+    FIELDS = (
+        ('windowId', BYTE),
+        ('items', ITEM_ARRAY),
+    )
 
     def handlePacket(self):
         pass
 
-    def writePacket(self, windowId, inventory):
-        self.pack('!B', self.PACKET_ID)
-        self.pack('!b', windowId)
-        self.pack('!h', len(inventory))
-
-        for item in inventory:
-            self.pack('!h', item.itemId)
-
-            if item.itemId != -1:
-                self.pack('!bh', item.count, item.uses)
+    @classmethod
+    def encode(cls, windowId, inventory):
+        return cls.CODEC.encode((windowId, [(item.itemId, item.count, item.uses) for item in inventory]))
 
 
 class PlayerDiggingPacket(Packet):
     PACKET_ID = 0x0E
     PACKET_DIRECTION = BOTH
-    EXPECTED_SIZE = 12
+    FIELDS = (
+        ('status', BYTE),
+        ('x', INT),
+        ('y', BYTE),
+        ('z', INT),
+        ('face', BYTE),
+    )
 
     START_DIGGING = 0
     DIGGING = 1
@@ -296,157 +340,216 @@ class PlayerDiggingPacket(Packet):
     DROP_ITEM = 4
 
     def handlePacket(self):
-        status = self.unpack('!b')[0]
-        x, y, z = self.unpack('!ibi')
-        face = self.unpack('!b')[0]
-
+        status, x, y, z, face = self.read()
         return status, x, y, z, face
 
-    def writePacket(self):
-        pass
-
 
 class HoldItemPacket(Packet):
     PACKET_ID = 0x10
     PACKET_DIRECTION = BOTH
-    EXPECTED_SIZE = 3
-
-    def writePacket(self, *args):
-        pass
+    FIELDS = (
+        ('slot', SHORT),
+    )
 
     def handlePacket(self):
-        slot = self.unpack('!h')[0]
+        slot = self.read()[0]
         return slot
 
 
+class MultiBlockChangePacket(Packet):
+    PACKET_ID = 0x34
+    PACKET_DIRECTION = DOWNSTREAM
+    FIELDS = (
+        ('chunkX', INT),
+        ('chunkZ', INT),
+        ('changes', BLOCK_CHANGES),
+    )
+
+    def handlePacket(self):
+        pass
+
+    @classmethod
+    def encode(cls, chunkX, chunkZ, coords, blockIds, blockMeta):
+        return cls.CODEC.encode((chunkX, chunkZ, (coords, blockIds, blockMeta)))
+
+
 class BlockChangePacket(Packet):
     PACKET_ID = 0x35
     PACKET_DIRECTION = BOTH
-    EXPECTED_SIZE = 12
+    FIELDS = (
+        ('x', INT),
+        ('y', BYTE),
+        ('z', INT),
+        ('blockId', BYTE),
+        ('blockMeta', BYTE),
+    )
 
     def handlePacket(self):
         pass
 
-    def writePacket(self, x, y, z, blockId, blockMeta):
-        self.pack('!B', self.PACKET_ID)
-        self.pack('ibibb', x, y, z, blockId, blockMeta)
+    @classmethod
+    def encode(cls, x, y, z, blockId, blockMeta):
+        return cls.CODEC.encode((x, y, z, blockId, blockMeta))
 
 
 class ChatMessagePacket(Packet):
     PACKET_ID = 0x03
     PACKET_DIRECTION = BOTH
-    EXPECTED_SIZE = 3
+    FIELDS = (
+        ('message', STRING),
+    )
 
     def handlePacket(self):
-        message = self.unpackString()
+        message = self.read()[0]
         return message
 
-    def writePacket(self, message):
-        self.pack('!B', self.PACKET_ID)
-        self.packString(message)
+    @classmethod
+    def encode(cls, message):
+        return cls.CODEC.encode((message,))
 
 
 class NamedEntitySpawnPacket(Packet):
     PACKET_ID = 0x14
     PACKET_DIRECTION = DOWNSTREAM
-    EXPECTED_SIZE = 23
+    FIELDS = (
+        ('entityId', INT),
+        ('name', STRING),
+        ('x', INT),
+        ('y', INT),
+        ('z', INT),
+        ('rotation', BYTE),
+        ('pitch', BYTE),
+        ('currentItem', SHORT),
+    )
 
     def handlePacket(self):
         pass
 
-    def writePacket(self, player):
-        self.pack('!B', self.PACKET_ID)
-        self.pack('!i', player.eid)
-        self.pack('!iii', int(player.x), int(player.y), int(player.z))
-        self.pack('!bb', int(player.h), int(player.p))
-
+    @classmethod
+    def encode(cls, player):
         # TODO: current hold item
-        self.pack('!h', 0)
+        return cls.CODEC.encode((player.eid, player.name, int(player.x), int(player.y), int(player.z),
+                                 int(player.h), int(player.p), 0))
 
 
 class EntityDestroyPacket(Packet):
     PACKET_ID = 0x1D
     PACKET_DIRECTION = DOWNSTREAM
-    EXPECTED_SIZE = 5
+    FIELDS = (
+        ('entityId', INT),
+    )
 
     def handlePacket(self):
         pass
 
-    def writePacket(self, eid):
-        self.pack('!Bi', self.PACKET_ID, eid)
+    @classmethod
+    def encode(cls, eid):
+        return cls.CODEC.encode((eid,))
 
 
 class EntityStillPacket(Packet):
     PACKET_ID = 0x1E
     PACKET_DIRECTION = DOWNSTREAM
-    EXPECTED_SIZE = 5
+    FIELDS = (
+        ('entityId', INT),
+    )
 
     def handlePacket(self):
         pass
 
-    def writePacket(self, eid):
-        self.pack('!Bi', self.PACKET_ID, eid)
+    @classmethod
+    def encode(cls, eid):
+        return cls.CODEC.encode((eid,))
 
 
 class EntityRelativePosPacket(Packet):
     PACKET_ID = 0x1F
     PACKET_DIRECTION = DOWNSTREAM
-    EXPECTED_SIZE = 8
+    FIELDS = (
+        ('entityId', INT),
+        ('dX', BYTE),
+        ('dY', BYTE),
+        ('dZ', BYTE),
+    )
 
     def handlePacket(self):
         pass
 
-    def writePacket(self, eid, dX, dY, dZ):
-        self.pack('!Bibbb', self.PACKET_ID, eid, dX, dY, dZ)
+    @classmethod
+    def encode(cls, eid, dX, dY, dZ):
+        return cls.CODEC.encode((eid, dX, dY, dZ))
 
 
 class EntityLookPacket(Packet):
     PACKET_ID = 0x20
     PACKET_DIRECTION = DOWNSTREAM
-    EXPECTED_SIZE = 7
+    FIELDS = (
+        ('entityId', INT),
+        ('h', BYTE),
+        ('p', BYTE),
+    )
 
     def handlePacket(self):
         pass
 
-    def writePacket(self, eid, h, p):
-        self.pack('!Bibb', self.PACKET_ID, eid, h, p)
+    @classmethod
+    def encode(cls, eid, h, p):
+        return cls.CODEC.encode((eid, h, p))
 
 
 class EntityRelativePosLookPacket(Packet):
     PACKET_ID = 0x21
     PACKET_DIRECTION = DOWNSTREAM
-    EXPECTED_SIZE = 10
+    FIELDS = (
+        ('entityId', INT),
+        ('dX', BYTE),
+        ('dY', BYTE),
+        ('dZ', BYTE),
+        ('h', BYTE),
+        ('p', BYTE),
+    )
 
     def handlePacket(self):
         pass
 
-    def writePacket(self, eid, dX, dY, dZ, h, p):
-        self.pack('!Bibbbbb', self.PACKET_ID, eid, dX, dY, dZ, h, p)
+    @classmethod
+    def encode(cls, eid, dX, dY, dZ, h, p):
+        return cls.CODEC.encode((eid, dX, dY, dZ, h, p))
 
 
 class EntityMovePacket(Packet):
     PACKET_ID = 0x22
     PACKET_DIRECTION = DOWNSTREAM
-    EXPECTED_SIZE = 19
+    FIELDS = (
+        ('entityId', INT),
+        ('x', INT),
+        ('y', INT),
+        ('z', INT),
+        ('h', BYTE),
+        ('p', BYTE),
+    )
 
     def handlePacket(self):
         pass
 
-    def writePacket(self, eid, x, y, z, h, p):
-        self.pack('!Biiiibb', self.PACKET_ID, eid, x, y, z, h, p)
+    @classmethod
+    def encode(cls, eid, x, y, z, h, p):
+        return cls.CODEC.encode((eid, x, y, z, h, p))
 
 
 class ClientKickPacket(Packet):
     PACKET_ID = 0xFF
     PACKET_DIRECTION = DOWNSTREAM
-    EXPECTED_SIZE = 3
+    FIELDS = (
+        ('reason', STRING),
+    )
 
     def handlePacket(self):
         pass
 
-    def writePacket(self, reason):
-        self.pack('!B', self.PACKET_ID)
-        self.packString(reason)
+    @classmethod
+    def encode(cls, reason):
+        return cls.CODEC.encode((reason,))
 
 VALID_PACKETS = {
     KeepAlivePacket,
@@ -483,6 +586,7 @@ VALID_PACKETS = {
     PreChunkPacket,
     MapChunkPacket,
 
+    MultiBlockChangePacket,
     BlockChangePacket,
 
 
@@ -490,3 +594,9 @@ VALID_PACKETS = {
     WindowItemsPacket,
     ClientKickPacket,
 }
+
+PACKETS_BY_ID = {}
+
+for packetClass in VALID_PACKETS:
+    PacketSchema.compileSchema(packetClass)
+    PACKETS_BY_ID[packetClass.PACKET_ID] = packetClass
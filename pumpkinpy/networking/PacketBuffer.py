@@ -0,0 +1,35 @@
+
+
+# Inbound byte stream with a read cursor. Packets are decoded in place with
+# unpack_from at the cursor; consumed bytes are only dropped once the buffer
+# has been fully drained or the dead prefix grows past COMPACT_THRESHOLD.
+class PacketBuffer:
+    COMPACT_THRESHOLD = 64 * 1024
+
+    def __init__(self):
+        self.buff = bytearray()
+        self.offset = 0
+
+    def __len__(self):
+        return len(self.buff) - self.offset
+
+    def feed(self, data):
+        self.buff += data
+
+    def peek(self):
+        return self.buff[self.offset]
+
+    def advance(self, size):
+        self.offset += size
+
+    def compact(self):
+        if self.offset == len(self.buff):
+            del self.buff[:]
+            self.offset = 0
+        elif self.offset > self.COMPACT_THRESHOLD:
+            del self.buff[:self.offset]
+            self.offset = 0
+
+    def clear(self):
+        del self.buff[:]
+        self.offset = 0
@@ -0,0 +1,249 @@
+import struct
+
+
+# Fixed-width field types are plain struct format characters so that runs of
+# them can be merged into a single precompiled struct.Struct.
+BYTE = 'b'
+UBYTE = 'B'
+BOOL = 'b'
+SHORT = 'h'
+INT = 'i'
+LONG = 'q'
+FLOAT = 'f'
+DOUBLE = 'd'
+
+SHORT_STRUCT = struct.Struct('!h')
+INT_STRUCT = struct.Struct('!i')
+ITEM_EXTRA_STRUCT = struct.Struct('!bh')
+
+
+class StringField:
+    MIN_SIZE = SHORT_STRUCT.size
+
+    def read(self, buff, offset):
+        length = SHORT_STRUCT.unpack_from(buff, offset)[0]
+        if length < 0:
+            raise ValueError('negative string length %d' % length)
+        offset += SHORT_STRUCT.size
+        end = offset + length
+        if end > len(buff):
+            raise struct.error('string of length %d exceeds buffer' % length)
+        return bytes(buff[offset:end]), end
+
+    def encode(self, value):
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        return value
+
+    def pack(self, value):
+        return SHORT_STRUCT.pack(len(value)) + value
+
+
+class ByteArrayField:
+    MIN_SIZE = INT_STRUCT.size
+
+    def read(self, buff, offset):
+        length = INT_STRUCT.unpack_from(buff, offset)[0]
+        if length < 0:
+            raise ValueError('negative byte array length %d' % length)
+        offset += INT_STRUCT.size
+        end = offset + length
+        if end > len(buff):
+            raise struct.error('byte array of length %d exceeds buffer' % length)
+        return bytes(buff[offset:end]), end
+
+    def encode(self, value):
+        return value
+
+    def pack(self, value):
+        return INT_STRUCT.pack(len(value)) + value
+
+
+class ItemField:
+    # An item slot is (itemId, count, uses); empty slots only carry itemId -1.
+    MIN_SIZE = SHORT_STRUCT.size
+
+    def read(self, buff, offset):
+        itemId = SHORT_STRUCT.unpack_from(buff, offset)[0]
+        offset += SHORT_STRUCT.size
+        if itemId == -1:
+            return (itemId, 0, 0), offset
+        count, uses = ITEM_EXTRA_STRUCT.unpack_from(buff, offset)
+        return (itemId, count, uses), offset + ITEM_EXTRA_STRUCT.size
+
+    def encode(self, value):
+        return value
+
+    def pack(self, value):
+        itemId, count, uses = value
+        if itemId == -1:
+            return SHORT_STRUCT.pack(itemId)
+        return SHORT_STRUCT.pack(itemId) + ITEM_EXTRA_STRUCT.pack(count, uses)
+
+
+class ItemArrayField:
+    MIN_SIZE = SHORT_STRUCT.size
+
+    def read(self, buff, offset):
+        count = SHORT_STRUCT.unpack_from(buff, offset)[0]
+        offset += SHORT_STRUCT.size
+        items = []
+        for i in xrange(count):
+            item, offset = ITEM.read(buff, offset)
+            items.append(item)
+        return items, offset
+
+    def encode(self, value):
+        return value
+
+    def pack(self, value):
+        return SHORT_STRUCT.pack(len(value)) + ''.join([ITEM.pack(item) for item in value])
+
+
+class BlockChangesField:
+    # (coords, blockIds, blockMeta) sharing one short count. Each coordinate is
+    # a short of x << 12 | z << 8 | y. Any of the three may be given already
+    # packed as a string.
+    MIN_SIZE = SHORT_STRUCT.size
+
+    def read(self, buff, offset):
+        count = SHORT_STRUCT.unpack_from(buff, offset)[0]
+        if count < 0:
+            raise ValueError('negative block change count %d' % count)
+        offset += SHORT_STRUCT.size
+        end = offset + count * 4
+        if end > len(buff):
+            raise struct.error('%d block changes exceed buffer' % count)
+
+        coords = struct.unpack_from('!%dh' % count, buff, offset)
+        offset += count * 2
+        blockIds = bytearray(buff[offset:offset + count])
+        blockMeta = bytearray(buff[offset + count:end])
+        return (list(coords), blockIds, blockMeta), end
+
+    def encode(self, value):
+        coords, blockIds, blockMeta = value
+        if not isinstance(coords, bytes):
+            coords = struct.pack('!%dh' % len(coords), *coords)
+        if not isinstance(blockIds, bytes):
+            blockIds = bytes(bytearray(blockIds))
+        if not isinstance(blockMeta, bytes):
+            blockMeta = bytes(bytearray(blockMeta))
+        if len(coords) != len(blockIds) * 2 or len(blockIds) != len(blockMeta):
+            raise ValueError('block change arrays differ in length')
+        return coords, blockIds, blockMeta
+
+    def pack(self, value):
+        coords, blockIds, blockMeta = value
+        return ''.join((SHORT_STRUCT.pack(len(blockIds)), coords, blockIds, blockMeta))
+
+
+STRING = StringField()
+BYTE_ARRAY = ByteArrayField()
+ITEM = ItemField()
+ITEM_ARRAY = ItemArrayField()
+BLOCK_CHANGES = BlockChangesField()
+
+
+# Compiled form of a packet's FIELDS schema. Consecutive fixed-width fields
+# are merged into one struct.Struct, so a packet made only of fixed-width
+# fields is decoded with a single unpack_from and encoded with a single pack.
+# Packets with variable-length fields are encoded as one string per step,
+# joined once.
+class PacketCodec:
+    def __init__(self, packetId, fields):
+        self.packetId = packetId
+        self.names = tuple(name for name, fieldType in fields)
+        self.fieldTypes = tuple(fieldType for name, fieldType in fields)
+
+        steps = []
+        fmt = ''
+        for name, fieldType in fields:
+            if isinstance(fieldType, str):
+                fmt += fieldType
+                continue
+            if fmt:
+                steps.append(struct.Struct('!' + fmt))
+                fmt = ''
+            steps.append(fieldType)
+        if fmt:
+            steps.append(struct.Struct('!' + fmt))
+
+        self.steps = tuple(steps)
+        self.variable = tuple(i for i, (name, fieldType) in enumerate(fields) if not isinstance(fieldType, str))
+
+        self.fixedSize = 1
+        for step in self.steps:
+            if isinstance(step, struct.Struct):
+                self.fixedSize += step.size
+            else:
+                self.fixedSize += step.MIN_SIZE
+
+        # Fast path for packets without variable-length fields: the packet ID
+        # is folded into the same struct as the body.
+        if not self.variable:
+            bodyFormat = ''.join(step.format[1:] for step in self.steps)
+            self.body = struct.Struct('!' + bodyFormat)
+            self.whole = struct.Struct('!B' + bodyFormat)
+        else:
+            self.body = self.whole = None
+
+        # (step, index of its first value, number of values) for encoding.
+        # The packet ID is folded into a leading fixed-width run.
+        layout = []
+        index = 0
+        for step in self.steps:
+            if isinstance(step, struct.Struct):
+                count = len(step.format) - 1
+                layout.append((step, index, count))
+                index += count
+            else:
+                layout.append((step, index, 0))
+                index += 1
+        self.header = chr(packetId)
+        if layout and layout[0][2]:
+            step, index, count = layout[0]
+            layout[0] = (struct.Struct('!B' + step.format[1:]), index, count)
+            self.header = None
+        self.layout = tuple(layout)
+
+    def decode(self, buff, offset=0):
+        # Decodes a packet body (without its ID byte) starting at offset and
+        # returns the field values and the offset just past the packet.
+        if self.body is not None:
+            return self.body.unpack_from(buff, offset), offset + self.body.size
+
+        values = []
+        for step in self.steps:
+            if isinstance(step, struct.Struct):
+                values.extend(step.unpack_from(buff, offset))
+                offset += step.size
+            else:
+                value, offset = step.read(buff, offset)
+                values.append(value)
+        return values, offset
+
+    def encode(self, values):
+        if self.whole is not None:
+            return self.whole.pack(self.packetId, *values)
+
+        parts = []
+        if self.header is not None:
+            parts.append(self.header)
+        for step, index, count in self.layout:
+            if not count:
+                parts.append(step.pack(step.encode(values[index])))
+            elif index or self.header is not None:
+                parts.append(step.pack(*values[index:index + count]))
+            else:
+                parts.append(step.pack(self.packetId, *values[:count]))
+        return ''.join(parts)
+
+
+def compileSchema(packetClass):
+    # EXPECTED_SIZE becomes the size of the packet with every variable-length
+    # field empty.
+    codec = PacketCodec(packetClass.PACKET_ID, packetClass.FIELDS)
+    packetClass.CODEC = codec
+    packetClass.EXPECTED_SIZE = codec.fixedSize
+    return codec
@@ -0,0 +1,258 @@
+import __builtin__
+import gc
+import json
+import random
+import sys
+import time
+
+import numpy
+from twisted.internet import reactor
+
+__builtin__.reactor = reactor
+
+from minecraft.entity.Player import Player
+from minecraft.util.MinecraftConstants import Blocks
+from minecraft.world.Chunk import Chunk, unpackNibbles
+from minecraft.world.World import World
+from pumpkinpy.metrics.Metrics import Metrics
+from pumpkinpy.networking import Packet
+from pumpkinpy.networking import PacketSchema
+from pumpkinpy.networking.BroadcastManager import BroadcastManager
+from pumpkinpy.TickScheduler import TickScheduler
+
+
+WORLD_RADIUS = 12
+VIEW_RADIUS = 5
+
+SAMPLE_VALUES = {
+    PacketSchema.BYTE: 1,
+    PacketSchema.UBYTE: 1,
+    PacketSchema.SHORT: 1,
+    PacketSchema.INT: 1,
+    PacketSchema.LONG: 1,
+    PacketSchema.FLOAT: 1.0,
+    PacketSchema.DOUBLE: 1.0,
+}
+
+
+def sampleValue(fieldType):
+    if fieldType is PacketSchema.STRING:
+        return 'benchmark'
+    if fieldType is PacketSchema.BYTE_ARRAY:
+        return 'x' * 4096
+    if fieldType is PacketSchema.ITEM:
+        return 1, 1, 0
+    if fieldType is PacketSchema.ITEM_ARRAY:
+        return [(1, 1, 0)] * 45
+    if fieldType is PacketSchema.BLOCK_CHANGES:
+        return range(64), [1] * 64, [0] * 64
+    return SAMPLE_VALUES[fieldType]
+
+
+def makeChunk(server, world, x, z, rng):
+    # Stone up to a noisy surface with grass on top and air above, which
+    # compresses roughly like real terrain.
+    blocks = bytearray(32768)
+    for column in xrange(256):
+        height = 60 + rng.randint(0, 8)
+        base = column * 128
+        blocks[base:base + height] = '\x01' * height
+        blocks[base + height] = 2
+
+    blockMeta = bytearray(16384)
+    blockLight = bytearray(16384)
+    skyLight = bytearray('\xff' * 16384)
+
+    return Chunk(server, world, x, z, True, blocks, blockMeta, blockLight, skyLight)
+
+
+class BenchmarkServer:
+    def __init__(self):
+        self.metrics = Metrics()
+        self.broadcastManager = BroadcastManager(self)
+        self.ticks = TickScheduler(self)
+        self.world = World(self, '')
+        self.nextEID = 100
+
+        rng = random.Random(0)
+        for x in xrange(-WORLD_RADIUS, WORLD_RADIUS):
+            for z in xrange(-WORLD_RADIUS, WORLD_RADIUS):
+                self.world.addChunk(makeChunk(self, self.world, x, z, rng))
+
+    def allocateEntityId(self):
+        eid = self.nextEID
+        self.nextEID += 1
+        return eid
+
+
+class BenchmarkClient:
+    connected = True
+
+    def __init__(self, server, username):
+        self.server = server
+        self.username = username
+
+    def send(self, data, urgent=False):
+        pass
+
+
+class Benchmark:
+    def __init__(self, name, func, iterations):
+        self.name = name
+        self.func = func
+        self.iterations = iterations
+
+    def run(self, repeats):
+        func = self.func
+        iterations = xrange(self.iterations)
+        best = None
+
+        gc.collect()
+        gc.disable()
+        try:
+            for i in xrange(repeats):
+                start = time.time()
+                for j in iterations:
+                    func()
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+        finally:
+            gc.enable()
+
+        return best / self.iterations * 1e9
+
+
+def packetBenchmarks():
+    benchmarks = []
+    for packetClass in sorted(Packet.VALID_PACKETS, key=lambda p: p.PACKET_ID):
+        codec = packetClass.CODEC
+        values = tuple(sampleValue(fieldType) for name, fieldType in packetClass.FIELDS)
+        data = codec.encode(values)
+
+        name = packetClass.__name__
+        benchmarks.append(Benchmark('encode.%s' % name, lambda codec=codec, values=values: codec.encode(values),
+                                    20000))
+        benchmarks.append(Benchmark('decode.%s' % name, lambda codec=codec, data=data: codec.decode(data, 1),
+                                    20000))
+    return benchmarks
+
+
+def worldBenchmarks():
+    server = BenchmarkServer()
+    world = server.world
+    chunk = world.getChunk(0, 0)
+
+    rng = random.Random(1)
+    chunkCoords = [(rng.randint(-WORLD_RADIUS, WORLD_RADIUS - 1), rng.randint(-WORLD_RADIUS, WORLD_RADIUS - 1))
+                   for i in xrange(1024)]
+    blockCoords = [(rng.randint(-WORLD_RADIUS * 16, WORLD_RADIUS * 16 - 1), rng.randint(0, 127),
+                    rng.randint(-WORLD_RADIUS * 16, WORLD_RADIUS * 16 - 1)) for i in xrange(1024)]
+
+    def getChunk():
+        for x, z in chunkCoords:
+            world.getChunk(x, z)
+
+    indices = numpy.random.RandomState(2).randint(0, 32768, 4096)
+
+    def getBlockAt():
+        for x, y, z in blockCoords:
+            world.getBlockAt(x, y, z)
+
+    def getHeightAt():
+        for x, y, z in blockCoords:
+            world.getHeightAt(x, z)
+
+    player = Player(BenchmarkClient(server, 'benchmark'), server.allocateEntityId())
+    player.spawn(world, 8.5, 70, 8.5, broadcast=False)
+    player.visibleChunks = world.getAllChunksInRadius(0, 0, VIEW_RADIUS)
+    for chunkCoord in player.visibleChunks:
+        world.addTicket(*chunkCoord)
+
+    def move():
+        # Walks back and forth across a chunk border, so every call crosses
+        # into a new chunk and updates visibility.
+        x = 16.5 if player.x < 16 else 15.5
+        player.move(x, player.y, player.z, broadcast=False)
+
+    oldVisibility = world.getAllChunksInRadius(0, 0, VIEW_RADIUS)
+    newVisibility = world.getAllChunksInRadius(1, 0, VIEW_RADIUS)
+
+    def placeTorch():
+        # Lights an area, then removes the light again.
+        world.setBlockAt(8, 70, 8, Blocks.TORCH)
+        world.lighting.propagate(float('inf'))
+        world.setBlockAt(8, 70, 8, Blocks.AIR)
+        world.lighting.propagate(float('inf'))
+
+    def updateVisibility():
+        player.updateVisibility(oldVisibility, newVisibility)
+        player.updateVisibility(newVisibility, oldVisibility)
+
+    return [
+        Benchmark('chunk.MapChunkPacket', lambda: Packet.MapChunkPacket.encode(chunk), 20),
+        Benchmark('chunk.unpackNibbles', lambda: unpackNibbles(chunk.skyLight), 2000),
+        Benchmark('chunk.getMeta[4096]', lambda: chunk.getMeta(indices), 2000),
+        Benchmark('world.getChunk[1024]', getChunk, 100),
+        Benchmark('world.getBlockAt[1024]', getBlockAt, 20),
+        Benchmark('world.getHeightAt[1024]', getHeightAt, 100),
+        Benchmark('world.getBox[32x32x32]', lambda: world.getBox(-16, 48, -16, 16, 80, 16), 200),
+        Benchmark('world.findBlocks[r=16]', lambda: world.findBlocks(2, 0, 64, 0, 16), 200),
+        Benchmark('lighting.relightChunk', lambda: world.lighting.relightChunk(chunk), 50),
+        Benchmark('lighting.placeTorch', placeTorch, 50),
+        Benchmark('world.getAllChunksInRadius', lambda: world.getAllChunksInRadius(0, 0, VIEW_RADIUS), 2000),
+        Benchmark('world.getChunksInRadius', lambda: list(world.getChunksInRadius(0, 0, VIEW_RADIUS)), 2000),
+        Benchmark('player.move', move, 200),
+        Benchmark('player.updateVisibility[x2]', updateVisibility, 200),
+    ]
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name in sorted(results):
+        current = results[name]
+        previous = baseline.get(name)
+        if previous is None:
+            print('%-40s %12.0f ns/op  (new)' % (name, current))
+            continue
+
+        ratio = current / previous
+        marker = ''
+        if ratio > 1.0 + threshold:
+            marker = '  REGRESSION'
+            regressions.append(name)
+        elif ratio < 1.0 - threshold:
+            marker = '  improved'
+        print('%-40s %12.0f ns/op  %6.2fx%s' % (name, current, ratio, marker))
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Runs the microbenchmark suite.')
+    parser.add_argument('--filter', default='', help='Only run benchmarks whose name contains this string.')
+    parser.add_argument('--repeats', default=5, type=int, help='Runs per benchmark; the fastest one is kept.')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare against the results in this JSON file.')
+    parser.add_argument('--threshold', default=0.10, type=float,
+                        help='Relative slowdown against the baseline that counts as a regression.')
+    args = parser.parse_args()
+
+    results = {}
+    for benchmark in packetBenchmarks() + worldBenchmarks():
+        if args.filter not in benchmark.name:
+            continue
+        results[benchmark.name] = benchmark.run(args.repeats)
+        if not args.baseline:
+            print('%-40s %12.0f ns/op' % (benchmark.name, results[benchmark.name]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'results': results}, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
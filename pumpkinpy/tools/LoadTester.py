@@ -0,0 +1,265 @@
+import json
+import random
+import struct
+import time
+
+from twisted.internet import protocol, reactor
+
+from pumpkinpy.networking import Packet
+from pumpkinpy.networking.PacketBuffer import PacketBuffer
+from pumpkinpy.networking.MinecraftProtocol import MinecraftProtocol
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 0.50),
+        'p90': percentile(values, 0.90),
+        'p99': percentile(values, 0.99),
+        'max': max(values) if values else None,
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.started = time.time()
+
+        self.loginLatency = []
+        self.firstChunkLatency = []
+        self.allChunksLatency = []
+        self.echoLatency = []
+
+        self.connected = 0
+        self.failed = 0
+        self.kicked = 0
+
+        self.packetsIn = 0
+        self.bytesIn = 0
+        self.packetsOut = 0
+        self.bytesOut = 0
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        return {
+            'elapsed': elapsed,
+            'connected': self.connected,
+            'failed': self.failed,
+            'kicked': self.kicked,
+            'loginLatency': summarize(self.loginLatency),
+            'firstChunkLatency': summarize(self.firstChunkLatency),
+            'allChunksLatency': summarize(self.allChunksLatency),
+            'echoLatency': summarize(self.echoLatency),
+            'packetsInPerSecond': self.packetsIn / elapsed,
+            'bytesInPerSecond': self.bytesIn / elapsed,
+            'packetsOutPerSecond': self.packetsOut / elapsed,
+            'bytesOutPerSecond': self.bytesOut / elapsed,
+        }
+
+
+# A headless client speaking the same protocol as the server, built on the
+# server's own packet codecs. It logs in, waits for its initial chunks, then
+# walks around at random and periodically sends chat messages whose echo is
+# timed.
+class BotProtocol(protocol.Protocol):
+    def __init__(self, factory, username):
+        self.factory = factory
+        self.stats = factory.stats
+        self.username = username
+
+        self.buffer = PacketBuffer()
+        self.connectTime = None
+        self.loginTime = None
+        self.chunks = 0
+        self.spawned = False
+
+        self.x = self.y = self.z = 0.0
+        self.chatSeq = 0
+        self.pendingEcho = {}
+
+        self.calls = {}
+
+        self.handlers = {
+            Packet.LoginHandshakePacket.PACKET_ID: self.handleHandshake,
+            Packet.LoginRequestPacket.PACKET_ID: self.handleLogin,
+            Packet.MapChunkPacket.PACKET_ID: self.handleMapChunk,
+            Packet.PlayerPosLookPacket.PACKET_ID: self.handlePosLook,
+            Packet.ChatMessagePacket.PACKET_ID: self.handleChat,
+            Packet.ClientKickPacket.PACKET_ID: self.handleKick,
+        }
+
+    def connectionMade(self):
+        self.stats.connected += 1
+        self.connectTime = time.time()
+        self.send(Packet.LoginHandshakePacket.encode(self.username))
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        for call in self.calls.values():
+            if call.active():
+                call.cancel()
+
+    def send(self, data):
+        self.stats.packetsOut += 1
+        self.stats.bytesOut += len(data)
+        self.transport.write(data)
+
+    def dataReceived(self, data):
+        self.stats.bytesIn += len(data)
+
+        buff = self.buffer
+        buff.feed(data)
+
+        while len(buff):
+            packetClass = Packet.PACKETS_BY_ID.get(buff.peek())
+            if packetClass is None:
+                print('%s: unknown packet ID %s' % (self.username, hex(buff.peek())))
+                self.transport.loseConnection()
+                return
+
+            if packetClass.EXPECTED_SIZE > len(buff):
+                break
+
+            try:
+                values, end = packetClass.CODEC.decode(buff.buff, buff.offset + 1)
+            except struct.error:
+                break
+            buff.advance(end - buff.offset)
+
+            self.stats.packetsIn += 1
+
+            handler = self.handlers.get(packetClass.PACKET_ID)
+            if handler is not None:
+                handler(values)
+
+        buff.compact()
+
+    def handleHandshake(self, values):
+        self.send(Packet.LoginRequestPacket.CODEC.encode(
+            (MinecraftProtocol.PROTOCOL_VERSION, self.username, '', 0, 0)))
+
+    def handleLogin(self, values):
+        self.loginTime = time.time()
+
+    def handleMapChunk(self, values):
+        self.chunks += 1
+        now = time.time()
+        if self.chunks == 1:
+            self.stats.firstChunkLatency.append(now - self.loginTime)
+        if self.chunks == self.factory.expectedChunks:
+            self.stats.allChunksLatency.append(now - self.loginTime)
+
+    def handlePosLook(self, values):
+        x, y, stance, z, yaw, pitch, onGround = values
+        self.x, self.y, self.z = x, y, z
+
+        if self.spawned:
+            return
+        self.spawned = True
+
+        self.stats.loginLatency.append(time.time() - self.connectTime)
+
+        self.repeat(self.factory.walkInterval, self.walk)
+        if self.factory.chatInterval > 0:
+            self.repeat(self.factory.chatInterval, self.chat)
+
+    def handleChat(self, values):
+        message = values[0]
+        token = message.rsplit(' ', 1)[-1]
+        sentAt = self.pendingEcho.pop(token, None)
+        if sentAt is not None:
+            self.stats.echoLatency.append(time.time() - sentAt)
+
+    def handleKick(self, values):
+        self.stats.kicked += 1
+        print('%s was kicked: %s' % (self.username, values[0]))
+
+    def repeat(self, interval, func):
+        def run():
+            func()
+            self.calls[func] = reactor.callLater(interval, run)
+
+        # Spread bots out so they do not all act on the same reactor turn.
+        self.calls[func] = reactor.callLater(random.random() * interval, run)
+
+    def walk(self):
+        self.x += random.uniform(-0.5, 0.5)
+        self.z += random.uniform(-0.5, 0.5)
+        self.send(Packet.PlayerPositionPacket.encode(self.x, self.y, self.y + 1.62, self.z, True))
+
+    def chat(self):
+        self.chatSeq += 1
+        token = '%s-%d' % (self.username, self.chatSeq)
+        self.pendingEcho[token] = time.time()
+        self.send(Packet.ChatMessagePacket.encode('echo %s' % token))
+
+
+class BotFactory(protocol.ClientFactory):
+    def __init__(self, stats, expectedChunks, walkInterval, chatInterval):
+        self.stats = stats
+        self.expectedChunks = expectedChunks
+        self.walkInterval = walkInterval
+        self.chatInterval = chatInterval
+        self.bots = 0
+
+    def buildProtocol(self, addr):
+        self.bots += 1
+        return BotProtocol(self, 'bot%d' % self.bots)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.stats.failed += 1
+
+
+def printReport(report):
+    def ms(value):
+        return '-' if value is None else '%.1fms' % (value * 1000.0)
+
+    print('Connected: %d  Failed: %d  Kicked: %d  Elapsed: %.1fs' % (
+        report['connected'], report['failed'], report['kicked'], report['elapsed']))
+
+    for key, label in (('loginLatency', 'Login'), ('firstChunkLatency', 'First chunk'),
+                       ('allChunksLatency', 'All chunks'), ('echoLatency', 'Chat echo')):
+        summary = report[key]
+        print('%-12s n=%-6d p50=%-10s p90=%-10s p99=%-10s max=%s' % (
+            label, summary['count'], ms(summary['p50']), ms(summary['p90']), ms(summary['p99']), ms(summary['max'])))
+
+    print('In:  %.0f packets/s  %.1f KiB/s' % (report['packetsInPerSecond'], report['bytesInPerSecond'] / 1024.0))
+    print('Out: %.0f packets/s  %.1f KiB/s' % (report['packetsOutPerSecond'], report['bytesOutPerSecond'] / 1024.0))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Connects a swarm of simulated players to a server.')
+    parser.add_argument('--host', default='127.0.0.1', help='The server to connect to.')
+    parser.add_argument('--port', default=25565, type=int, help='The port of the server.')
+    parser.add_argument('--bots', default=100, type=int, help='The number of simulated players.')
+    parser.add_argument('--ramp', default=20.0, type=float, help='How many bots to connect per second.')
+    parser.add_argument('--duration', default=60.0, type=float, help='How long to run the test in seconds.')
+    parser.add_argument('--walk-interval', default=0.05, type=float, help='Seconds between position updates.')
+    parser.add_argument('--chat-interval', default=5.0, type=float,
+                        help='Seconds between chat messages per bot, 0 to disable chat.')
+    parser.add_argument('--expected-chunks', default=100, type=int,
+                        help='The number of chunks a bot receives after logging in.')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+    args = parser.parse_args()
+
+    stats = Stats()
+    factory = BotFactory(stats, args.expected_chunks, args.walk_interval, args.chat_interval)
+
+    for i in xrange(args.bots):
+        reactor.callLater(i / args.ramp, reactor.connectTCP, args.host, args.port, factory)
+
+    reactor.callLater(args.duration, reactor.stop)
+    reactor.run()
+
+    if args.json:
+        print(json.dumps(stats.report(), indent=2, sort_keys=True))
+    else:
+        printReport(stats.report())
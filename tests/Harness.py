@@ -0,0 +1,65 @@
+from twisted.test.proto_helpers import StringTransport
+
+from minecraft.world.Chunk import Chunk
+from minecraft.world.World import World
+from pumpkinpy.TickScheduler import TickScheduler
+from pumpkinpy.metrics.Metrics import Metrics
+from pumpkinpy.networking import Packet
+from pumpkinpy.networking.BroadcastManager import BroadcastManager
+from pumpkinpy.networking.MinecraftProtocol import MinecraftFactory, MinecraftProtocol
+
+
+WORLD_RADIUS = 4
+GROUND = 64
+
+
+def makeFlatChunk(server, world, x, z):
+    # Stone up to y = GROUND - 1 and air above.
+    blocks = bytearray(32768)
+    for column in xrange(256):
+        base = column * 128
+        blocks[base:base + GROUND] = '\x01' * GROUND
+
+    blockMeta = bytearray(16384)
+    blockLight = bytearray(16384)
+    skyLight = bytearray('\xff' * 16384)
+
+    return Chunk(server, world, x, z, True, blocks, blockMeta, blockLight, skyLight)
+
+
+# A server with a flat in-memory world and no network or worker pool. The
+# tick loop is never started; tests run ticks themselves.
+class TestServer:
+    def __init__(self):
+        self.factory = MinecraftFactory()
+        self.factory.server = self
+        self.factory.clients = []
+
+        self.metrics = Metrics()
+        self.broadcastManager = BroadcastManager(self)
+        self.ticks = TickScheduler(self)
+        self.world = World(self, '')
+        self.nextEID = 100
+
+        for x in xrange(-WORLD_RADIUS, WORLD_RADIUS):
+            for z in xrange(-WORLD_RADIUS, WORLD_RADIUS):
+                self.world.addChunk(makeFlatChunk(self, self.world, x, z))
+
+    def allocateEntityId(self):
+        eid = self.nextEID
+        self.nextEID += 1
+        return eid
+
+    def connect(self):
+        client = MinecraftProtocol()
+        client.factory = self.factory
+        client.makeConnection(StringTransport())
+        return client
+
+    def login(self, username='Tester'):
+        # A client that has logged in but not been spawned yet.
+        client = self.connect()
+        client.dataReceived(Packet.LoginHandshakePacket.CODEC.encode((username,)))
+        client.dataReceived(Packet.LoginRequestPacket.CODEC.encode((MinecraftProtocol.PROTOCOL_VERSION, username, '',
+                                                                    0, 0)))
+        return client
@@ -0,0 +1,5 @@
+import __builtin__
+
+from twisted.internet import reactor
+
+__builtin__.reactor = reactor
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from minecraft.world.ChunkFile import makeDirectories
+
+
+class MakeDirectoriesTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testExisting(self):
+        directory = os.path.join(self.folder, 'a', 'b')
+        makeDirectories(directory)
+        makeDirectories(directory)
+        self.assertTrue(os.path.isdir(directory))
+
+    def testConcurrent(self):
+        directory = os.path.join(self.folder, 'a', 'b')
+        errors = []
+
+        def make():
+            try:
+                makeDirectories(directory)
+            except OSError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=make) for i in xrange(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertTrue(os.path.isdir(directory))
+
+    def testFileInTheWay(self):
+        location = os.path.join(self.folder, 'a')
+        open(location, 'w').close()
+        self.assertRaises(OSError, makeDirectories, location)
+
+
+if __name__ == '__main__':
+    unittest.main()
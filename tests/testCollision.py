@@ -0,0 +1,74 @@
+import unittest
+
+from minecraft.util.MinecraftConstants import Blocks
+from pumpkinpy.networking import Packet
+from tests.Harness import GROUND, TestServer
+
+
+class CollisionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = TestServer()
+        self.world = self.server.world
+        self.client = self.server.login()
+        self.client.spawnPlayer()
+        self.player = self.client.player
+
+    def tearDown(self):
+        self.client.connectionLost()
+
+    def assertMoved(self, x, y, z):
+        self.player.move(x, y, z, broadcast=False)
+        self.assertEqual((self.player.x, self.player.y, self.player.z), (x, y, z))
+
+    def assertRejected(self, x, y, z):
+        before = (self.player.x, self.player.y, self.player.z)
+        self.player.move(x, y, z, broadcast=False)
+        self.assertEqual((self.player.x, self.player.y, self.player.z), before)
+
+    def testGround(self):
+        self.assertMoved(2.5, GROUND, 2.5)
+        self.assertRejected(2.5, GROUND - 0.5, 2.5)
+
+    def testFarmland(self):
+        self.world.setBlockAt(2, GROUND - 1, 2, Blocks.FARMLAND)
+        self.assertMoved(2.5, GROUND - 0.0625, 2.5)
+        self.assertRejected(2.5, GROUND - 0.5, 2.5)
+
+    def testSoulSand(self):
+        self.world.setBlockAt(2, GROUND - 1, 2, Blocks.SOUL_SAND)
+        self.assertMoved(2.5, GROUND - 0.125, 2.5)
+        self.assertRejected(2.5, GROUND - 0.5, 2.5)
+
+    def testSlab(self):
+        self.world.setBlockAt(2, GROUND, 2, Blocks.SLAB)
+        self.assertMoved(2.5, GROUND + 0.5, 2.5)
+        self.assertRejected(2.5, GROUND + 0.25, 2.5)
+
+    def testFence(self):
+        self.world.setBlockAt(2, GROUND, 2, Blocks.FENCE)
+        self.assertRejected(2.5, GROUND + 1, 2.5)
+        self.assertMoved(2.5, GROUND + 1.5, 2.5)
+
+    def testTwoHighTunnel(self):
+        y = GROUND - 4
+        self.world.setBlockAt(5, y, 5, Blocks.AIR)
+        self.world.setBlockAt(5, y + 1, 5, Blocks.AIR)
+        self.assertMoved(5.5, y, 5.5)
+
+        self.world.setBlockAt(6, y, 5, Blocks.AIR)
+        self.assertRejected(6.5, y, 5.5)
+
+    def testTwoHighTunnelPosLook(self):
+        # Clients send x, y, stance, z.
+        y = GROUND - 4
+        self.world.setBlockAt(5, y, 5, Blocks.AIR)
+        self.world.setBlockAt(5, y + 1, 5, Blocks.AIR)
+
+        self.client.dataReceived(Packet.PlayerPosLookPacket.CODEC.encode((5.5, y, y + 1.62, 5.5, 90.0, 0.0, 1)))
+        self.assertEqual((self.player.x, self.player.y, self.player.z), (5.5, y, 5.5))
+        self.assertEqual(self.player.stance, y + 1.62)
+        self.assertEqual(self.player.h, 90.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
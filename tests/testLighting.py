@@ -0,0 +1,74 @@
+import unittest
+
+from minecraft.util.MinecraftConstants import Blocks
+from minecraft.world.Lighting import BLOCK_LIGHT, SKY_LIGHT
+from tests.Harness import GROUND, TestServer
+
+
+class LightingTest(unittest.TestCase):
+    def setUp(self):
+        self.server = TestServer()
+        self.world = self.server.world
+        self.lighting = self.world.lighting
+
+    def setBlock(self, x, y, z, blockId):
+        self.world.setBlockAt(x, y, z, blockId)
+        self.lighting.propagate(float('inf'))
+
+    def testTorch(self):
+        y = GROUND + 4
+        self.setBlock(8, y, 8, Blocks.TORCH)
+        self.assertEqual(self.lighting.getLevel(BLOCK_LIGHT, 8, y, 8), 14)
+        self.assertEqual(self.lighting.getLevel(BLOCK_LIGHT, 8, y, 12), 10)
+        # Across the chunk border.
+        self.assertEqual(self.lighting.getLevel(BLOCK_LIGHT, 19, y + 1, 8), 2)
+        self.assertEqual(self.lighting.getLevel(BLOCK_LIGHT, 8, GROUND - 1, 8), 0)
+
+        self.setBlock(8, y, 8, Blocks.AIR)
+        self.assertEqual(self.lighting.getLevel(BLOCK_LIGHT, 8, y, 8), 0)
+        self.assertEqual(self.lighting.getLevel(BLOCK_LIGHT, 19, y + 1, 8), 0)
+
+    def testTorchBehindWall(self):
+        y = GROUND
+        for z in xrange(-2, 3):
+            for wallY in xrange(y, y + 3):
+                self.world.setBlockAt(9, wallY, 8 + z, Blocks.STONE)
+        self.setBlock(8, y, 8, Blocks.TORCH)
+        # Over or around the wall rather than through it, eight blocks.
+        self.assertEqual(self.lighting.getLevel(BLOCK_LIGHT, 10, y, 8), 14 - 8)
+
+    def testRoof(self):
+        y = GROUND + 4
+        self.setBlock(8, y, 8, Blocks.STONE)
+        self.assertEqual(self.lighting.getLevel(SKY_LIGHT, 8, y + 1, 8), 15)
+        self.assertEqual(self.lighting.getLevel(SKY_LIGHT, 8, y, 8), 0)
+        self.assertEqual(self.lighting.getLevel(SKY_LIGHT, 8, y - 1, 8), 14)
+        self.assertEqual(self.lighting.getLevel(SKY_LIGHT, 8, GROUND, 8), 14)
+
+        self.setBlock(8, y, 8, Blocks.AIR)
+        self.assertEqual(self.lighting.getLevel(SKY_LIGHT, 8, y, 8), 15)
+        self.assertEqual(self.lighting.getLevel(SKY_LIGHT, 8, GROUND, 8), 15)
+
+    def testLargeFillRemovesLight(self):
+        # A glowstone wall at the edge of a chunk lights a cave in the next.
+        y = GROUND - 16
+        self.world.fillBox(16, y, 0, 32, y + 8, 16, Blocks.AIR)
+        self.world.fillBox(15, y, 0, 16, y + 8, 16, Blocks.GLOW_STONE)
+        self.lighting.propagate(float('inf'))
+        self.assertEqual(self.lighting.getLevel(BLOCK_LIGHT, 16, y + 4, 8), 14)
+        self.assertEqual(self.lighting.getLevel(BLOCK_LIGHT, 20, y + 4, 8), 10)
+
+        # Hollowing out the wall's chunk changes more than RELIGHT_THRESHOLD
+        # blocks, the wall among them.
+        self.assertTrue(self.world.fillBox(0, y, 0, 16, y + 8, 16, Blocks.AIR) > self.lighting.RELIGHT_THRESHOLD)
+        self.lighting.propagate(float('inf'))
+        for x in (8, 12, 15, 16, 17, 20):
+            self.assertEqual(self.lighting.getLevel(BLOCK_LIGHT, x, y + 4, 8), 0)
+
+    def testUnchangedLightIsLeftAlone(self):
+        self.world.setBlockAt(8, GROUND - 10, 8, Blocks.DIRT)
+        self.assertFalse(self.lighting.regions[BLOCK_LIGHT])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import json
+import unittest
+
+from tests.Harness import TestServer
+
+
+class ClientLabelTest(unittest.TestCase):
+    USERNAME = 'a"b\\c\nd\xff'
+
+    def setUp(self):
+        self.server = TestServer()
+        self.client = self.server.login(self.USERNAME)
+
+    def tearDown(self):
+        self.client.connectionLost()
+
+    def testSnapshot(self):
+        stats = json.loads(json.dumps(self.server.metrics.snapshot(self.server)))
+        self.assertEqual(stats['connections'][0]['username'], u'a"b\\c\nd\ufffd')
+
+    def testPrometheus(self):
+        text = self.server.metrics.prometheus(self.server)
+        self.assertIsInstance(text, str)
+        line = [line for line in text.split('\n') if line.startswith('pumpkinpy_connection_backlog_bytes')][0]
+        self.assertTrue(line.startswith('pumpkinpy_connection_backlog_bytes{client="a\\"b\\\\c\\nd\xef\xbf\xbd"} '))
+
+
+if __name__ == '__main__':
+    unittest.main()
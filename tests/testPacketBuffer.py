@@ -0,0 +1,125 @@
+import struct
+import unittest
+
+from pumpkinpy.networking import Packet
+from pumpkinpy.networking.MinecraftProtocol import ANONYMOUS, HANDSHAKE, PLAY_GAME
+from pumpkinpy.networking.PacketBuffer import PacketBuffer
+from tests.Harness import TestServer
+
+
+def decode(buff):
+    # The framing loop of MinecraftProtocol.dataReceived, without dispatch.
+    results = []
+    while len(buff):
+        packetClass = Packet.PACKETS_BY_ID[buff.peek()]
+        if packetClass.EXPECTED_SIZE > len(buff):
+            break
+
+        packet = packetClass(buff.buff, buff.offset + 1)
+        try:
+            result = packet.handlePacket()
+        except struct.error:
+            break
+
+        buff.advance(1 + packet.size)
+        results.append(result)
+    buff.compact()
+    return results
+
+
+class PacketBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.buff = PacketBuffer()
+
+    def testSplitPacket(self):
+        data = Packet.PlayerPositionPacket.CODEC.encode((10.5, 70.0, 71.62, 10.5, 1))
+        for i in xrange(len(data) - 1):
+            self.buff.feed(data[i])
+            self.assertEqual(decode(self.buff), [])
+            self.assertEqual(len(self.buff), i + 1)
+
+        self.buff.feed(data[-1])
+        self.assertEqual(decode(self.buff), [(10.5, 70.0, 71.62, 10.5, True)])
+        self.assertEqual(len(self.buff), 0)
+        self.assertEqual(self.buff.offset, 0)
+
+    def testSeveralPackets(self):
+        self.buff.feed(Packet.ChatMessagePacket.encode('one') + Packet.PlayerOnGroundPacket.CODEC.encode((1,)) +
+                       Packet.ChatMessagePacket.encode('two') + Packet.ChatMessagePacket.encode('th'))
+        self.buff.feed('\x03\x00\x05thr')
+        self.assertEqual(decode(self.buff), ['one', True, 'two', 'th'])
+
+        # The cut-off message stays buffered until the rest arrives.
+        self.assertEqual(len(self.buff), 6)
+        self.buff.feed('ee')
+        self.assertEqual(decode(self.buff), ['three'])
+        self.assertEqual(len(self.buff), 0)
+
+    def testCutOffString(self):
+        data = Packet.ChatMessagePacket.encode('hello world')
+        # Cut inside the length prefix and inside the string itself.
+        for cut in (2, 5, len(data) - 1):
+            self.buff.clear()
+            self.buff.feed(data[:cut])
+            self.assertEqual(decode(self.buff), [])
+            self.assertEqual(len(self.buff), cut)
+
+            self.buff.feed(data[cut:])
+            self.assertEqual(decode(self.buff), ['hello world'])
+            self.assertEqual(len(self.buff), 0)
+
+    def testCompact(self):
+        self.buff.COMPACT_THRESHOLD = 8
+        data = Packet.ChatMessagePacket.encode('hello')
+        self.buff.feed(data * 3 + data[:4])
+        self.assertEqual(decode(self.buff), ['hello'] * 3)
+        self.assertEqual(self.buff.offset, 0)
+        self.assertEqual(self.buff.buff, data[:4])
+
+
+class DataReceivedTest(unittest.TestCase):
+    def setUp(self):
+        self.server = TestServer()
+        self.client = self.server.connect()
+
+    def tearDown(self):
+        self.client.connectionLost()
+
+    def getCount(self, packetClass):
+        return self.server.metrics.inbound.counts[packetClass.PACKET_ID]
+
+    def testHandshakeCutOff(self):
+        data = Packet.LoginHandshakePacket.CODEC.encode(('Tester',))
+        self.client.dataReceived(data[:5])
+        self.assertEqual(self.client.state, ANONYMOUS)
+        self.assertIsNone(self.client.username)
+        self.assertEqual(self.getCount(Packet.LoginHandshakePacket), 0)
+
+        self.client.dataReceived(data[5:])
+        self.assertEqual(self.client.state, HANDSHAKE)
+        self.assertEqual(self.client.username, 'Tester')
+        self.assertFalse(self.client.transport.disconnecting)
+
+    def testLoginInOneRead(self):
+        data = (Packet.LoginHandshakePacket.CODEC.encode(('Tester',)) +
+                Packet.LoginRequestPacket.CODEC.encode((self.client.PROTOCOL_VERSION, 'Tester', '', 0, 0)) +
+                Packet.KeepAlivePacket.CODEC.encode(()))
+        self.client.dataReceived(data)
+        self.assertEqual(self.client.state, PLAY_GAME)
+        self.assertEqual(self.getCount(Packet.KeepAlivePacket), 1)
+        self.assertEqual(len(self.client.dataBuffer), 0)
+
+    def testMovementSplitAcrossReads(self):
+        self.client.dataReceived(Packet.LoginHandshakePacket.CODEC.encode(('Tester',)) +
+                                 Packet.LoginRequestPacket.CODEC.encode((self.client.PROTOCOL_VERSION, 'Tester',
+                                                                         '', 0, 0)))
+        data = Packet.PlayerPositionPacket.CODEC.encode((10.5, 70.0, 71.62, 10.5, 1)) * 2
+        for start in xrange(0, len(data), 7):
+            self.client.dataReceived(data[start:start + 7])
+        self.assertEqual(self.getCount(Packet.PlayerPositionPacket), 2)
+        self.assertEqual(len(self.client.dataBuffer), 0)
+        self.assertFalse(self.client.transport.disconnecting)
+
+
+if __name__ == '__main__':
+    unittest.main()
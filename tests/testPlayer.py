@@ -0,0 +1,39 @@
+import unittest
+
+from pumpkinpy.networking import Packet
+from pumpkinpy.networking.MinecraftProtocol import PLAY_GAME
+from tests.Harness import TestServer
+
+
+class MoveBeforeSpawnTest(unittest.TestCase):
+    def setUp(self):
+        self.server = TestServer()
+        self.client = self.server.login()
+
+    def tearDown(self):
+        self.client.connectionLost()
+
+    def testMovementIsDropped(self):
+        player = self.client.player
+        self.assertEqual(self.client.state, PLAY_GAME)
+        self.assertIsNone(player.world)
+
+        self.client.dataReceived(Packet.PlayerPositionPacket.CODEC.encode((10.5, 70.0, 71.62, 10.5, 1)))
+        self.client.dataReceived(Packet.PlayerPosLookPacket.CODEC.encode((10.5, 70.0, 71.62, 10.5, 0.0, 0.0, 1)))
+
+        self.assertFalse(self.client.transport.disconnecting)
+        self.assertEqual((player.x, player.y, player.z), (0.0, 0.0, 0.0))
+        self.assertIsNone(player.chunk)
+
+    def testSpawnAfterDroppedMovement(self):
+        self.client.dataReceived(Packet.PlayerPositionPacket.CODEC.encode((10.5, 70.0, 71.62, 10.5, 1)))
+        self.client.spawnPlayer()
+
+        player = self.client.player
+        self.assertIs(player.world, self.server.world)
+        self.assertEqual((player.x, player.z), (0, 0))
+        self.assertIsNotNone(player.chunk)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from minecraft.world.RegionFile import (SECTOR_SIZE, ZLIB, RegionFile, RegionStorage, compactRegionFile,
+                                        getRegionName)
+
+
+def makeData(size, seed=0):
+    # Random bytes do not compress, so size decides the sectors used.
+    rng = random.Random(seed)
+    return ''.join(chr(rng.randint(0, 255)) for i in xrange(size))
+
+
+class RegionFileTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.location = os.path.join(self.folder, getRegionName(0, 0))
+        self.region = RegionFile(self.location)
+
+    def tearDown(self):
+        self.region.close()
+        shutil.rmtree(self.folder)
+
+    def getSectors(self):
+        return os.path.getsize(self.location) // SECTOR_SIZE
+
+    def testRoundTrip(self):
+        data = makeData(1000)
+        self.region.write(3, 5, data)
+        self.assertTrue(self.region.hasChunk(3, 5))
+        self.assertFalse(self.region.hasChunk(5, 3))
+        self.assertEqual(self.region.read(3, 5), data)
+        self.assertIsNone(self.region.read(5, 3))
+
+        self.region.close()
+        self.region = RegionFile(self.location, readOnly=True)
+        self.assertEqual(self.region.read(3, 5), data)
+        self.assertEqual(self.region.getChunkCoords(0, 0), [(3, 5)])
+
+    def testFreedSectorsAreReused(self):
+        self.region.write(0, 0, makeData(1000, 1))
+        self.region.write(1, 0, makeData(1000, 2))
+        sectors = self.getSectors()
+
+        # Each write goes to free sectors before the old ones are released,
+        # so one spare sector is all repeated saves ever need.
+        for i in xrange(10):
+            self.region.write(0, 0, makeData(1000, i))
+        self.assertEqual(self.getSectors(), sectors + 1)
+        self.assertEqual(self.region.read(0, 0), makeData(1000, 9))
+        self.assertEqual(self.region.read(1, 0), makeData(1000, 2))
+
+    def testGrowingChunk(self):
+        self.region.write(0, 0, makeData(1000, 1))
+        self.region.write(1, 0, makeData(1000, 2))
+
+        data = makeData(SECTOR_SIZE * 3, 3)
+        self.region.write(0, 0, data)
+        offset, count = self.region.getLocation(0)
+        self.assertEqual(count, 4)
+        self.assertEqual(self.region.read(0, 0), data)
+        self.assertEqual(self.region.read(1, 0), makeData(1000, 2))
+
+        # Shrinking again frees the large run.
+        self.region.write(0, 0, makeData(1000, 4))
+        self.assertEqual(self.region.getLocation(0)[1], 1)
+        self.assertEqual(self.region.read(0, 0), makeData(1000, 4))
+
+    def testTooLarge(self):
+        self.assertRaises(ValueError, self.region.writeCompressed, 0, 0, ZLIB, makeData(SECTOR_SIZE * 255))
+
+    def testCompaction(self):
+        chunks = {}
+        for i in xrange(8):
+            chunks[(i, 31 - i)] = makeData(500 * (i + 1), i)
+            self.region.writeCompressed(i, 31 - i, ZLIB, zlib.compress(chunks[(i, 31 - i)]), 1000 + i)
+        for i in xrange(4):
+            # Leaves freed sectors behind.
+            chunks[(i, 31 - i)] = makeData(SECTOR_SIZE * 2, 10 + i)
+            self.region.writeCompressed(i, 31 - i, ZLIB, zlib.compress(chunks[(i, 31 - i)]), 2000 + i)
+        self.region.close()
+
+        before, after = compactRegionFile(self.location)
+        self.assertTrue(after < before)
+
+        self.region = RegionFile(self.location, readOnly=True)
+        self.assertEqual(sorted(self.region.getChunkCoords(0, 0)), sorted(chunks))
+        for (x, z), data in chunks.iteritems():
+            self.assertEqual(self.region.read(x, z), data)
+            timestamp = self.region.getTimestamp(x + z * 32)
+            self.assertEqual(timestamp, (2000 if x < 4 else 1000) + x)
+
+
+class RegionStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.folder, 'region'))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testUnreadableRegionIsSkipped(self):
+        region = RegionFile(os.path.join(self.folder, 'region', getRegionName(0, 0)))
+        region.write(1, 2, makeData(100))
+        region.close()
+        # Truncated, as by a crash while the file was first created.
+        open(os.path.join(self.folder, 'region', getRegionName(1, 0)), 'wb').write('\x00' * 100)
+
+        storage = RegionStorage(self.folder, readOnly=True)
+        try:
+            self.assertEqual(storage.listChunks(), [(1, 2)])
+            jobs, total = storage.getLoadJobs()
+            self.assertEqual((len(jobs), total), (1, 1))
+        finally:
+            storage.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
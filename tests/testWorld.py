@@ -0,0 +1,42 @@
+import unittest
+
+from minecraft.util.MinecraftConstants import Blocks
+from tests.Harness import GROUND, TestServer
+
+
+class FillBoxTest(unittest.TestCase):
+    def setUp(self):
+        self.server = TestServer()
+        self.world = self.server.world
+        self.chunk = self.world.getChunk(0, 0)
+
+    def testUnchangedBlocksAreSkipped(self):
+        # Half the box is stone already.
+        self.assertEqual(self.world.fillBox(0, GROUND - 2, 0, 4, GROUND + 2, 4, Blocks.STONE), 32)
+        self.assertEqual(self.world.getBlockAt(1, GROUND + 1, 1).blockId, Blocks.STONE)
+
+    def testNothingChanged(self):
+        self.assertEqual(self.world.fillBox(0, 0, 0, 4, GROUND, 4, Blocks.STONE), 0)
+        self.assertFalse(self.chunk.dirty)
+        self.assertFalse(self.chunk.changedBlocks)
+        self.assertNotIn(self.chunk, self.world.changedChunks)
+
+    def testMetaOnlyChange(self):
+        self.assertEqual(self.world.fillBox(0, GROUND - 1, 0, 2, GROUND, 2, Blocks.STONE, meta=3), 4)
+        self.assertEqual(self.world.getBlockAt(1, GROUND - 1, 1).blockData, 3)
+        self.assertEqual(self.world.fillBox(0, GROUND - 1, 0, 2, GROUND, 2, Blocks.STONE, meta=3), 0)
+
+    def testReplace(self):
+        self.world.fillBox(0, GROUND, 0, 2, GROUND + 1, 2, Blocks.DIRT)
+        self.assertEqual(self.world.fillBox(0, GROUND - 1, 0, 4, GROUND + 1, 4, Blocks.DIRT, replace=Blocks.DIRT), 0)
+        self.assertEqual(self.world.fillBox(0, GROUND - 1, 0, 4, GROUND + 1, 4, Blocks.GRASS, replace=Blocks.DIRT), 4)
+
+    def testHeightMap(self):
+        self.world.fillBox(0, GROUND, 0, 2, GROUND + 3, 2, Blocks.STONE)
+        self.assertEqual(self.world.getHeightAt(1, 1), GROUND + 3)
+        self.world.fillBox(0, GROUND - 3, 0, 2, GROUND + 3, 2, Blocks.AIR)
+        self.assertEqual(self.world.getHeightAt(1, 1), GROUND - 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
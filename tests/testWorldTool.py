@@ -0,0 +1,73 @@
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from minecraft.world.Chunk import DATA_SIZE
+from minecraft.world.ChunkFile import ChunkFileStorage
+from minecraft.world.RegionFile import RegionStorage
+from pumpkinpy.WorldTool import convert, readChunkData
+
+
+def makeData(blockId):
+    data = numpy.zeros(DATA_SIZE, numpy.uint8)
+    data[0] = blockId
+    return data
+
+
+class ConvertTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.chunkFiles = ChunkFileStorage(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def convert(self, to, keep=False):
+        convert(argparse.Namespace(world_directory=self.folder, to=to, keep=keep, workers=0))
+
+    def readBlock(self, storage, x, z):
+        try:
+            return readChunkData(storage, x, z)[1][0]
+        finally:
+            storage.close()
+
+    def testToRegionKeepsNewerRegionCopy(self):
+        # A region world leaves the chunk file behind when it saves a chunk.
+        self.chunkFiles.writeChunk(3, 3, True, makeData(0))
+        self.chunkFiles.writeChunk(4, 3, True, makeData(1))
+        regions = RegionStorage(self.folder)
+        regions.writeChunk(3, 3, True, makeData(57))
+        regions.close()
+
+        self.convert('region')
+
+        self.assertEqual(self.readBlock(RegionStorage(self.folder, readOnly=True), 3, 3), 57)
+        self.assertEqual(self.readBlock(RegionStorage(self.folder, readOnly=True), 4, 3), 1)
+        self.assertEqual(self.chunkFiles.listChunks(), [])
+
+    def testToRegionKeep(self):
+        self.chunkFiles.writeChunk(3, 3, True, makeData(1))
+        self.convert('region', keep=True)
+        self.assertTrue(self.chunkFiles.hasChunk(3, 3))
+        self.assertEqual(self.readBlock(RegionStorage(self.folder, readOnly=True), 3, 3), 1)
+
+    def testToChunks(self):
+        self.chunkFiles.writeChunk(3, 3, True, makeData(0))
+        regions = RegionStorage(self.folder)
+        regions.writeChunk(3, 3, True, makeData(57))
+        regions.writeChunk(40, -3, True, makeData(2))
+        regions.close()
+
+        self.convert('chunks')
+
+        self.assertEqual(self.readBlock(self.chunkFiles, 3, 3), 57)
+        self.assertEqual(self.readBlock(self.chunkFiles, 40, -3), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'region')))
+
+
+if __name__ == '__main__':
+    unittest.main()